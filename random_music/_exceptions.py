@@ -38,3 +38,20 @@ class MissingConfigFileError(_Error):
         return repr(self.value)
 
 
+
+
+class QuerySyntaxError(_Error):
+    """
+    Search terms could not be parsed as a query.
+    """
+    def __init__(self, reason):
+        """
+        :param reason: description of what is wrong with the query
+        :type reason: str
+        """
+        self.reason = reason
+        self.value = "Invalid search terms: %s" % reason
+        Exception.__init__(self, self.value)
+
+    def __str__(self):
+        return repr(self.value)
@@ -0,0 +1,281 @@
+"""Benchmark random_music against a synthetic music library.
+
+A library of empty files is generated in a temporary directory: a tree of
+the given depth and fan-out, with the given number of songs (and a cover
+image, which should not be indexed) in each leaf directory. Each operation
+is then timed several times, and the fastest and median times written out
+as JSON, e.g.:
+
+$ python -m random_music.benchmark --depth 3 --fanout 10 --files 12 \\
+      -o before.json
+$ python -m random_music.benchmark --depth 3 --fanout 10 --files 12 \\
+      -o after.json
+$ python -m random_music.benchmark --compare before.json after.json
+
+Comparing two runs reports how each operation's fastest time changed, and
+exits with status 1 if any got slower by more than the threshold.
+
+"""
+
+from __future__ import with_statement
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+from optparse import OptionParser
+from ConfigParser import RawConfigParser
+
+import random_music
+from index import INDEX_FORMATS, TEXT_FORMAT
+from selection import SHUFFLE_MODES, RANDOM_SHUFFLE
+
+DEFAULT_DEPTH = 3
+DEFAULT_FANOUT = 8
+DEFAULT_FILES = 10
+DEFAULT_REPEAT = 5
+# Number of songs picked when timing track selection
+PICKS = 1000
+DEFAULT_SEARCH_TERMS = ["track", "1"]
+# A result this much slower than the baseline is a regression
+DEFAULT_THRESHOLD = 0.2
+
+
+def generate_library(root, depth, fanout, files):
+    """
+    Generate a tree of empty song files, returning the number of songs.
+
+    :param root: directory to generate the library in
+    :type root: str
+    :param depth: number of levels of directories
+    :type depth: int
+    :param fanout: number of subdirectories of each directory
+    :type fanout: int
+    :param files: number of songs in each leaf directory
+    :type files: int
+    """
+    count = 0
+    pending = [(root, 0)]
+    while pending:
+        path, level = pending.pop()
+        if level == depth:
+            for n in xrange(files):
+                song = os.path.join(path, "%02d Track %d.mp3" % (n + 1, count))
+                os.close(os.open(song, os.O_CREAT | os.O_WRONLY, 0644))
+                count += 1
+            os.close(os.open(os.path.join(path, "cover.jpg"),
+                             os.O_CREAT | os.O_WRONLY, 0644))
+            continue
+        for n in xrange(fanout):
+            child = os.path.join(path, "%s %d" % (("Artist", "Album",
+                                                   "Disc")[min(level, 2)], n))
+            os.mkdir(child)
+            pending.append((child, level + 1))
+    return count
+
+
+def _write_config(path, music_dir, index_dir, index_format, shuffle_mode):
+    config = RawConfigParser()
+    config.add_section("config")
+    config.set("config", "loop_songs", "true")
+    config.set("config", "randomise", "true")
+    config.set("config", "index_dir", index_dir)
+    config.set("config", "index_format", index_format)
+    config.set("config", "music_client", "true")
+    config.set("config", "shuffle_mode", shuffle_mode)
+    config.set("config", "music_dirs", music_dir)
+    with open(path, "wb") as fh:
+        config.write(fh)
+
+
+def _time(func, repeat):
+    """
+    Time func, returning a dict of the fastest and median times in seconds.
+    """
+    times = []
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    times.sort()
+    return {"min": times[0], "median": times[len(times) // 2],
+            "runs": repeat}
+
+
+def _pick_songs(rmp):
+    song_index = -1
+    for _ in xrange(PICKS):
+        song_index = rmp._get_song_index(song_index)
+
+
+def run_benchmarks(work_dir, depth=DEFAULT_DEPTH, fanout=DEFAULT_FANOUT,
+                   files=DEFAULT_FILES, repeat=DEFAULT_REPEAT,
+                   index_format=TEXT_FORMAT, shuffle_mode=RANDOM_SHUFFLE,
+                   search_terms=DEFAULT_SEARCH_TERMS):
+    """
+    Generate a library in work_dir and time operations against it,
+    returning the results as a dict.
+
+    :param work_dir: an empty directory to work in
+    :type work_dir: str
+    :param repeat: number of times each operation is timed
+    :type repeat: int
+    :param index_format: one of index.INDEX_FORMATS
+    :type index_format: str
+    :param shuffle_mode: one of selection.SHUFFLE_MODES
+    :type shuffle_mode: str
+    :param search_terms: search terms to time searches with
+    :type search_terms: list[str]
+    """
+    music_dir = os.path.join(work_dir, "music")
+    home_dir = os.path.join(work_dir, "home")
+    config_file = os.path.join(home_dir, "config.txt")
+    os.mkdir(music_dir)
+    os.mkdir(home_dir)
+    start = time.time()
+    songs = generate_library(music_dir, depth, fanout, files)
+    generate_time = time.time() - start
+    _write_config(config_file, music_dir, os.path.join(home_dir, "indicies"),
+                  index_format, shuffle_mode)
+
+    # Keep everything random_music stores in the home directory out of the
+    # user's own.
+    old_home_dir = random_music.DEFAULT_HOME_DIR
+    old_stdout = sys.stdout
+    random_music.DEFAULT_HOME_DIR = home_dir
+    sys.stdout = open(os.devnull, "w")
+    try:
+        # The first run creates the index
+        rmp = random_music.RandomMusicPlaylist(config_file, use_daemon=False,
+                                               seed=0)
+        results = {
+            "update_index": _time(rmp._update_index, repeat),
+            "full_update_index": _time(lambda: rmp._update_index(full=True),
+                                       repeat),
+            "get_index_file": _time(rmp.get_index_file, repeat),
+        }
+        rmp.index_file = rmp.get_index_file()
+        rmp.search_terms = []
+        rmp.parse_search_terms(rmp.search_terms)
+        results["generate_list"] = _time(rmp.generate_list, repeat)
+        results["pick_songs"] = _time(lambda: _pick_songs(rmp), repeat)
+        results["parse_search_terms"] = _time(
+            lambda: rmp.parse_search_terms(search_terms), repeat)
+        rmp.search_terms = search_terms
+        rmp.parse_search_terms(search_terms)
+        results["generate_list_search"] = _time(rmp.generate_list, repeat)
+    finally:
+        sys.stdout.close()
+        sys.stdout = old_stdout
+        random_music.DEFAULT_HOME_DIR = old_home_dir
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "depth": depth,
+            "fanout": fanout,
+            "files": files,
+            "songs": songs,
+            "index_format": index_format,
+            "shuffle_mode": shuffle_mode,
+            "search_terms": search_terms,
+            "generate_library": generate_time,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare two sets of results, returning a list of (name, baseline time,
+    current time, regressed) tuples, one for each operation timed in both.
+
+    :param baseline: results of the earlier run
+    :type baseline: dict
+    :param current: results of the later run
+    :type current: dict
+    :param threshold: fraction by which an operation must slow down to
+    count as a regression
+    :type threshold: float
+    """
+    comparison = []
+    for name in sorted(baseline["results"]):
+        if name not in current["results"]:
+            continue
+        before = baseline["results"][name]["min"]
+        after = current["results"][name]["min"]
+        comparison.append((name, before, after,
+                           after > before * (1 + threshold)))
+    return comparison
+
+
+def main():
+    """
+    Parse user args, then run the benchmarks or compare two runs.
+    """
+    parser = OptionParser(usage="%prog [options]\n"
+                                "       %prog --compare BASELINE CURRENT")
+    parser.add_option("--depth", type="int", default=DEFAULT_DEPTH,
+                help="Levels of directories (default %d)" % DEFAULT_DEPTH)
+    parser.add_option("--fanout", type="int", default=DEFAULT_FANOUT,
+                help="Subdirectories per directory (default %d)" %
+                     DEFAULT_FANOUT)
+    parser.add_option("--files", type="int", default=DEFAULT_FILES,
+                help="Songs per leaf directory (default %d)" % DEFAULT_FILES)
+    parser.add_option("--repeat", type="int", default=DEFAULT_REPEAT,
+                help="Times to run each operation (default %d)" %
+                     DEFAULT_REPEAT)
+    parser.add_option("--index-format", dest="index_format",
+                default=TEXT_FORMAT, type="choice",
+                choices=sorted(INDEX_FORMATS))
+    parser.add_option("--shuffle-mode", dest="shuffle_mode",
+                default=RANDOM_SHUFFLE, type="choice",
+                choices=list(SHUFFLE_MODES))
+    parser.add_option("-o", "--output", dest="output",
+                help="Write results to a file instead of stdout")
+    parser.add_option("--compare", action="store_true", dest="compare",
+                default=False, help="Compare two earlier runs")
+    parser.add_option("--threshold", type="float", default=DEFAULT_THRESHOLD,
+                help="Slowdown counted as a regression (default %g)" %
+                     DEFAULT_THRESHOLD)
+    (options, args) = parser.parse_args()
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error("--compare needs two result files")
+        with open(args[0]) as fh:
+            baseline = json.load(fh)
+        with open(args[1]) as fh:
+            current = json.load(fh)
+        regressed = False
+        for name, before, after, slower in compare(baseline, current,
+                                                   options.threshold):
+            sys.stdout.write("%-22s %11.6fs %11.6fs %+7.1f%%%s\n" %
+                             (name, before, after,
+                              (after / before - 1) * 100 if before else 0,
+                              "  REGRESSION" if slower else ""))
+            regressed = regressed or slower
+        return 1 if regressed else 0
+
+    work_dir = tempfile.mkdtemp(prefix="random_music_benchmark")
+    try:
+        results = run_benchmarks(work_dir, options.depth, options.fanout,
+                                 options.files, options.repeat,
+                                 options.index_format, options.shuffle_mode,
+                                 args or DEFAULT_SEARCH_TERMS)
+    finally:
+        shutil.rmtree(work_dir)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as fh:
+            fh.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,544 @@
+"""Play songs from an event loop which also takes commands.
+
+The players in the player module block until each song finishes, and can
+only be interrupted with ctrl+c. A PlaybackController instead starts the
+music client for each song and goes back to its event loop, a select() loop
+which waits on:
+
+- commands typed at the terminal, one per line,
+- commands sent to its control socket (see send_command), one per line,
+- the music client exiting (signalled by SIGCHLD, through a wakeup pipe),
+- background commands finishing (signalled through another pipe),
+- timers, such as the read-ahead hint for the next songs.
+
+Commands are:
+
+skip (or s, next, n)
+    Stop the current song and move on to the next.
+pause (or p)
+    Pause or resume the current song (by stopping and continuing the music
+    client, so this works with any music client).
+queue SONG (or q SONG)
+    Play a song next. If SONG is not a file, it is taken as search terms,
+    and every matching song is queued.
+quit (or exit, x)
+    Stop playing.
+
+Anything else the caller wants to run on the loop can be added as a command
+too. Commands which take a while (such as index updates) can be added as
+background commands instead: these run in a worker thread, one at a time, so
+that songs keep changing and commands keep being answered meanwhile, and
+their replies are written out once they finish.
+
+Once a song starts, the kernel is told (with posix_fadvise, where it is
+available) that the upcoming songs will be read soon, so it can start
+reading them in ahead of time.
+
+"""
+
+from __future__ import with_statement
+import os
+import sys
+import time
+import errno
+import fcntl
+import heapq
+import select
+import signal
+import socket
+import ctypes
+import ctypes.util
+import threading
+import subprocess
+from collections import deque, namedtuple
+
+# A song to play: key is whatever the caller uses to identify it, song its
+# path, path where to play it from (e.g. a cached copy) and upcoming the
+# paths of the songs expected after it
+Track = namedtuple("Track", "key song path upcoming")
+
+POSIX_FADV_WILLNEED = 3
+# Delay before hinting at upcoming songs, so the current song starts first
+HINT_DELAY = 1.0
+# A second ctrl+c within this long quits, rather than skipping
+QUIT_INTERVAL = 0.5
+# Longest command accepted from the control socket
+MAX_COMMAND = 4096
+
+
+def _load_fadvise():
+    """
+    Return libc's posix_fadvise, or None if it is not available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        fadvise = getattr(libc, "posix_fadvise64", None) or \
+            libc.posix_fadvise
+    except (OSError, AttributeError):
+        return None
+    fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                        ctypes.c_int]
+    return fadvise
+
+_fadvise = _load_fadvise()
+
+
+def readahead_hint(path):
+    """
+    Tell the kernel a file will be read soon. Does nothing where
+    posix_fadvise is not available, or the file cannot be opened.
+
+    :param path: path to the file
+    :type path: str
+    """
+    if _fadvise is None:
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        _fadvise(fd, 0, 0, POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def send_command(socket_file, command):
+    """
+    Send a command to a running controller, returning its reply.
+
+    :param socket_file: path to the controller's socket
+    :type socket_file: str
+    :param command: the command, e.g. "skip"
+    :type command: str
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_file)
+        sock.sendall(command + "\n")
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        for chunk in iter(lambda: sock.recv(4096), ""):
+            chunks.append(chunk)
+        return "".join(chunks)
+    finally:
+        sock.close()
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class EventLoop(object):
+    """
+    A minimal select() loop, with readers and timers.
+    """
+    def __init__(self):
+        self.readers = {}
+        self.timers = []
+        self._timer_count = 0
+        self.running = False
+
+    def add_reader(self, fd, callback):
+        """
+        Call callback whenever fd is readable.
+
+        :param fd: file descriptor
+        :type fd: int
+        :param callback: callable taking no arguments
+        :type callback: callable
+        """
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def call_later(self, delay, callback):
+        """
+        Call callback after delay seconds.
+
+        :param delay: seconds to wait
+        :type delay: float
+        :param callback: callable taking no arguments
+        :type callback: callable
+        """
+        # The count keeps timers due at the same time in order, and stops
+        # the callbacks themselves ever being compared.
+        self._timer_count += 1
+        heapq.heappush(self.timers, (time.time() + delay, self._timer_count,
+                                     callback))
+
+    def stop(self):
+        """
+        Have whoever is calling run_once() stop.
+        """
+        self.running = False
+
+    def run_once(self, timeout=None):
+        """
+        Wait for (at most timeout seconds for) something to happen, and
+        handle it.
+        """
+        if self.timers:
+            until_timer = max(0, self.timers[0][0] - time.time())
+            if timeout is None or until_timer < timeout:
+                timeout = until_timer
+        try:
+            readable, _, _ = select.select(list(self.readers), [], [],
+                                           timeout)
+        except select.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+            readable = []
+        for fd in readable:
+            callback = self.readers.get(fd)
+            if callback is not None:
+                callback()
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            heapq.heappop(self.timers)[2]()
+
+
+class PlaybackController(object):
+    """
+    Play songs from an event loop, taking commands from the terminal and a
+    control socket.
+    """
+    def __init__(self, music_client, tracks, socket_file=None,
+                 use_stdin=True, on_skip=None, find=None, commands=None,
+                 background_commands=None, out=sys.stdout):
+        """
+        :param music_client: the music client to play songs with
+        :type music_client: str
+        :param tracks: the songs to play
+        :type tracks: iterator of Track
+        :param socket_file: path of the control socket to listen on
+        (optional)
+        :type socket_file: str
+        :param use_stdin: read commands from stdin
+        :type use_stdin: bool
+        :param on_skip: called with a Track when it is skipped (optional)
+        :type on_skip: callable
+        :param find: called with a list of search terms, returning the
+        matching songs, for the queue command (optional)
+        :type find: callable
+        :param commands: further commands, mapping each name to a callable
+        taking the command's arguments and returning a reply (optional)
+        :type commands: dict
+        :param background_commands: further commands, as for commands, which
+        are run in a worker thread (optional)
+        :type background_commands: dict
+        :param out: where to write the songs being played
+        :type out: file
+        """
+        self.argv = [music_client]
+        self.tracks = tracks
+        self.socket_file = socket_file
+        self.use_stdin = use_stdin
+        self.on_skip = on_skip
+        self.find = find
+        self.commands = dict(commands or {})
+        self.background_commands = dict(background_commands or {})
+        self.out = out
+        self.loop = EventLoop()
+        self.queued = deque()
+        self.current = None
+        self.proc = None
+        self.paused = False
+        self.skipping = False
+        self.last_interrupt = 0
+        self.devnull = open(os.devnull, "r+b")
+        self.server = None
+        # The background command running, if any, and its reply
+        self.worker = None
+        self.worker_reply = None
+        self.done_read = self.done_write = None
+
+    def run(self):
+        """
+        Play songs until they run out, or the quit command is given. Raises
+        socket.error (with errno EADDRINUSE) if another controller is
+        listening on the control socket.
+        """
+        if self.socket_file is not None:
+            self._listen()
+        wakeup_read, wakeup_write = os.pipe()
+        _set_nonblocking(wakeup_read)
+        _set_nonblocking(wakeup_write)
+        # Signals (SIGCHLD in particular) write a byte to the pipe, which
+        # wakes up select().
+        old_wakeup = signal.set_wakeup_fd(wakeup_write)
+        old_sigchld = signal.signal(signal.SIGCHLD, lambda *args: None)
+        self.loop.add_reader(wakeup_read,
+                             lambda: self._drain(wakeup_read))
+        # Background commands write a byte to this pipe once they finish.
+        self.done_read, self.done_write = os.pipe()
+        _set_nonblocking(self.done_read)
+        self.loop.add_reader(self.done_read, self._background_done)
+        if self.use_stdin:
+            self.loop.add_reader(sys.stdin.fileno(), self._read_stdin)
+        try:
+            self.loop.running = True
+            self._play_next()
+            while self.loop.running:
+                try:
+                    self.loop.run_once()
+                except KeyboardInterrupt:
+                    self._interrupted()
+        finally:
+            self._stop_song()
+            if self.worker is not None:
+                # Let it finish, rather than leaving (say) an index half
+                # updated.
+                sys.stderr.write("Waiting for %s to finish...\n" %
+                                 self.worker.name)
+                self.worker.join()
+            os.close(self.done_read)
+            os.close(self.done_write)
+            signal.signal(signal.SIGCHLD, old_sigchld)
+            signal.set_wakeup_fd(old_wakeup)
+            os.close(wakeup_read)
+            os.close(wakeup_write)
+            if self.server is not None:
+                self.server.close()
+                try:
+                    os.unlink(self.socket_file)
+                except OSError:
+                    pass
+            self.devnull.close()
+
+    def _drain(self, fd):
+        try:
+            while os.read(fd, 512):
+                pass
+        except OSError, err:
+            if err.errno != errno.EAGAIN:
+                raise
+        if self.proc is not None and self.proc.poll() is not None:
+            self._song_finished()
+
+    def _interrupted(self):
+        """
+        Skip the current song on ctrl+c, or quit if pressed twice in quick
+        succession.
+        """
+        now = time.time()
+        if now - self.last_interrupt < QUIT_INTERVAL:
+            sys.stderr.write("\nExiting...\n")
+            self.loop.stop()
+        else:
+            self.skip()
+        self.last_interrupt = now
+
+    def _play_next(self):
+        """
+        Start the next song, or stop the loop if there are none left.
+        """
+        if self.queued:
+            track = self.queued.popleft()
+        else:
+            track = next(self.tracks, None)
+        if track is None:
+            self.current = None
+            self.loop.stop()
+            return
+        self.current = track
+        self.paused = False
+        self.out.write("%s\n" % track.song)
+        self.out.flush()
+        # In its own process group, so ctrl+c only reaches us
+        self.proc = subprocess.Popen(self.argv + [track.path],
+                                     stdin=self.devnull, stdout=self.devnull,
+                                     stderr=self.devnull,
+                                     preexec_fn=os.setpgrp)
+        upcoming = [queued.path for queued in self.queued] + track.upcoming
+        if upcoming:
+            self.loop.call_later(HINT_DELAY, lambda: self._hint(upcoming))
+
+    def _hint(self, paths):
+        for path in paths:
+            readahead_hint(path)
+
+    def _song_finished(self):
+        self.proc.wait()
+        self.proc = None
+        if self.skipping:
+            self.skipping = False
+            if self.on_skip is not None:
+                self.on_skip(self.current)
+        if self.loop.running:
+            self._play_next()
+
+    def _signal_song(self, signum):
+        try:
+            os.killpg(self.proc.pid, signum)
+        except OSError:
+            pass
+
+    def _stop_song(self):
+        if self.proc is None:
+            return
+        if self.paused:
+            self._signal_song(signal.SIGCONT)
+        self._signal_song(signal.SIGTERM)
+        self.proc.wait()
+        self.proc = None
+
+    def skip(self):
+        """
+        Stop the current song; the next one starts once it has exited.
+        """
+        if self.proc is None:
+            return
+        self.skipping = True
+        if self.paused:
+            self._signal_song(signal.SIGCONT)
+        self._signal_song(signal.SIGTERM)
+
+    def pause(self):
+        """
+        Pause the current song, or resume it if paused.
+        """
+        if self.proc is None:
+            return
+        self._signal_song(signal.SIGCONT if self.paused else signal.SIGSTOP)
+        self.paused = not self.paused
+
+    def queue(self, args):
+        """
+        Queue a song, or the songs matching search terms, to play next,
+        returning how many were queued.
+
+        :param args: path to a song, or search terms
+        :type args: list[str]
+        """
+        path = " ".join(args)
+        if os.path.isfile(path):
+            songs = [path]
+        elif self.find is not None and args:
+            songs = self.find(args)
+        else:
+            songs = []
+        for song in songs:
+            self.queued.append(Track(None, song, song, []))
+        return len(songs)
+
+    def command(self, line):
+        """
+        Carry out a command, returning the reply.
+
+        :param line: the command and its arguments
+        :type line: str
+        """
+        args = line.split()
+        if not args:
+            return ""
+        name, args = args[0].lower(), args[1:]
+        if name in ("skip", "s", "next", "n"):
+            self.skip()
+            return "ok"
+        if name in ("pause", "p"):
+            self.pause()
+            return "paused" if self.paused else "playing"
+        if name in ("queue", "q"):
+            return "queued %d" % self.queue(args)
+        if name in ("quit", "exit", "x"):
+            self.loop.stop()
+            return "ok"
+        if name in self.commands:
+            return self.commands[name](args)
+        if name in self.background_commands:
+            return self._start_background(name, args)
+        return "unknown command '%s'" % name
+
+    def _start_background(self, name, args):
+        """
+        Start a background command in a worker thread, returning the reply
+        to give straight away. The command's own reply is written out once
+        it finishes (see _background_done()).
+
+        :param name: the command's name
+        :type name: str
+        :param args: the command's arguments
+        :type args: list[str]
+        """
+        if self.worker is not None:
+            return "busy with %s" % self.worker.name
+        func = self.background_commands[name]
+
+        def work():
+            self.worker_reply = None
+            try:
+                self.worker_reply = func(args)
+            finally:
+                os.write(self.done_write, "x")
+
+        self.worker = threading.Thread(target=work, name=name)
+        self.worker.daemon = True
+        self.worker.start()
+        return "started %s" % name
+
+    def _background_done(self):
+        os.read(self.done_read, 512)
+        self.worker.join()
+        name, reply = self.worker.name, self.worker_reply
+        self.worker = None
+        if reply is None:
+            reply = "%s failed" % name
+        self.out.write("%s\n" % reply)
+        self.out.flush()
+
+    def _read_stdin(self):
+        line = sys.stdin.readline()
+        if not line:
+            # End of input; carry on playing without it
+            self.loop.remove_reader(sys.stdin.fileno())
+            return
+        reply = self.command(line)
+        if reply and reply != "ok":
+            self.out.write("%s\n" % reply)
+            self.out.flush()
+
+    def _listen(self):
+        if os.path.exists(self.socket_file):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_file)
+            except socket.error:
+                # Left behind by a controller which did not exit cleanly
+                os.unlink(self.socket_file)
+            else:
+                raise socket.error(errno.EADDRINUSE, "A controller is "
+                                   "already listening on %s" %
+                                   self.socket_file)
+            finally:
+                probe.close()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0177)
+        try:
+            self.server.bind(self.socket_file)
+        finally:
+            os.umask(old_umask)
+        self.server.listen(5)
+        self.loop.add_reader(self.server.fileno(), self._accept)
+
+    def _accept(self):
+        try:
+            conn, _ = self.server.accept()
+        except socket.error:
+            return
+        conn.settimeout(1.0)
+        try:
+            data = ""
+            while "\n" not in data and len(data) < MAX_COMMAND:
+                chunk = conn.recv(MAX_COMMAND)
+                if not chunk:
+                    break
+                data += chunk
+            conn.sendall(self.command(data.split("\n")[0]) + "\n")
+        except socket.error:
+            pass
+        finally:
+            conn.close()
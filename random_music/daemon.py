@@ -0,0 +1,285 @@
+"""Serve a loaded index to music clients over a Unix domain socket.
+
+Starting up involves finding the latest index file, opening it (reading it
+into memory, for text indexes) and opening its trigram index. A long-lived
+daemon does this once and answers each client's requests from memory, so
+clients can start playing straight away.
+
+Messages in both directions are marshalled Python objects (which, unlike
+JSON, can carry song paths which are not valid UTF-8), prefixed by their
+length. The socket is only accessible to its owner. Each client connection
+is handled in its own thread; the loaded index is only ever read, and is
+replaced wholesale when the daemon is asked to reload it. The index it
+replaces is closed once the last request using it has finished.
+
+"""
+
+import os
+import errno
+import random
+import socket
+import struct
+import marshal
+import threading
+from SocketServer import ThreadingMixIn, UnixStreamServer, BaseRequestHandler
+
+from selection import select_songs
+
+LENGTH = struct.Struct("<I")
+# Number of songs fetched from the daemon at a time when iterating an index
+FETCH_SIZE = 1000
+
+
+def send_message(sock, message):
+    """
+    Send a message over a socket.
+
+    :param sock: the socket
+    :type sock: socket.socket
+    :param message: the message (any marshallable object)
+    """
+    data = marshal.dumps(message)
+    sock.sendall(LENGTH.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+
+def recv_message(sock):
+    """
+    Receive a message from a socket. Raises EOFError if the connection is
+    closed.
+
+    :param sock: the socket
+    :type sock: socket.socket
+    """
+    size, = LENGTH.unpack(_recv_exactly(sock, LENGTH.size))
+    return marshal.loads(_recv_exactly(sock, size))
+
+
+class IndexServer(ThreadingMixIn, UnixStreamServer):
+    """
+    Serve an index, and searches against it, to any number of clients.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_file, load_library):
+        """
+        :param socket_file: path of the socket to listen on
+        :type socket_file: str
+        :param load_library: callable returning a library.Library of the
+        latest index
+        :type load_library: callable
+        """
+        self.load_library = load_library
+        self.lock = threading.Lock()
+        # Number of requests in progress using each library
+        self.users = {}
+        self.library = None
+        self.reload()
+        if os.path.exists(socket_file):
+            if connect(socket_file) is not None:
+                raise socket.error(errno.EADDRINUSE, "A daemon is already "
+                                   "listening on %s" % socket_file)
+            # Left behind by a daemon which did not exit cleanly
+            os.unlink(socket_file)
+        old_umask = os.umask(0177)
+        try:
+            UnixStreamServer.__init__(self, socket_file, _IndexRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def reload(self):
+        """
+        Load the latest index, replacing the current one. Requests in
+        progress carry on with whichever index they started with, and the
+        old index is closed once they have finished.
+        """
+        library = self.load_library()
+        with self.lock:
+            old_library, self.library = self.library, library
+            in_use = old_library in self.users
+        if old_library is not None and not in_use:
+            old_library.close()
+
+    def acquire(self):
+        """
+        Return the current library, which stays open until release() is
+        called with it.
+        """
+        with self.lock:
+            library = self.library
+            self.users[library] = self.users.get(library, 0) + 1
+        return library
+
+    def release(self, library):
+        """
+        Finish with a library returned by acquire(), closing it if it has
+        been replaced and nothing else is using it.
+
+        :param library: the library
+        :type library: library.Library
+        """
+        with self.lock:
+            self.users[library] -= 1
+            if self.users[library]:
+                return
+            del self.users[library]
+            if library is self.library:
+                return
+        library.close()
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        self.library.close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+class _IndexRequestHandler(BaseRequestHandler):
+    """
+    Handle requests from a single client until it disconnects.
+    """
+    def handle(self):
+        while True:
+            try:
+                request = recv_message(self.request)
+            except (EOFError, ValueError, socket.error):
+                return
+            try:
+                response = {"ok": True,
+                            "result": self.dispatch(request)}
+            except Exception, err:
+                response = {"ok": False, "error": str(err)}
+            send_message(self.request, response)
+
+    def dispatch(self, request):
+        library = self.server.acquire()
+        try:
+            return self._dispatch(request, library)
+        finally:
+            self.server.release(library)
+
+    def _dispatch(self, request, library):
+        command = request.get("command")
+        if command == "info":
+            return {"index_file": library.index_file, "count": len(library)}
+        if command == "get":
+            return library[request["n"]]
+        if command == "range":
+            return library[request["start"]:request["stop"]]
+        if command == "search":
+            matches = (library[n] for n in
+                       library.iter_search(request["search_terms"]))
+            seed = request.get("seed")
+            rng = random.Random(seed) if seed is not None else random
+            return list(select_songs(matches, request.get("num_songs"),
+                                     request.get("randomise", False), rng))
+        if command == "reload":
+            self.server.reload()
+            return self.server.library.index_file
+        raise ValueError("Unknown command '%s'" % command)
+
+
+class DaemonClient(object):
+    """
+    A connection to a running index daemon.
+    """
+    def __init__(self, sock):
+        """
+        :param sock: socket connected to the daemon
+        :type sock: socket.socket
+        """
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def request(self, command, **kwargs):
+        """
+        Send a request to the daemon and return its result. Errors reported
+        by the daemon are raised as RuntimeErrors.
+
+        :param command: the command to send
+        :type command: str
+        """
+        kwargs["command"] = command
+        with self.lock:
+            send_message(self.sock, kwargs)
+            response = recv_message(self.sock)
+        if not response["ok"]:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def info(self):
+        return self.request("info")
+
+    def reload(self):
+        return self.request("reload")
+
+    def search(self, search_terms, num_songs=None, randomise=False,
+               seed=None):
+        return self.request("search", search_terms=list(search_terms),
+                            num_songs=num_songs, randomise=randomise,
+                            seed=seed)
+
+    def close(self):
+        self.sock.close()
+
+
+class RemoteIndex(object):
+    """
+    A read-only sequence of the songs in the daemon's index.
+    """
+    def __init__(self, client):
+        """
+        :param client: connection to the daemon
+        :type client: DaemonClient
+        """
+        self.client = client
+        info = client.info()
+        self.path = info["index_file"]
+        self._count = info["count"]
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            start, stop, step = n.indices(self._count)
+            songs = self.client.request("range", start=start, stop=stop)
+            return songs[::step]
+        return self.client.request("get", n=n)
+
+    def __iter__(self):
+        for start in xrange(0, self._count, FETCH_SIZE):
+            for song in self[start:start + FETCH_SIZE]:
+                yield song
+
+    def close(self):
+        pass
+
+
+def connect(socket_file):
+    """
+    Connect to the daemon listening on socket_file, returning None if it is
+    not running.
+
+    :param socket_file: path of the daemon's socket
+    :type socket_file: str
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_file)
+    except socket.error:
+        sock.close()
+        return None
+    return DaemonClient(sock)
@@ -0,0 +1,246 @@
+"""Find songs which are copies of each other, so each is indexed once.
+
+Comparing every file's contents would mean reading the whole library, so
+candidates are narrowed down in stages:
+
+1. Files are grouped by size (known from the tag cache without reading
+   anything). Only files sharing a size can be copies.
+2. Within those groups, a hash of each file's first and last SAMPLE_SIZE
+   bytes is taken, in a pool of worker processes.
+3. Files whose samples match are hashed in full to confirm they are copies.
+   (For files no bigger than two samples, the sample is the whole file.)
+
+Hashes are cached by each file's size and mtime, so an update only reads
+files which are new or have changed. Empty files are never counted as
+copies of each other.
+
+Of each set of copies, the first in index order is kept in the index, and
+the others are recorded as its alternates in a .dups file next to it.
+
+"""
+
+from __future__ import with_statement
+import os
+import marshal
+import hashlib
+from itertools import imap
+from multiprocessing import Pool
+
+from tags import CHUNK_SIZE, DEFAULT_TAG_WORKERS
+
+HASH_CACHE_FILE = "hash_cache.marshal"
+DUPLICATES_EXT = ".dups"
+SAMPLE_SIZE = 64 * 1024
+READ_SIZE = 1 << 20
+
+
+def duplicates_file(index_file):
+    """
+    Return the path to the alternates file for an index file.
+
+    :param index_file: path to the index file
+    :type index_file: str
+    """
+    return index_file + DUPLICATES_EXT
+
+
+def _sample_hash(path, size):
+    """
+    Hash the start and end of a file.
+    """
+    digest = hashlib.md5()
+    with open(path, "rb") as fh:
+        digest.update(fh.read(SAMPLE_SIZE))
+        if size > SAMPLE_SIZE:
+            fh.seek(max(SAMPLE_SIZE, size - SAMPLE_SIZE))
+            digest.update(fh.read(SAMPLE_SIZE))
+    return digest.digest()
+
+
+def _full_hash(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as fh:
+        for data in iter(lambda: fh.read(READ_SIZE), ""):
+            digest.update(data)
+    return digest.digest()
+
+
+def _hash(job):
+    """
+    Hash a file in a worker process, returning (path, hash), or (path,
+    None) if the file cannot be read.
+
+    :param job: (path, size, whether to hash the whole file)
+    :type job: tuple
+    """
+    path, size, full = job
+    try:
+        if full:
+            return path, _full_hash(path)
+        return path, _sample_hash(path, size)
+    except IOError:
+        return path, None
+
+
+class HashCache(object):
+    """
+    Files' sample and full hashes, keyed by path.
+    """
+    def __init__(self, entries=None):
+        """
+        :param entries: mapping of path to a [size, mtime, sample hash, full
+        hash] list, where either hash may be None if not yet taken
+        :type entries: dict
+        """
+        self.entries = entries if entries is not None else {}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a previously saved cache, returning an empty cache if there is
+        none (or it cannot be read).
+
+        :param path: path to the saved cache
+        :type path: str
+        """
+        try:
+            with open(path, "rb") as fh:
+                return cls(marshal.load(fh))
+        except (IOError, EOFError, ValueError, TypeError):
+            return cls()
+
+    def save(self, path):
+        """
+        Save the cache, replacing any existing cache atomically.
+
+        :param path: path to save the cache to
+        :type path: str
+        """
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "wb") as fh:
+            marshal.dump(self.entries, fh)
+        os.rename(tmp_path, path)
+
+
+def _hash_files(files, field, cache, new_cache, pool):
+    """
+    Fill in the sample (field 2) or full (field 3) hash of each (path, size,
+    mtime) in files, in new_cache, reusing cached hashes of files which have
+    not changed. Returns a dict of path to hash for those files which could
+    be read.
+    """
+    hashes = {}
+    jobs = []
+    for path, size, mtime in files:
+        entry = new_cache.entries.get(path)
+        if entry is None:
+            entry = cache.entries.get(path)
+            if entry is None or entry[:2] != [size, mtime]:
+                entry = [size, mtime, None, None]
+            new_cache.entries[path] = entry
+        if entry[field] is None:
+            jobs.append((path, size, field == 3))
+        else:
+            hashes[path] = entry[field]
+    if pool is not None:
+        results = pool.imap(_hash, jobs, CHUNK_SIZE)
+    else:
+        results = imap(_hash, jobs)
+    for path, digest in results:
+        if digest is not None:
+            new_cache.entries[path][field] = digest
+            hashes[path] = digest
+    return hashes
+
+
+def _group(files, key):
+    """
+    Group (path, size, mtime) tuples by key (skipping those whose key is
+    None), returning the groups with more than one member.
+    """
+    groups = {}
+    for f in files:
+        k = key(f)
+        if k is not None:
+            groups.setdefault(k, []).append(f)
+    return [group for group in groups.itervalues() if len(group) > 1]
+
+
+def find_duplicates(files, cache, new_cache, workers=DEFAULT_TAG_WORKERS):
+    """
+    Find files which are copies of earlier files, returning a dict mapping
+    each copy's path to the path of the first file (in the order given) it
+    is a copy of. The hashes taken are recorded in new_cache.
+
+    :param files: (path, size, mtime) of each file, in index order
+    :type files: list[tuple]
+    :param cache: the cache from the previous update
+    :type cache: HashCache
+    :param new_cache: the cache being built
+    :type new_cache: HashCache
+    :param workers: number of worker processes
+    :type workers: int
+    """
+    order = dict((f[0], n) for n, f in enumerate(files))
+    candidates = [f for group in _group(files,
+                                        lambda f: f[1] if f[1] else None)
+                  for f in group]
+    if not candidates:
+        return {}
+    pool = Pool(workers) if workers > 1 and len(candidates) > 1 else None
+    try:
+        samples = _hash_files(candidates, 2, cache, new_cache, pool)
+        groups = _group(candidates, lambda f: (f[1], samples[f[0]])
+                        if f[0] in samples else None)
+        # A sample covering the whole file is as good as a full hash
+        confirmed = [group for group in groups
+                     if group[0][1] <= 2 * SAMPLE_SIZE]
+        to_confirm = [f for group in groups if group[0][1] > 2 * SAMPLE_SIZE
+                      for f in group]
+        if to_confirm:
+            full = _hash_files(to_confirm, 3, cache, new_cache, pool)
+            confirmed.extend(_group(to_confirm, lambda f: (f[1], full[f[0]])
+                                    if f[0] in full else None))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    duplicates = {}
+    for group in confirmed:
+        paths = sorted((f[0] for f in group), key=order.__getitem__)
+        for path in paths[1:]:
+            duplicates[path] = paths[0]
+    return duplicates
+
+
+def write_duplicates(path, alternates):
+    """
+    Write the alternates file for an index.
+
+    :param path: path to the alternates file
+    :type path: str
+    :param alternates: mapping of each indexed song with copies to a list of
+    the copies' paths
+    :type alternates: dict
+    """
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "wb") as fh:
+        marshal.dump(alternates, fh)
+    os.rename(tmp_path, path)
+
+
+def load_duplicates(index_file):
+    """
+    Return the alternates recorded for an index file, as a mapping of each
+    indexed song with copies to a list of the copies' paths (empty if no
+    copies were recorded).
+
+    :param index_file: path to the index file
+    :type index_file: str
+    """
+    try:
+        with open(duplicates_file(index_file), "rb") as fh:
+            return marshal.load(fh)
+    except (IOError, EOFError, ValueError, TypeError):
+        return {}
@@ -0,0 +1,109 @@
+"""Write playlists out in common playlist formats.
+
+m3u
+    One path per line.
+extm3u
+    Extended M3U, with an #EXTINF line (unknown duration, and the file name
+    as the title) before each path.
+pls
+    PLS, as understood by most players.
+jsonl
+    One JSON object per line, with "path" and "title" keys (paths are
+    assumed to be UTF-8).
+
+Playlists are streamed straight to the output file, so nothing but the
+current song is held in memory.
+
+"""
+
+import os
+import sys
+import json
+
+M3U_FORMAT = "m3u"
+EXTM3U_FORMAT = "extm3u"
+PLS_FORMAT = "pls"
+JSONL_FORMAT = "jsonl"
+
+# Size of the output buffer
+BUFFER_SIZE = 1 << 16
+
+
+def song_title(song):
+    """
+    Return a title for a song, from its file name.
+
+    :param song: path to the song
+    :type song: str
+    """
+    return os.path.splitext(os.path.basename(song))[0]
+
+
+def _write_m3u(songs, fh):
+    count = 0
+    for song in songs:
+        fh.write("%s\n" % song)
+        count += 1
+    return count
+
+
+def _write_extm3u(songs, fh):
+    fh.write("#EXTM3U\n")
+    count = 0
+    for song in songs:
+        fh.write("#EXTINF:-1,%s\n%s\n" % (song_title(song), song))
+        count += 1
+    return count
+
+
+def _write_pls(songs, fh):
+    fh.write("[playlist]\n")
+    count = 0
+    for count, song in enumerate(songs, 1):
+        fh.write("File%d=%s\nTitle%d=%s\n" % (count, song, count,
+                                              song_title(song)))
+    fh.write("NumberOfEntries=%d\nVersion=2\n" % count)
+    return count
+
+
+def _write_jsonl(songs, fh):
+    # JSON strings are unicode, so paths which are not valid UTF-8 cannot be
+    # represented exactly; undecodable bytes are replaced.
+    count = 0
+    for song in songs:
+        fh.write(json.dumps({"path": song.decode("utf-8", "replace"),
+                             "title": song_title(song).decode("utf-8",
+                                                              "replace")}))
+        fh.write("\n")
+        count += 1
+    return count
+
+
+EXPORT_FORMATS = {
+    M3U_FORMAT: _write_m3u,
+    EXTM3U_FORMAT: _write_extm3u,
+    PLS_FORMAT: _write_pls,
+    JSONL_FORMAT: _write_jsonl,
+}
+
+
+def export_playlist(songs, output, fmt=M3U_FORMAT):
+    """
+    Write songs to output in the given format, returning the number of songs
+    written. If output is None, the playlist is written to stdout.
+
+    :param songs: song paths, in playlist order
+    :type songs: iterable
+    :param output: path to write the playlist to, or None
+    :type output: str
+    :param fmt: one of EXPORT_FORMATS
+    :type fmt: str
+    """
+    writer = EXPORT_FORMATS[fmt]
+    if output is None:
+        sys.stdout.flush()
+        fh = os.fdopen(os.dup(sys.stdout.fileno()), "wb", BUFFER_SIZE)
+    else:
+        fh = open(output, "wb", BUFFER_SIZE)
+    with fh:
+        return writer(songs, fh)
@@ -0,0 +1,248 @@
+"""Log of played and skipped songs, used to avoid repeating songs.
+
+The log is an append-only file of fixed-size binary records, each holding a
+timestamp, the kind of event and a 64-bit hash of the song's path. Records
+are buffered and written (and fsync()ed) in batches. Since records are
+fixed-size and appended in time order, the most recent ones can be read
+straight from the end of the file, without reading the whole log; when the
+log grows too large, it is compacted down to its most recent records.
+
+Recently played songs are kept in a RecentWindow: a ring buffer of the last
+plays, along with a count of each song in it, so checking whether a song was
+played recently takes constant time.
+
+"""
+
+import os
+import time
+import struct
+import hashlib
+from collections import deque
+
+HISTORY_FILE = "history.log"
+
+HISTORY_MAGIC = "RMHIST01"
+# timestamp, song hash, event
+RECORD = struct.Struct("<dQB")
+
+PLAY_EVENT = 1
+SKIP_EVENT = 2
+
+# Number of records buffered before they are written and synced
+SYNC_BATCH = 16
+# When the log holds more records than this, it is compacted ...
+MAX_RECORDS = 1000000
+# ... down to this many
+COMPACTED_RECORDS = 100000
+# Default size of the window of recent plays which aren't repeated
+DEFAULT_NO_REPEAT_TRACKS = 20
+# Number of times a song from the window is put back and another picked,
+# before giving up (e.g. when the window holds most of the playlist)
+MAX_REPICKS = 10
+
+
+def song_key(song):
+    """
+    Return the 64-bit hash by which a song is identified in the log.
+
+    :param song: path to the song
+    :type song: str
+    """
+    return struct.unpack("<Q", hashlib.md5(song).digest()[:8])[0]
+
+
+class HistoryLog(object):
+    """
+    An append-only log of song plays and skips.
+    """
+    def __init__(self, path, sync_batch=SYNC_BATCH):
+        """
+        :param path: path of the log file
+        :type path: str
+        :param sync_batch: number of records to buffer before writing
+        :type sync_batch: int
+        """
+        self.path = path
+        self.sync_batch = sync_batch
+        self.buffer = []
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "wb") as fh:
+                fh.write(HISTORY_MAGIC)
+        elif self._count() > MAX_RECORDS:
+            self.compact(COMPACTED_RECORDS)
+        self.fh = open(path, "ab")
+
+    def _count(self):
+        """
+        Return the number of complete records in the file.
+        """
+        size = os.path.getsize(self.path) - len(HISTORY_MAGIC)
+        return max(size, 0) // RECORD.size
+
+    def append(self, event, song, when=None):
+        """
+        Add a record to the log.
+
+        :param event: PLAY_EVENT or SKIP_EVENT
+        :type event: int
+        :param song: path to the song
+        :type song: str
+        :param when: time of the event (defaults to now)
+        :type when: float
+        """
+        if when is None:
+            when = time.time()
+        self.buffer.append(RECORD.pack(when, song_key(song), event))
+        if len(self.buffer) >= self.sync_batch:
+            self.flush()
+
+    def flush(self):
+        """
+        Write out and sync any buffered records.
+        """
+        if not self.buffer:
+            return
+        self.fh.write("".join(self.buffer))
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+
+    def recent(self, max_records=0, max_age=0, now=None):
+        """
+        Return the most recent records, as (timestamp, song hash, event)
+        tuples in time order: at least the last max_records records, and at
+        least every record from the last max_age seconds. Only the end of the
+        file is read.
+
+        :param max_records: number of records wanted
+        :type max_records: int
+        :param max_age: age in seconds of the oldest record wanted
+        :type max_age: float
+        """
+        self.flush()
+        count = self._count()
+        start = max(count - max_records, 0) if max_records else count
+        with open(self.path, "rb") as fh:
+            if max_age:
+                if now is None:
+                    now = time.time()
+                start = min(start, self._find_time(fh, count, now - max_age))
+            fh.seek(len(HISTORY_MAGIC) + RECORD.size * start)
+            data = fh.read(RECORD.size * (count - start))
+        return [RECORD.unpack_from(data, offset)
+                for offset in xrange(0, len(data) - RECORD.size + 1,
+                                     RECORD.size)]
+
+    def _find_time(self, fh, count, since):
+        """
+        Binary search for the first record at or after since.
+        """
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            fh.seek(len(HISTORY_MAGIC) + RECORD.size * mid)
+            if RECORD.unpack(fh.read(RECORD.size))[0] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def compact(self, keep):
+        """
+        Rewrite the log, keeping only its most recent records.
+
+        :param keep: number of records to keep
+        :type keep: int
+        """
+        records = self.recent(keep) if keep else []
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "wb") as fh:
+            fh.write(HISTORY_MAGIC)
+            for record in records:
+                fh.write(RECORD.pack(*record))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp_path, self.path)
+
+
+class RecentWindow(object):
+    """
+    Songs played within the last max_tracks plays, or the last max_age
+    seconds.
+    """
+    def __init__(self, max_tracks=0, max_age=0):
+        """
+        :param max_tracks: number of plays to remember
+        :type max_tracks: int
+        :param max_age: age in seconds of the oldest play to remember
+        :type max_age: float
+        """
+        self.max_tracks = max_tracks
+        self.max_age = max_age
+        self.plays = deque()
+        self.counts = {}
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def __len__(self):
+        return len(self.plays)
+
+    def add(self, key, when=None):
+        """
+        Record a play.
+
+        :param key: the song's hash, from song_key()
+        :type key: int
+        :param when: time of the play (defaults to now)
+        :type when: float
+        """
+        if when is None:
+            when = time.time()
+        self.plays.append((when, key))
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.expire(when)
+
+    def _drop_oldest(self):
+        _, key = self.plays.popleft()
+        self.counts[key] -= 1
+        if not self.counts[key]:
+            del self.counts[key]
+
+    def expire(self, now=None):
+        """
+        Forget plays which have fallen out of the window.
+        """
+        if now is None:
+            now = time.time()
+        while self.plays:
+            too_many = len(self.plays) > self.max_tracks
+            too_old = (not self.max_age or
+                       self.plays[0][0] < now - self.max_age)
+            if too_many and too_old:
+                self._drop_oldest()
+            else:
+                break
+
+    @classmethod
+    def from_log(cls, log, max_tracks=0, max_age=0, now=None):
+        """
+        Build a window from the most recent plays in a history log.
+
+        :param log: the history log
+        :type log: HistoryLog
+        """
+        window = cls(max_tracks, max_age)
+        if now is None:
+            now = time.time()
+        # Only plays count, and skips are interleaved with them, so read
+        # enough records to find max_tracks plays in the common case.
+        for when, key, event in log.recent(2 * max_tracks, max_age, now):
+            if event == PLAY_EVENT:
+                window.add(key, when)
+        window.expire(now)
+        return window
@@ -0,0 +1,777 @@
+"""Read and write song index files.
+
+Two formats are supported:
+
+text
+    One path per line. Simple to read and grep, but the whole file has to
+    be read into memory before a song can be picked from it.
+
+binary
+    A header, followed by every path packed into a single blob, followed by
+    a table of offsets into the blob. The file is mmap()ed, so fetching the
+    Nth path means reading two offsets and one slice of the blob, and only
+    the pages actually touched are ever read from disk.
+
+sqlite
+    A SQLite database, with a full-text table used to search it (see the
+    sqlite_index module).
+
+Songs' tags (artist, album, title and duration) may be stored alongside
+them: in columns of the songs table for SQLite indexes, and otherwise in a
+.tags file next to the index, holding one encoded record per song in the
+binary format. Each song's search key (see query.search_key), which is what
+searches compare, is stored the same way: in a column, or in a .keys file.
+Searches of indexes written before search keys were stored work the keys
+out as they go, and don't use the index's trigram index or full-text table,
+which were built from the songs' unnormalized text.
+
+An update writes one index file (a shard) per music directory, and a
+manifest (MANIFEST_FILE) listing the current shards, in order. Shards are
+written in full before the manifest naming them is renamed into place, so
+readers only ever see complete shards, and a root which hasn't changed
+keeps its shard from the last update. Opening the manifest gives a
+ShardedIndex, which reads as one index. Index files no longer named by the
+manifest, or the one it replaced, are removed.
+
+"""
+
+import os
+import glob
+import json
+import mmap
+import errno
+import struct
+import hashlib
+from array import array
+from bisect import bisect_right
+from itertools import izip, repeat
+from collections import namedtuple
+
+from query import search_key, search_text
+from sqlite_index import SQLiteIndex, write_sqlite_index
+from songtable import SongTable
+from trigrams import open_trigram_index
+
+TEXT_FORMAT = "text"
+BINARY_FORMAT = "binary"
+SQLITE_FORMAT = "sqlite"
+INDEX_FORMATS = {TEXT_FORMAT: ".txt", BINARY_FORMAT: ".idx",
+                 SQLITE_FORMAT: ".db"}
+
+# magic, number of songs, position of the offset table
+BINARY_HEADER = struct.Struct("<8sQQ")
+BINARY_MAGIC = "RMIDX001"
+OFFSET = struct.Struct("<Q")
+OFFSET_PAIR = struct.Struct("<QQ")
+OFFSET_CHUNK = 4096
+
+TAGS_EXT = ".tags"
+KEYS_EXT = ".keys"
+INDEX_PREFIX = "music_index_"
+MANIFEST_FILE = "index.shards"
+MANIFEST_EXT = ".shards"
+# Changed whenever what is stored in a shard changes, so that older shards
+# are rewritten by the next update
+SHARD_VERSION = "2"
+# Tag strings are UTF-8; duration is in whole seconds (0 if unknown)
+Tags = namedtuple("Tags", "artist album title duration")
+NO_TAGS = Tags("", "", "", 0)
+
+
+def index_format(path):
+    """
+    Return the format of an index file, based on its extension.
+
+    :param path: path to the index file
+    :type path: str
+    """
+    ext = os.path.splitext(path)[1]
+    for fmt, fmt_ext in INDEX_FORMATS.items():
+        if ext == fmt_ext:
+            return fmt
+    raise ValueError("Unknown index format for '%s'" % path)
+
+
+def index_files_of_format(index_dir, fmt):
+    """
+    Return the index files of a format, oldest first.
+
+    :param index_dir: directory holding the index files
+    :type index_dir: str
+    :param fmt: one of INDEX_FORMATS
+    :type fmt: str
+    """
+    entries = sorted((os.stat(index_file).st_mtime, index_file)
+                     for index_file in glob.glob(os.path.join(
+                         index_dir, "*" + INDEX_FORMATS[fmt])))
+    return [index_file for mtime, index_file in entries]
+
+
+def latest_index_file(index_dir, fmt):
+    """
+    Return the most recently written index file of a format, or None if
+    there is none.
+
+    :param index_dir: directory holding the index files
+    :type index_dir: str
+    :param fmt: one of INDEX_FORMATS
+    :type fmt: str
+    """
+    files = index_files_of_format(index_dir, fmt)
+    if not files:
+        return None
+    return files[-1]
+
+
+def current_index_file(index_dir, fmt):
+    """
+    Return the index's manifest, or for an index directory last updated
+    before indexes were sharded, the most recently written index file of a
+    format. Returns None if there is neither.
+
+    :param index_dir: directory holding the index files
+    :type index_dir: str
+    :param fmt: one of INDEX_FORMATS
+    :type fmt: str
+    """
+    path = os.path.join(index_dir, MANIFEST_FILE)
+    if os.path.isfile(path):
+        return path
+    return latest_index_file(index_dir, fmt)
+
+
+def shard_file(index_dir, generation, root, fmt):
+    """
+    Return the path of a new shard.
+
+    :param index_dir: directory holding the index files
+    :type index_dir: str
+    :param generation: name of the update writing the shard (e.g. its start
+    time)
+    :type generation: str
+    :param root: the music directory indexed by the shard
+    :type root: str
+    :param fmt: one of INDEX_FORMATS
+    :type fmt: str
+    """
+    return os.path.join(index_dir, "%s%s_%s%s" % (
+        INDEX_PREFIX, generation, hashlib.md5(root).hexdigest()[:8],
+        INDEX_FORMATS[fmt]))
+
+
+def read_manifest(path):
+    """
+    Read a manifest, returning a dict with the format of its shards
+    ("format") and a list of the shards ("shards"), each a dict giving the
+    root it indexes ("root"), its file name relative to the manifest
+    ("file"), its number of songs ("songs") and a digest of its contents
+    ("digest"). Returns None if the manifest cannot be read.
+
+    :param path: path to the manifest
+    :type path: str
+    """
+    try:
+        with open(path) as fh:
+            manifest = json.load(fh)
+    except (IOError, ValueError):
+        return None
+    for shard in manifest["shards"]:
+        for key in ("root", "file"):
+            shard[key] = shard[key].encode("utf-8")
+    return manifest
+
+
+def write_manifest(path, fmt, shards):
+    """
+    Write a manifest, replacing any existing manifest atomically.
+
+    :param path: path to the manifest
+    :type path: str
+    :param fmt: format of the shards, one of INDEX_FORMATS
+    :type fmt: str
+    :param shards: the shards, as described in read_manifest()
+    :type shards: list[dict]
+    """
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "w") as fh:
+        json.dump({"format": fmt, "shards": shards}, fh, indent=1,
+                  sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def index_files(index_file):
+    """
+    Return the paths of the index files making up an index: the shards
+    named by a manifest, or just the index file itself.
+
+    :param index_file: path to the index file or manifest
+    :type index_file: str
+    """
+    if not index_file.endswith(MANIFEST_EXT):
+        return [index_file]
+    manifest = read_manifest(index_file)
+    if manifest is None:
+        raise IOError("Cannot read index manifest '%s'" % index_file)
+    index_dir = os.path.dirname(index_file)
+    return [os.path.join(index_dir, shard["file"])
+            for shard in manifest["shards"]]
+
+
+def shard_digest(songs, tags, alternates):
+    """
+    Return a digest of a shard's contents, by which an update can tell
+    whether a shard needs rewriting.
+
+    :param songs: song paths in the shard
+    :type songs: list[str]
+    :param tags: tags for each song
+    :type tags: list[Tags]
+    :param alternates: mapping of songs in the shard to their copies left
+    out of the index (see the duplicates module)
+    :type alternates: dict
+    """
+    digest = hashlib.md5(SHARD_VERSION + "\n")
+    for song, song_tags in izip(songs, tags):
+        digest.update("%s\0%s\n" % (song, _encode_tags(song_tags)))
+    digest.update("\n")
+    for song in sorted(alternates):
+        digest.update("%s\0%s\n" % (song, "\0".join(alternates[song])))
+    return digest.hexdigest()
+
+
+def remove_old_index_files(index_dir, keep):
+    """
+    Remove index files, and the files kept alongside them, other than those
+    of the given index files. Returns the number of files removed.
+
+    :param index_dir: directory holding the index files
+    :type index_dir: str
+    :param keep: names of the index files to keep
+    :type keep: iterable
+    """
+    # Shard names hold no dots, so everything up to the first dot
+    # identifies the index file a .tags, trigram or .dups file belongs to
+    keep = set(name.split(".", 1)[0] for name in keep)
+    removed = 0
+    for name in os.listdir(index_dir):
+        if (not name.startswith(INDEX_PREFIX) or
+                name.split(".", 1)[0] in keep):
+            continue
+        try:
+            os.unlink(os.path.join(index_dir, name))
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+        else:
+            removed += 1
+    return removed
+
+
+def open_index(path):
+    """
+    Open an index file or manifest, returning a read-only sequence of song
+    paths.
+
+    :param path: path to the index file or manifest
+    :type path: str
+    """
+    if path.endswith(MANIFEST_EXT):
+        return ShardedIndex(path)
+    fmt = index_format(path)
+    if fmt == BINARY_FORMAT:
+        return BinaryIndex(path)
+    if fmt == SQLITE_FORMAT:
+        return SQLiteIndex(path)
+    return TextIndex(path)
+
+
+def has_full_text(index):
+    """
+    Return whether an index can search itself, without a trigram index.
+
+    :param index: the song index
+    :type index: TextIndex, BinaryIndex or SQLiteIndex
+    """
+    return (isinstance(index, SQLiteIndex) and index.has_fts and
+            index.has_keys)
+
+
+def has_search_keys(index):
+    """
+    Return whether an index has its songs' search keys stored with it.
+
+    :param index: the song index
+    :type index: TextIndex, BinaryIndex or SQLiteIndex
+    """
+    if isinstance(index, SQLiteIndex):
+        return index.has_keys
+    return os.path.isfile(keys_file(index.path))
+
+
+def open_search_index(index):
+    """
+    Open whatever is used to narrow down searches of an index: its
+    full-text table, for SQLite indexes which have one, or its trigram index
+    otherwise. Returns None if there is neither, or the index has no search
+    keys.
+
+    :param index: the song index
+    :type index: TextIndex, BinaryIndex, SQLiteIndex or ShardedIndex
+    """
+    if isinstance(index, ShardedIndex):
+        search_indexes = []
+        for shard in index.parts:
+            search_index = open_search_index(shard)
+            if search_index is None:
+                for search_index in search_indexes:
+                    search_index.close()
+                return None
+            search_indexes.append(search_index)
+        return ShardedSearchIndex(search_indexes, index.offsets)
+    if not has_search_keys(index):
+        return None
+    if has_full_text(index):
+        return index.full_text()
+    return open_trigram_index(index.path)
+
+
+def tags_file(index_file):
+    """
+    Return the path of the tags file for an index file.
+
+    :param index_file: path to the song index
+    :type index_file: str
+    """
+    return os.path.splitext(index_file)[0] + TAGS_EXT
+
+
+def keys_file(index_file):
+    """
+    Return the path of the search keys file for an index file.
+
+    :param index_file: path to the song index
+    :type index_file: str
+    """
+    return os.path.splitext(index_file)[0] + KEYS_EXT
+
+
+def write_index(path, songs, tags=None, fmt=None):
+    """
+    Write an index file, in the format given by its extension, along with
+    its songs' search keys. The file is written under a temporary name and
+    renamed into place, so readers never see a partially written index.
+
+    :param path: path to the index file
+    :type path: str
+    :param songs: song paths to write
+    :type songs: iterable
+    :param tags: tags for each song, to be stored with the index (optional)
+    :type tags: iterable of Tags
+    :param fmt: one of INDEX_FORMATS (defaults to the format given by the
+    extension)
+    :type fmt: str
+    """
+    if fmt is None:
+        fmt = index_format(path)
+    if fmt != SQLITE_FORMAT:
+        songs = list(songs)
+        if tags is not None:
+            tags = list(tags)
+            _write_file(tags_file(path), (_encode_tags(t) for t in tags),
+                        BINARY_FORMAT)
+        _write_file(keys_file(path),
+                    (search_key(search_text(song, song_tags))
+                     for song, song_tags in izip(
+                         songs, tags if tags is not None else repeat(None))),
+                    BINARY_FORMAT)
+        tags = None
+    _write_file(path, songs, fmt, tags)
+
+
+def _write_file(path, songs, fmt, tags=None):
+    """
+    Write a single index file under a temporary name, and rename it into
+    place.
+    """
+    tmp_path = "%s.tmp" % path
+    if fmt == SQLITE_FORMAT:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        write_sqlite_index(tmp_path, songs, tags)
+    else:
+        with open(tmp_path, "wb") as fh:
+            if fmt == BINARY_FORMAT:
+                _write_binary(fh, songs)
+            else:
+                export_text(songs, fh)
+    os.rename(tmp_path, path)
+
+
+def _encode_tags(tags):
+    return "\0".join((tags.artist, tags.album, tags.title,
+                      str(tags.duration)))
+
+
+def _decode_tags(record):
+    artist, album, title, duration = record.split("\0")
+    return Tags(artist, album, title, int(duration))
+
+
+def open_tags(index):
+    """
+    Open the tags stored with an index, returning a read-only sequence of
+    Tags (one per song), or None if the index has no tags.
+
+    :param index: the song index
+    :type index: TextIndex, BinaryIndex, SQLiteIndex or ShardedIndex
+    """
+    if isinstance(index, ShardedIndex):
+        tag_tables = []
+        for shard in index.parts:
+            tag_table = open_tags(shard)
+            if tag_table is None:
+                for tag_table in tag_tables:
+                    tag_table.close()
+                return None
+            tag_tables.append(tag_table)
+        return Concatenation(tag_tables)
+    if isinstance(index, SQLiteIndex):
+        columns = index.tag_columns()
+        if columns is None:
+            return None
+        return TagTable(columns, lambda row: Tags(*row))
+    try:
+        records = BinaryIndex(tags_file(index.path))
+    except (IOError, ValueError, mmap.error):
+        return None
+    if len(records) != len(index):
+        # Left over from an index written by another update
+        records.close()
+        return None
+    return TagTable(records, _decode_tags)
+
+
+def open_search_keys(index):
+    """
+    Open the search keys stored with an index, returning a read-only
+    sequence of them (one per song), or None if the index has none.
+
+    :param index: the song index
+    :type index: TextIndex, BinaryIndex or SQLiteIndex
+    """
+    if isinstance(index, SQLiteIndex):
+        return index.search_keys()
+    try:
+        keys = BinaryIndex(keys_file(index.path))
+    except (IOError, ValueError, mmap.error):
+        return None
+    if len(keys) != len(index):
+        # Left over from an index written by another update
+        keys.close()
+        return None
+    return keys
+
+
+def open_search_view(index):
+    """
+    Return a read-only sequence of the search key (see query.search_key) of
+    each song in an index: the keys stored with it, or for an index written
+    before search keys were stored, keys worked out from its songs' paths
+    and tags as they are read.
+
+    :param index: the song index
+    :type index: TextIndex, BinaryIndex, SQLiteIndex or ShardedIndex
+    """
+    if isinstance(index, ShardedIndex):
+        return Concatenation([open_search_view(shard)
+                              for shard in index.parts])
+    keys = open_search_keys(index)
+    if keys is not None:
+        return keys
+    return SearchView(index, open_tags(index))
+
+
+def export_text(songs, fh):
+    """
+    Write songs to an open file in the text index format.
+
+    :param songs: song paths to write
+    :type songs: iterable
+    :param fh: file to write to
+    :type fh: file
+    """
+    for song in songs:
+        fh.write("%s\n" % song)
+
+
+def _write_binary(fh, songs):
+    """
+    Write songs to an open file in the binary index format.
+
+    :param fh: file to write to
+    :type fh: file
+    :param songs: song paths to write
+    :type songs: iterable
+    """
+    fh.write(BINARY_HEADER.pack(BINARY_MAGIC, 0, 0))
+    offsets = array("L", [0])
+    position = 0
+    for song in songs:
+        fh.write(song)
+        position += len(song)
+        offsets.append(position)
+    table_offset = BINARY_HEADER.size + position
+    for i in xrange(0, len(offsets), OFFSET_CHUNK):
+        chunk = offsets[i:i + OFFSET_CHUNK]
+        fh.write(struct.pack("<%dQ" % len(chunk), *chunk))
+    fh.seek(0)
+    fh.write(BINARY_HEADER.pack(BINARY_MAGIC, len(offsets) - 1, table_offset))
+
+
+class TextIndex(object):
+    """
+    A text index, read into memory in full (but compactly, see the
+    songtable module).
+    """
+    def __init__(self, path):
+        """
+        :param path: path to the index file
+        :type path: str
+        """
+        self.path = path
+        with open(path, "r") as fh:
+            self._songs = SongTable(line.rstrip("\n") for line in fh)
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __getitem__(self, n):
+        return self._songs[n]
+
+    def __iter__(self):
+        return iter(self._songs)
+
+    def close(self):
+        pass
+
+
+class BinaryIndex(object):
+    """
+    A memory-mapped binary index. Songs are only read from the file as they
+    are accessed.
+    """
+    def __init__(self, path):
+        """
+        :param path: path to the index file
+        :type path: str
+        """
+        self.path = path
+        with open(path, "rb") as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, self._table = BINARY_HEADER.unpack_from(self._map)
+        if magic != BINARY_MAGIC:
+            self._map.close()
+            raise ValueError("'%s' is not a binary index file" % path)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self[i] for i in xrange(*n.indices(self._count))]
+        if n < 0:
+            n += self._count
+        if not 0 <= n < self._count:
+            raise IndexError("index out of range")
+        start, end = OFFSET_PAIR.unpack_from(self._map,
+                                             self._table + OFFSET.size * n)
+        return self._map[BINARY_HEADER.size + start:BINARY_HEADER.size + end]
+
+    def __iter__(self):
+        start = 0
+        for n in xrange(self._count):
+            end, = OFFSET.unpack_from(self._map,
+                                      self._table + OFFSET.size * (n + 1))
+            yield self._map[BINARY_HEADER.size + start:
+                            BINARY_HEADER.size + end]
+            start = end
+
+    def close(self):
+        self._map.close()
+
+
+class TagTable(object):
+    """
+    A read-only sequence of the tags stored with an index.
+    """
+    def __init__(self, records, decode):
+        """
+        :param records: the stored tag records, one per song
+        :type records: sequence
+        :param decode: callable turning a record into Tags
+        :type decode: callable
+        """
+        self._records = records
+        self._decode = decode
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self._decode(record) for record in self._records[n]]
+        return self._decode(self._records[n])
+
+    def __iter__(self):
+        for record in self._records:
+            yield self._decode(record)
+
+    def close(self):
+        self._records.close()
+
+
+class SearchView(object):
+    """
+    A read-only sequence of the search key of each song in an index, worked
+    out from its path and any tags.
+    """
+    def __init__(self, index, tag_table=None):
+        """
+        :param index: the song index
+        :type index: TextIndex, BinaryIndex or SQLiteIndex
+        :param tag_table: the index's tags, if it has any
+        :type tag_table: TagTable
+        """
+        self.index = index
+        self.tag_table = tag_table
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            songs = self.index[n]
+            tags = self.tag_table[n] if self.tag_table is not None else \
+                repeat(None)
+            return [search_key(search_text(song, song_tags))
+                    for song, song_tags in izip(songs, tags)]
+        tags = self.tag_table[n] if self.tag_table is not None else None
+        return search_key(search_text(self.index[n], tags))
+
+    def __iter__(self):
+        tags = self.tag_table if self.tag_table is not None else repeat(None)
+        for song, song_tags in izip(self.index, tags):
+            yield search_key(search_text(song, song_tags))
+
+    def close(self):
+        if self.tag_table is not None:
+            self.tag_table.close()
+
+
+class Concatenation(object):
+    """
+    A read-only sequence made up of other sequences, one after another.
+    """
+    def __init__(self, parts, owned=None):
+        """
+        :param parts: the sequences
+        :type parts: list
+        :param owned: those of the sequences to close along with this one
+        (defaults to all of them)
+        :type owned: list
+        """
+        self.parts = parts
+        self.owned = parts if owned is None else owned
+        # Position of the first item of each part, and the total length
+        self.offsets = [0]
+        for part in parts:
+            self.offsets.append(self.offsets[-1] + len(part))
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __getitem__(self, n):
+        count = self.offsets[-1]
+        if isinstance(n, slice):
+            start, stop, step = n.indices(count)
+            if step != 1:
+                return [self[i] for i in xrange(start, stop, step)]
+            items = []
+            for part, offset in izip(self.parts, self.offsets):
+                if offset >= stop:
+                    break
+                if offset + len(part) > start:
+                    items.extend(part[max(start - offset, 0):stop - offset])
+            return items
+        if n < 0:
+            n += count
+        if not 0 <= n < count:
+            raise IndexError("index out of range")
+        part = bisect_right(self.offsets, n) - 1
+        return self.parts[part][n - self.offsets[part]]
+
+    def __iter__(self):
+        for part in self.parts:
+            for item in part:
+                yield item
+
+    def close(self):
+        for part in self.owned:
+            part.close()
+
+
+class ShardedIndex(Concatenation):
+    """
+    The shards named by a manifest, read as a single index.
+    """
+    def __init__(self, path):
+        """
+        :param path: path to the manifest
+        :type path: str
+        """
+        self.path = path
+        shards = []
+        try:
+            for shard_path in index_files(path):
+                shards.append(open_index(shard_path))
+        except Exception:
+            for shard in shards:
+                shard.close()
+            raise
+        Concatenation.__init__(self, shards)
+
+
+class ShardedSearchIndex(object):
+    """
+    Narrow down searches of a ShardedIndex using each shard's trigram index
+    or full-text table.
+    """
+    def __init__(self, search_indexes, offsets):
+        """
+        :param search_indexes: the search index of each shard
+        :type search_indexes: list
+        :param offsets: position of each shard's first song in the index
+        :type offsets: list[int]
+        """
+        self.search_indexes = search_indexes
+        self.offsets = offsets
+
+    def candidates(self, term):
+        """
+        Return the sorted positions of songs which may contain term, or
+        None if term is too short to narrow the search down.
+
+        :param term: the search term
+        :type term: str
+        """
+        positions = []
+        for search_index, offset in izip(self.search_indexes, self.offsets):
+            shard_positions = search_index.candidates(term)
+            if shard_positions is None:
+                return None
+            positions.extend(offset + n for n in shard_positions)
+        return positions
+
+    def close(self):
+        for search_index in self.search_indexes:
+            search_index.close()
@@ -0,0 +1,254 @@
+"""A library of songs, and playlists drawn from it, for use as a module.
+
+A Library is an index loaded once (along with whatever is used to search
+it), which never changes once loaded, so any number of threads can share
+it. To pick up a new index, load a new Library.
+
+A Playlist is a cursor over a Library: its search terms, shuffle mode, seed
+and position. It holds no songs of its own, only the positions of its
+matches in the index if it has search terms, so a playlist costs little
+more than its matches; without search terms, it costs next to nothing.
+Songs are worked out from the position as they are needed:
+
+sequential (no shuffle mode)
+    The matches in index order.
+
+random
+    A song picked uniformly at random for each position, which may repeat
+    songs.
+
+permutation
+    A seeded permutation of the matches (see selection.Permutation), so
+    every song is played once before any is repeated. Each time round the
+    playlist, the permutation's seed is moved on.
+
+The same search terms, shuffle mode, seed and position always give the same
+songs, so a playlist can be saved (see Playlist.state) and resumed later.
+Each playlist has its own lock, so a playlist may also be shared between
+threads.
+
+e.g.
+    library = Library.from_config()
+    playlist = library.playlist(["bowie"], PERMUTATION_SHUFFLE, loop=True)
+    song = playlist.next()
+
+"""
+
+from __future__ import with_statement
+import os
+import random
+import threading
+from array import array
+from ConfigParser import ConfigParser
+
+from index import (TEXT_FORMAT, current_index_file, open_index,
+                   open_search_index, open_search_view)
+from query import Query
+from selection import PERMUTATION_SHUFFLE, RANDOM_SHUFFLE, Permutation
+
+DEFAULT_CONFIG_FILE = os.path.join(os.path.expanduser("~"), ".random_music",
+                                   "config.txt")
+PLAYLIST_SHUFFLE_MODES = (RANDOM_SHUFFLE, PERMUTATION_SHUFFLE)
+
+
+class Library(object):
+    """
+    An index, loaded once and shared between playlists.
+    """
+    def __init__(self, index_file):
+        """
+        :param index_file: path to the index file
+        :type index_file: str
+        """
+        self.index_file = index_file
+        self.index = open_index(index_file)
+        self.search_index = open_search_index(self.index)
+        self.search_view = open_search_view(self.index)
+
+    @classmethod
+    def from_config(cls, config_file=DEFAULT_CONFIG_FILE):
+        """
+        Load the current index named by a config file. Raises IOError if
+        there is no index.
+
+        :param config_file: path to the config file
+        :type config_file: str
+        """
+        config = ConfigParser()
+        if not config.read(config_file):
+            raise IOError("Cannot read config file '%s'" % config_file)
+        index_dir = config.get("config", "index_dir")
+        if config.has_option("config", "index_format"):
+            fmt = config.get("config", "index_format")
+        else:
+            fmt = TEXT_FORMAT
+        index_file = current_index_file(index_dir, fmt)
+        if index_file is None:
+            raise IOError("No index file in '%s'" % index_dir)
+        return cls(index_file)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, n):
+        return self.index[n]
+
+    def iter_search(self, search_terms):
+        """
+        Yield the positions of the songs matching search terms, in order.
+        Raises QuerySyntaxError if the search terms cannot be parsed.
+
+        :param search_terms: terms to match (see the query module)
+        :type search_terms: list[str]
+        """
+        return Query(search_terms).iter_search(self.search_view,
+                                               self.search_index)
+
+    def search(self, search_terms):
+        """
+        Return the positions of the songs matching search terms, as an
+        array.
+
+        :param search_terms: terms to match (see the query module)
+        :type search_terms: list[str]
+        """
+        return array("L", self.iter_search(search_terms))
+
+    def playlist(self, search_terms=None, shuffle_mode=None, seed=None,
+                 loop=False, position=0):
+        """
+        Return a new Playlist of songs from the library. See Playlist.
+        """
+        return Playlist(self, search_terms, shuffle_mode, seed, loop,
+                        position)
+
+    def close(self):
+        """
+        Close the index. Only to be called once no playlist is using the
+        library.
+        """
+        if self.search_view is not self.index:
+            self.search_view.close()
+        if self.search_index is not None:
+            self.search_index.close()
+        self.index.close()
+
+
+class Playlist(object):
+    """
+    A cursor over the songs in a Library matching some search terms.
+    """
+    def __init__(self, library, search_terms=None, shuffle_mode=None,
+                 seed=None, loop=False, position=0):
+        """
+        :param library: the library to play songs from
+        :type library: Library
+        :param search_terms: terms to match (optional, defaults to every
+        song)
+        :type search_terms: list[str]
+        :param shuffle_mode: one of PLAYLIST_SHUFFLE_MODES, or None to play
+        songs in order
+        :type shuffle_mode: str
+        :param seed: seed for shuffling (optional, defaults to a random seed)
+        :type seed: int
+        :param loop: start again once every song has been played
+        :type loop: bool
+        :param position: number of songs already played
+        :type position: int
+        """
+        if shuffle_mode is not None and shuffle_mode not in \
+                PLAYLIST_SHUFFLE_MODES:
+            raise ValueError("Unsupported shuffle mode '%s'" % shuffle_mode)
+        self.library = library
+        self.search_terms = list(search_terms or [])
+        self.shuffle_mode = shuffle_mode
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(32)
+        self.seed = seed
+        self.loop = loop
+        self.position = position
+        if self.search_terms:
+            self._matches = library.search(self.search_terms)
+        else:
+            self._matches = None
+        # (time round the playlist, its permutation)
+        self._permutation = (None, None)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        if self._matches is None:
+            return len(self.library)
+        return len(self._matches)
+
+    def _song_at(self, position):
+        """
+        Return the song played at a position, or None if the playlist will
+        have ended by then.
+        """
+        count = len(self)
+        if not count:
+            return None
+        cycle, offset = divmod(position, count)
+        if cycle and not self.loop:
+            return None
+        if self.shuffle_mode == RANDOM_SHUFFLE:
+            offset = random.Random((self.seed, position)).randrange(count)
+        elif self.shuffle_mode == PERMUTATION_SHUFFLE:
+            permutation_cycle, permutation = self._permutation
+            if permutation_cycle != cycle:
+                permutation = Permutation(count, self.seed + cycle)
+                self._permutation = (cycle, permutation)
+            offset = permutation[offset]
+        if self._matches is not None:
+            offset = self._matches[offset]
+        return self.library[offset]
+
+    def peek(self, ahead=0):
+        """
+        Return a song coming up, without moving on to it: the next song, or
+        the one ahead songs after it. Returns None if the playlist will have
+        ended by then.
+
+        :param ahead: number of songs to look past
+        :type ahead: int
+        """
+        with self._lock:
+            return self._song_at(self.position + ahead)
+
+    def next(self):
+        """
+        Move on to the next song, returning it, or None if the playlist has
+        ended.
+        """
+        with self._lock:
+            song = self._song_at(self.position)
+            if song is not None:
+                self.position += 1
+            return song
+
+    def __iter__(self):
+        while True:
+            song = self.next()
+            if song is None:
+                return
+            yield song
+
+    def seek(self, position):
+        """
+        Move to a position in the playlist.
+
+        :param position: number of songs to count as already played
+        :type position: int
+        """
+        with self._lock:
+            self.position = position
+
+    def state(self):
+        """
+        Return the playlist's state as a dict, which can be passed as
+        keyword arguments to Library.playlist() to resume it.
+        """
+        with self._lock:
+            return {"search_terms": self.search_terms,
+                    "shuffle_mode": self.shuffle_mode, "seed": self.seed,
+                    "loop": self.loop, "position": self.position}
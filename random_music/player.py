@@ -0,0 +1,387 @@
+"""Play songs using an external music client.
+
+Three playback modes are available:
+
+simple
+    Start the music client afresh for each song.
+
+prespawn
+    While a song plays, start the music client for the next song, stopping
+    it the moment it has been exec'd (it is traced with ptrace, which stops
+    it at the exec, and then left stopped with SIGSTOP). When the song
+    finishes, all that is left to do is send it SIGCONT. The process has to
+    be in the terminal's foreground process group by then, so that the music
+    client can read the keyboard (a process cannot be moved between groups
+    once it has exec'd), so it waits in ours. A ctrl+c while it waits would
+    be held until it continues, and then kill it, so it is thrown away and
+    started afresh whenever ctrl+c is pressed. This mode needs ptrace, so it
+    is only available on Linux.
+
+persistent
+    Drive a single mplayer process in slave mode, appending each song to its
+    playlist while the previous one is still playing, so that it moves
+    straight from one song to the next.
+
+Music clients are always run directly from an argv list rather than through
+a shell, so song paths can contain any characters.
+
+"""
+
+import os
+import sys
+import time
+import errno
+import ctypes
+import ctypes.util
+import signal
+import threading
+import subprocess
+from Queue import Queue, Empty
+
+from profiling import NULL_PROFILER
+
+SIMPLE_MODE = "simple"
+PRESPAWN_MODE = "prespawn"
+PERSISTENT_MODE = "persistent"
+PLAYBACK_MODES = (SIMPLE_MODE, PRESPAWN_MODE, PERSISTENT_MODE)
+
+# How often the persistent player asks mplayer what it is playing
+POLL_INTERVAL = 0.2
+# How long the persistent player waits for mplayer to start a song before
+# assuming it could not be played
+START_TIMEOUT = 5
+
+PTRACE_TRACEME = 0
+PTRACE_DETACH = 17
+
+
+def _load_libc():
+    """
+    Return libc, if it has ptrace (and we are on Linux), or None.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        libc.ptrace
+    except (OSError, AttributeError):
+        return None
+    libc.ptrace.argtypes = [ctypes.c_long, ctypes.c_int, ctypes.c_void_p,
+                            ctypes.c_void_p]
+    return libc
+
+_libc = _load_libc()
+
+
+def make_player(mode, music_client, profiler=NULL_PROFILER):
+    """
+    Return a player for the given playback mode.
+
+    :param mode: one of PLAYBACK_MODES
+    :type mode: str
+    :param music_client: the music client to play songs with
+    :type music_client: str
+    :param profiler: profiler to time starting songs with (optional)
+    :type profiler: profiling.Profiler
+    """
+    if mode == PERSISTENT_MODE:
+        if "mplayer" in os.path.basename(music_client):
+            return SlavePlayer(music_client, profiler)
+        sys.stderr.write("WARNING: persistent playback requires mplayer, "
+                         "falling back to simple playback\n")
+    elif mode == PRESPAWN_MODE:
+        if _libc is not None:
+            return PrespawnPlayer(music_client, profiler)
+        sys.stderr.write("WARNING: prespawn playback requires ptrace, "
+                         "falling back to simple playback\n")
+    return ProcessPlayer(music_client, profiler)
+
+
+class ProcessPlayer(object):
+    """
+    Start the music client afresh for each song.
+    """
+    def __init__(self, music_client, profiler=NULL_PROFILER):
+        """
+        :param music_client: the music client to play songs with
+        :type music_client: str
+        :param profiler: profiler to time starting songs with (optional)
+        :type profiler: profiling.Profiler
+        """
+        self.argv = [music_client]
+        self.devnull = open(os.devnull, "r+b")
+        self.profiler = profiler
+
+    def play(self, song, next_song=None):
+        """
+        Play a song, returning when it has finished. If interrupted with
+        ctrl+c, the song is stopped and the KeyboardInterrupt re-raised.
+
+        :param song: path to the song
+        :type song: str
+        :param next_song: path to the song which will be played next, if
+        known
+        :type next_song: str
+        """
+        with self.profiler.timer("playback.spawn"):
+            proc = subprocess.Popen(self.argv + [song], stdout=self.devnull,
+                                    stderr=self.devnull)
+        try:
+            proc.wait()
+        except KeyboardInterrupt:
+            _kill(proc.pid)
+            proc.wait()
+            raise
+
+    def close(self):
+        self.devnull.close()
+
+
+def _kill(pid):
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def _ptrace(request, pid, data=None):
+    if _libc.ptrace(request, pid, None, data) < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def _trace_me():
+    """
+    Run in the child before exec: have it stopped once it has exec'd.
+    """
+    _ptrace(PTRACE_TRACEME, 0)
+
+
+class _StoppedProcess(object):
+    """
+    The music client, exec'd ahead of time and stopped until it is started.
+    """
+    def __init__(self, argv, devnull):
+        """
+        :param argv: the music client command line
+        :type argv: list[str]
+        :param devnull: open file on os.devnull
+        :type devnull: file
+        """
+        self.argv = argv
+        self.proc = subprocess.Popen(argv, stdout=devnull, stderr=devnull,
+                                     preexec_fn=_trace_me)
+        self.pid = self.proc.pid
+        try:
+            # The exec stops the traced child with SIGTRAP; detaching from
+            # it with SIGSTOP leaves it stopped, without its having run a
+            # single instruction of the music client.
+            _, status = os.waitpid(self.pid, 0)
+            if not os.WIFSTOPPED(status):
+                raise OSError(errno.ECHILD, "%s exited before it was "
+                              "started" % argv[0])
+            _ptrace(PTRACE_DETACH, self.pid, signal.SIGSTOP)
+            os.waitpid(self.pid, os.WUNTRACED)
+        except OSError:
+            self.cancel()
+            raise
+
+    def start(self):
+        os.kill(self.pid, signal.SIGCONT)
+
+    def wait(self):
+        return self.proc.wait()
+
+    def cancel(self):
+        # SIGTERM only arrives once the process is continued, before it
+        # gets to run anything.
+        _kill(self.pid)
+        try:
+            os.kill(self.pid, signal.SIGCONT)
+        except OSError:
+            pass
+        self.proc.wait()
+
+
+class PrespawnPlayer(ProcessPlayer):
+    """
+    Start the next song's music client, stopped, while the current song
+    plays.
+    """
+    def __init__(self, music_client, profiler=NULL_PROFILER):
+        ProcessPlayer.__init__(self, music_client, profiler)
+        self._spare = None
+        self._can_prespawn = True
+
+    def _prespawn(self, song):
+        """
+        Return a stopped process to play a song with, or None if ptrace is
+        not permitted (in some containers, say).
+        """
+        if not self._can_prespawn:
+            return None
+        try:
+            return _StoppedProcess(self.argv + [song], self.devnull)
+        except OSError, err:
+            if err.errno not in (errno.EPERM, errno.EACCES, errno.ENOSYS):
+                raise
+            sys.stderr.write("WARNING: cannot trace the music client (%s), "
+                             "falling back to simple playback\n" % err)
+            self._can_prespawn = False
+            return None
+
+    def play(self, song, next_song=None):
+        with self.profiler.timer("playback.spawn"):
+            proc = self._spare
+            self._spare = None
+            if proc is None or proc.argv[-1] != song:
+                self.profiler.count("playback.prespawn_misses")
+                if proc is not None:
+                    proc.cancel()
+                proc = self._prespawn(song)
+            if proc is not None:
+                proc.start()
+        if proc is None:
+            return ProcessPlayer.play(self, song)
+        try:
+            if next_song is not None:
+                self._spare = self._prespawn(next_song)
+            proc.wait()
+        except KeyboardInterrupt:
+            _kill(proc.pid)
+            proc.wait()
+            # The spare got the SIGINT too, and would die of it as soon as
+            # it was continued.
+            if self._spare is not None:
+                self._spare.cancel()
+                self._spare = None
+            raise
+
+    def close(self):
+        if self._spare is not None:
+            self._spare.cancel()
+            self._spare = None
+        ProcessPlayer.close(self)
+
+
+def _quote(song):
+    """
+    Quote a song path for use in an mplayer slave command.
+
+    :param song: path to the song
+    :type song: str
+    """
+    if "\n" in song:
+        raise ValueError("Cannot play '%r' in persistent mode" % song)
+    return '"%s"' % song.replace("\\", "\\\\").replace('"', '\\"')
+
+
+class SlavePlayer(object):
+    """
+    Drive a single mplayer process in slave mode.
+    """
+    def __init__(self, music_client, profiler=NULL_PROFILER):
+        """
+        :param music_client: path to mplayer
+        :type music_client: str
+        :param profiler: profiler to time starting songs with (optional)
+        :type profiler: profiling.Profiler
+        """
+        self.profiler = profiler
+        self.devnull = open(os.devnull, "wb")
+        self.proc = subprocess.Popen([music_client, "-slave", "-idle",
+                                      "-quiet"],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=self.devnull,
+                                     preexec_fn=os.setpgrp)
+        self.answers = Queue()
+        self.queued = None
+        reader = threading.Thread(target=self._read_answers)
+        reader.daemon = True
+        reader.start()
+
+    def _read_answers(self):
+        for line in iter(self.proc.stdout.readline, ""):
+            if line.startswith("ANS_"):
+                self.answers.put(line.rstrip("\n"))
+        self.answers.put(None)
+
+    def _command(self, command):
+        self.proc.stdin.write(command + "\n")
+        self.proc.stdin.flush()
+
+    def _current_path(self):
+        """
+        Return the path mplayer is currently playing, or None if it is idle.
+        """
+        # An answer left over from an earlier request (one which timed out,
+        # or was interrupted with ctrl+c) would be taken for this one's.
+        while True:
+            try:
+                stale = self.answers.get_nowait()
+            except Empty:
+                break
+            if stale is None:
+                # mplayer has exited; keep that for below.
+                self.answers.put(None)
+                break
+        self._command("pausing_keep_force get_property path")
+        try:
+            answer = self.answers.get(timeout=5)
+        except Empty:
+            answer = None
+        if answer is None:
+            if self.proc.poll() is not None:
+                raise RuntimeError("mplayer exited unexpectedly")
+            return None
+        if answer.startswith("ANS_path="):
+            return answer[len("ANS_path="):]
+        return None
+
+    def play(self, song, next_song=None):
+        if self.queued != song:
+            self._command("loadfile %s 0" % _quote(song))
+        self.queued = None
+        if next_song is not None:
+            # Appending the next song to mplayer's playlist means it moves
+            # straight on to it, without waiting on us.
+            self._command("loadfile %s 1" % _quote(next_song))
+            self.queued = next_song
+        try:
+            self._wait(song, next_song)
+        except KeyboardInterrupt:
+            self._command("stop")
+            self.queued = None
+            raise
+
+    def _wait(self, song, next_song):
+        """
+        Wait for mplayer to start playing a song, and then to move on from
+        it. mplayer skips songs it cannot play, so if it does not start the
+        song within START_TIMEOUT (or skips straight to the next song), we
+        stop waiting.
+        """
+        started = time.time()
+        seen = False
+        while True:
+            current = self._current_path()
+            if current == song:
+                if not seen:
+                    # Only as accurate as POLL_INTERVAL
+                    self.profiler.add_time("playback.spawn",
+                                           time.time() - started)
+                seen = True
+            elif (seen or current == next_song or
+                  time.time() - started > START_TIMEOUT):
+                return
+            time.sleep(POLL_INTERVAL)
+
+    def close(self):
+        try:
+            self._command("quit")
+        except IOError:
+            pass
+        self.proc.wait()
+        self.devnull.close()
@@ -0,0 +1,281 @@
+"""Copy upcoming songs to a local cache while the current song plays.
+
+Music kept on a network mount can be slow to start, and can drop out when
+the network stalls. With a cache (see cache_size_mb), the next few songs in
+the playlist are copied into a cache directory by a background thread, and
+played from there once they have been copied. Songs not yet copied are
+played from where they are, as before.
+
+Cached copies are named after a hash of their song's path (keeping its
+extension, which music clients go by), and a manifest records each copy's
+song, the song's size and mtime when it was copied, and when the copy was
+last used. A copy is only played once it has been checked against its song
+in this session, so changed songs are copied again. When the cache outgrows
+its size, the least recently used copies are removed.
+
+Opening a cache removes any copies missing from its manifest (left behind
+by a run which was killed), so only one process may use a cache directory
+at a time: it holds an exclusive flock() on a lock file in the directory
+until it closes the cache, and any other process plays without one.
+
+"""
+
+from __future__ import with_statement
+import os
+import time
+import errno
+import fcntl
+import hashlib
+import marshal
+import threading
+from Queue import Queue
+
+CACHE_DIR = "cache"
+MANIFEST_FILE = "manifest.marshal"
+LOCK_FILE = "lock"
+DEFAULT_PREFETCH_TRACKS = 3
+COPY_CHUNK = 1 << 20
+
+
+def cache_name(song):
+    """
+    Return the name of the cached copy of a song.
+
+    :param song: path to the song
+    :type song: str
+    """
+    return (hashlib.md5(song).hexdigest() +
+            os.path.splitext(song)[1].lower())
+
+
+class _Stopped(Exception):
+    pass
+
+
+class TrackCache(object):
+    """
+    A size-bounded cache of copies of songs, evicting the least recently
+    used copies first.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        """
+        :param cache_dir: directory to keep copies in (created if need be)
+        :type cache_dir: str
+        :param max_bytes: most space to take up
+        :type max_bytes: int
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Raises IOError if another process is using the cache
+        self.lock_fh = open(os.path.join(cache_dir, LOCK_FILE), "a")
+        try:
+            fcntl.flock(self.lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.lock_fh.close()
+            raise
+        self.manifest_file = os.path.join(cache_dir, MANIFEST_FILE)
+        # name -> [song, size, mtime, last used]
+        self.entries = {}
+        try:
+            with open(self.manifest_file, "rb") as fh:
+                self.entries = marshal.load(fh)
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        # Drop copies which have gone missing, and copies left behind by
+        # runs which were killed before saving the manifest
+        names = set(name for name in os.listdir(cache_dir)
+                    if name not in (MANIFEST_FILE, LOCK_FILE))
+        for name in list(self.entries):
+            if name not in names:
+                del self.entries[name]
+        for name in names - set(self.entries):
+            self._remove(name)
+        self.size = sum(entry[1] for entry in self.entries.itervalues())
+        # Names of copies checked against their songs this session
+        self.ready = set()
+        # Names of copies which must not be evicted
+        self.pinned = set()
+        self._lock = threading.Lock()
+        self.stopped = False
+
+    def _remove(self, name):
+        try:
+            os.unlink(os.path.join(self.cache_dir, name))
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def get(self, song):
+        """
+        Return the path to a song's cached copy, or None if it has not been
+        copied (and checked) yet.
+
+        :param song: path to the song
+        :type song: str
+        """
+        name = cache_name(song)
+        with self._lock:
+            if name not in self.ready:
+                return None
+            self.entries[name][3] = time.time()
+        return os.path.join(self.cache_dir, name)
+
+    def pin(self, songs):
+        """
+        Protect the copies of the given songs (those playing or about to)
+        from eviction, in place of any songs pinned before.
+
+        :param songs: paths to the songs
+        :type songs: iterable
+        """
+        with self._lock:
+            self.pinned = set(cache_name(song) for song in songs)
+
+    def _evict(self, needed):
+        """
+        Remove the least recently used copies until there is room for
+        needed more bytes, returning whether there is.
+        """
+        by_last_use = sorted(self.entries,
+                             key=lambda name: self.entries[name][3])
+        for name in by_last_use:
+            if self.size + needed <= self.max_bytes:
+                break
+            if name in self.pinned:
+                continue
+            self.size -= self.entries.pop(name)[1]
+            self.ready.discard(name)
+            self._remove(name)
+        return self.size + needed <= self.max_bytes
+
+    def fetch(self, song):
+        """
+        Copy a song into the cache, unless an up to date copy is already
+        there (or the song cannot fit).
+
+        :param song: path to the song
+        :type song: str
+        """
+        name = cache_name(song)
+        try:
+            st = os.stat(song)
+        except OSError:
+            return
+        if st.st_size > self.max_bytes:
+            return
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                if entry[:3] == [song, st.st_size, st.st_mtime]:
+                    self.ready.add(name)
+                    return
+                # Out of date
+                self.size -= self.entries.pop(name)[1]
+                self.ready.discard(name)
+                self._remove(name)
+            if not self._evict(st.st_size):
+                return
+            # Reserve the space while copying
+            self.size += st.st_size
+        path = os.path.join(self.cache_dir, name)
+        tmp_path = "%s.tmp" % path
+        try:
+            self._copy(song, tmp_path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError, _Stopped):
+            with self._lock:
+                self.size -= st.st_size
+            self._remove(os.path.basename(tmp_path))
+            return
+        with self._lock:
+            self.entries[name] = [song, st.st_size, st.st_mtime, time.time()]
+            self.ready.add(name)
+
+    def _copy(self, src, dst):
+        with open(src, "rb") as src_fh:
+            with open(dst, "wb") as dst_fh:
+                while True:
+                    if self.stopped:
+                        raise _Stopped()
+                    data = src_fh.read(COPY_CHUNK)
+                    if not data:
+                        break
+                    dst_fh.write(data)
+
+    def stop(self):
+        """
+        Abandon any copy in progress.
+        """
+        self.stopped = True
+
+    def save(self):
+        """
+        Save the manifest, replacing the existing one atomically.
+        """
+        tmp_path = "%s.tmp" % self.manifest_file
+        with self._lock:
+            with open(tmp_path, "wb") as fh:
+                marshal.dump(self.entries, fh)
+        os.rename(tmp_path, self.manifest_file)
+
+    def close(self):
+        """
+        Let other processes use the cache.
+        """
+        self.lock_fh.close()
+
+
+class Prefetcher(object):
+    """
+    Copy songs into a TrackCache in a background thread.
+    """
+    def __init__(self, cache):
+        """
+        :param cache: the cache to copy songs into
+        :type cache: TrackCache
+        """
+        self.cache = cache
+        self.queue = Queue()
+        self.queued = set()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            song = self.queue.get()
+            if song is None or self.cache.stopped:
+                return
+            self.cache.fetch(song)
+            self.queued.discard(song)
+
+    def upcoming(self, playing, songs):
+        """
+        Tell the prefetcher which song is playing and which are coming up
+        next, in order. The upcoming songs not already copied are queued for
+        copying; the playing song is already being read from wherever it is,
+        so it is only kept from being evicted, along with the rest.
+
+        :param playing: path to the song playing
+        :type playing: str
+        :param songs: paths to the upcoming songs
+        :type songs: list[str]
+        """
+        self.cache.pin([playing] + songs)
+        for song in songs:
+            if song not in self.queued and self.cache.get(song) is None:
+                self.queued.add(song)
+                self.queue.put(song)
+
+    def close(self):
+        """
+        Stop the background thread, abandoning any copy in progress, and
+        save and close the cache.
+        """
+        self.cache.stop()
+        self.queue.put(None)
+        self.thread.join()
+        self.cache.save()
+        self.cache.close()
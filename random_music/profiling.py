@@ -0,0 +1,193 @@
+"""Time the stages of building a playlist and playing it.
+
+A Profiler keeps named timers, which accumulate how many times a stage ran
+and how long it took, and named counters. Timer names are dotted, with the
+stage first (e.g. "update_index.scan_files" is part of "update_index"). The
+collected numbers are reported at exit, either as a table or as JSON lines
+(one object per timer or counter), for feeding to other tools.
+
+When profiling is off, NULL_PROFILER stands in, so the stages need not
+check whether they are being timed.
+
+"""
+
+from __future__ import with_statement
+import json
+import time
+from functools import wraps
+
+TEXT_FORMAT = "text"
+JSON_FORMAT = "json"
+PROFILE_FORMATS = (TEXT_FORMAT, JSON_FORMAT)
+
+
+class _Timing(object):
+    """
+    The accumulated times of a named timer.
+    """
+    __slots__ = ("count", "total", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+
+class _Timer(object):
+    """
+    Context manager timing a block of code.
+    """
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add_time(self.name, time.time() - self.start)
+
+
+class Profiler(object):
+    """
+    Named timers and counters.
+    """
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        # Names in the order they were first used, which is roughly the
+        # order the stages ran in
+        self._order = []
+
+    def timer(self, name):
+        """
+        Return a context manager which times its block under name, e.g.
+            with profiler.timer("generate_list"):
+                ...
+
+        :param name: name of the timer
+        :type name: str
+        """
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds):
+        """
+        Record that a stage took the given time.
+
+        :param name: name of the timer
+        :type name: str
+        :param seconds: time taken
+        :type seconds: float
+        """
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = _Timing()
+            self._order.append(name)
+        timing.add(seconds)
+
+    def count(self, name, n=1):
+        """
+        Add n to a counter.
+
+        :param name: name of the counter
+        :type name: str
+        :param n: amount to add
+        :type n: int
+        """
+        if name not in self.counters:
+            self.counters[name] = 0
+            self._order.append(name)
+        self.counters[name] += n
+
+    def report(self, fh, fmt=TEXT_FORMAT):
+        """
+        Write out the timers and counters.
+
+        :param fh: file to write to
+        :type fh: file
+        :param fmt: one of PROFILE_FORMATS
+        :type fmt: str
+        """
+        if fmt == JSON_FORMAT:
+            for name in self._order:
+                if name in self.timings:
+                    timing = self.timings[name]
+                    record = {"type": "timer", "name": name,
+                              "count": timing.count, "total": timing.total,
+                              "mean": timing.total / timing.count,
+                              "min": timing.min, "max": timing.max}
+                else:
+                    record = {"type": "counter", "name": name,
+                              "value": self.counters[name]}
+                fh.write(json.dumps(record, sort_keys=True) + "\n")
+            return
+        width = max([len(name) for name in self._order] + [len("counter")])
+        timers = [name for name in self._order if name in self.timings]
+        counters = [name for name in self._order if name in self.counters]
+        if timers:
+            fh.write("%-*s %7s %11s %11s %11s\n" % (width, "timer", "count",
+                                                    "total", "mean", "max"))
+            for name in timers:
+                timing = self.timings[name]
+                fh.write("%-*s %7d %10.4fs %10.4fs %10.4fs\n" %
+                         (width, name, timing.count, timing.total,
+                          timing.total / timing.count, timing.max))
+        if counters:
+            fh.write("%-*s %7s\n" % (width, "counter", "value"))
+            for name in counters:
+                fh.write("%-*s %7d\n" % (width, name, self.counters[name]))
+
+
+def timed(name):
+    """
+    Decorate a method so that each call is timed under name, by the
+    profiler in its object's profiler attribute.
+
+    :param name: name of the timer
+    :type name: str
+    """
+    def decorate(method):
+        @wraps(method)
+        def timed_method(self, *args, **kwargs):
+            with self.profiler.timer(name):
+                return method(self, *args, **kwargs)
+        return timed_method
+    return decorate
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+
+class NullProfiler(Profiler):
+    """
+    A profiler which records nothing.
+    """
+    def timer(self, name):
+        return _NULL_TIMER
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,490 @@
+"""Parse and evaluate search queries.
+
+A query is made up of search terms, which match any song whose path contains
+them (ignoring case, accents and punctuation), combined as follows:
+
+    david bowie                 both terms must match (AND is implied)
+    bowie OR "lou reed"         either may match; quotes group a phrase
+    bowie NOT live              the second term must not match (or -live)
+    (bowie OR reed) AND live    parentheses group sub-queries
+    ^heroes                     the term must start a path segment
+    heroes$                     the term must end a path segment (or come
+                                just before a file extension)
+    beethoven~                  the term may be misspelt (see below)
+
+OR binds more loosely than AND, so "a b OR c" means "(a AND b) OR c", as it
+always has.
+
+Where the index holds a song's tags, they are searched too: each song is
+matched against its search text, its path followed by its artist, album and
+title on separate lines, each of which counts as a path segment for ^ and $.
+
+Songs and terms are compared by their search keys (see search_key()): their
+text lowercased, with accents stripped and runs of punctuation collapsed, so
+"bjork" matches the accented spelling too, and "guns n roses" matches "Guns
+N' Roses". Indexes store each song's search key, so songs are not normalized
+again on every search.
+
+A term followed by ~ matches text within a few edits (insertions, deletions
+or substitutions) of it: one edit, or two for terms of FUZZY_LONG_TERM
+characters or more. term~N allows N edits. Split into N + 1 pieces, a term
+misspelt N times must still have one piece intact, so fuzzy terms are
+narrowed down to the songs containing any of the pieces (using the trigram
+index) before the edit distance is worked out.
+
+A query is parsed once into a tree of nodes, which is then compiled into a
+single predicate, so every branch of the query is evaluated against each
+song's search key in a single pass.
+
+"""
+
+import re
+import shlex
+import unicodedata
+
+from _exceptions import QuerySyntaxError
+from trigrams import intersect
+
+# Separates a song's path and tags in its search text
+TAG_SEPARATOR = "\n"
+# Terms this long or longer may be misspelt twice by default
+FUZZY_LONG_TERM = 9
+# Letters which don't decompose into a base letter and an accent
+_FOLDS = {u"\xdf": u"ss", u"\xe6": u"ae", u"\u0153": u"oe", u"\xf8": u"o",
+          u"\u0142": u"l", u"\u0111": u"d", u"\xfe": u"th"}
+# Runs of spaces and punctuation, other than path and tag separators
+_SEPARATOR_RUN = re.compile(r"(?:[^\w/\n]|_)+", re.UNICODE)
+# Separators left at the start or end of a path segment
+_SEGMENT_EDGE = re.compile(r"[ .]*([/\n])[ .]*")
+_FUZZY_SUFFIX = re.compile(r"~(\d?)$")
+
+
+def search_text(song, tags=None):
+    """
+    Return the text a song is searched by: its path, followed by any tags it
+    has.
+
+    :param song: path to the song
+    :type song: str
+    :param tags: the song's tags (artist, album, title, ...), if known
+    :type tags: index.Tags
+    """
+    if not tags or not any(tags[:3]):
+        return song
+    return TAG_SEPARATOR.join((song,) + tuple(tags[:3]))
+
+
+def _separator(match):
+    # A dot within a word (e.g. before a file extension) is kept as a dot,
+    # so that $ still finds extensions; anything else becomes a space.
+    run = match.group()
+    if "." in run and not any(c.isspace() for c in run):
+        return u"."
+    return u" "
+
+
+def search_key(text):
+    """
+    Return the form of a song's search text (or a search term) which
+    searches compare: lowercased, with accents stripped and each run of
+    spaces and punctuation collapsed into a single space.
+
+    :param text: UTF-8 search text
+    :type text: str
+    """
+    text = unicodedata.normalize("NFKD", text.decode("utf-8", "replace")
+                                 .lower())
+    text = u"".join(_FOLDS.get(c, c) for c in text
+                    if not unicodedata.combining(c))
+    text = _SEPARATOR_RUN.sub(_separator, text)
+    text = _SEGMENT_EDGE.sub(r"\1", text).strip(u" .")
+    return text.encode("utf-8")
+
+
+def within_edits(term, text, max_edits):
+    """
+    Return whether text contains a string within max_edits insertions,
+    deletions or substitutions of term. Uses Myers' bit-parallel algorithm,
+    which keeps a column of the edit distance matrix in the bits of two
+    integers, so each character of text costs a few integer operations.
+
+    :param term: the term to look for
+    :type term: str
+    :param text: the text to search
+    :type text: str
+    :param max_edits: most edits allowed
+    :type max_edits: int
+    """
+    m = len(term)
+    if m <= max_edits:
+        return True
+    # Bit i of masks[c] is set where term[i] == c
+    masks = {}
+    for i, c in enumerate(term):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    # Vertical positive and negative deltas of the current column
+    pv, mv = full, 0
+    score = m
+    for c in text:
+        eq = masks.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        if score <= max_edits:
+            return True
+        ph = (ph << 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+    return False
+
+
+class Term(object):
+    """
+    A search term (or quoted phrase), optionally anchored to path segment
+    boundaries.
+    """
+    def __init__(self, text, anchor_start=False, anchor_end=False):
+        """
+        :param text: the term itself
+        :type text: str
+        :param anchor_start: the term must start a path segment
+        :type anchor_start: bool
+        :param anchor_end: the term must end a path segment
+        :type anchor_end: bool
+        """
+        self.text = search_key(text)
+        self.anchor_start = anchor_start
+        self.anchor_end = anchor_end
+
+    def __repr__(self):
+        return "Term(%r%s%s)" % (self.text, ", ^" * self.anchor_start,
+                                 ", $" * self.anchor_end)
+
+    def compile(self):
+        text = self.text
+        if not (self.anchor_start or self.anchor_end):
+            return lambda song: text in song
+        pattern = re.escape(text)
+        if self.anchor_start:
+            pattern = "(?:^|[/\n])" + pattern
+        if self.anchor_end:
+            pattern += r"(?=$|[/\n]|\.[^/.\n]*(?:$|\n))"
+        return re.compile(pattern).search
+
+    def candidates(self, trigram_index):
+        # An anchored term must be preceded by a slash (unless it starts
+        # the path, which would make it the root directory), so include it.
+        # Tags are preceded by a TAG_SEPARATOR instead.
+        if self.anchor_start:
+            positions = trigram_index.candidates("/" + self.text)
+            tag_positions = trigram_index.candidates(TAG_SEPARATOR +
+                                                     self.text)
+            if positions is None or tag_positions is None:
+                return None
+            if not tag_positions:
+                return positions
+            return sorted(set(positions).union(tag_positions))
+        return trigram_index.candidates(self.text)
+
+
+class FuzzyTerm(object):
+    """
+    A search term which may be misspelt.
+    """
+    def __init__(self, text, max_edits=None):
+        """
+        :param text: the term itself
+        :type text: str
+        :param max_edits: most edits allowed (defaults to one, or two for
+        terms of FUZZY_LONG_TERM characters or more), which must be fewer
+        than the term has characters
+        :type max_edits: int
+        """
+        self.text = search_key(text)
+        if max_edits is None:
+            max_edits = 2 if len(self.text) >= FUZZY_LONG_TERM else 1
+        if len(self.text.decode("utf-8")) <= max_edits:
+            # Every song is within that many edits of containing it
+            raise QuerySyntaxError("fuzzy term '%s' must be longer than %d "
+                                   "characters" % (text, max_edits))
+        self.max_edits = max_edits
+
+    def __repr__(self):
+        return "FuzzyTerm(%r, %d)" % (self.text, self.max_edits)
+
+    def compile(self):
+        text, max_edits = self.text, self.max_edits
+        # Most songs are ruled out by the trigram index, but an exact match
+        # is cheaper still to check for
+        return lambda song: text in song or within_edits(text, song,
+                                                         max_edits)
+
+    def candidates(self, trigram_index):
+        pieces = self.max_edits + 1
+        text = self.text.decode("utf-8")
+        length = len(text)
+        positions = set()
+        for i in xrange(pieces):
+            piece = text[i * length // pieces:(i + 1) * length // pieces]
+            piece_positions = trigram_index.candidates(piece.encode("utf-8"))
+            if piece_positions is None:
+                return None
+            positions.update(piece_positions)
+        return sorted(positions)
+
+
+class And(object):
+    """
+    Every sub-query must match.
+    """
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return "And(%r)" % self.children
+
+    def compile(self):
+        predicates = [child.compile() for child in self.children]
+        return lambda song: all(p(song) for p in predicates)
+
+    def candidates(self, trigram_index):
+        positions = None
+        for child in self.children:
+            child_positions = child.candidates(trigram_index)
+            if child_positions is None:
+                continue
+            if positions is None:
+                positions = child_positions
+            else:
+                positions = intersect(positions, child_positions)
+        return positions
+
+
+class Or(object):
+    """
+    Any sub-query may match.
+    """
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return "Or(%r)" % self.children
+
+    def compile(self):
+        predicates = [child.compile() for child in self.children]
+        return lambda song: any(p(song) for p in predicates)
+
+    def candidates(self, trigram_index):
+        positions = set()
+        for child in self.children:
+            child_positions = child.candidates(trigram_index)
+            if child_positions is None:
+                return None
+            positions.update(child_positions)
+        return sorted(positions)
+
+
+class Not(object):
+    """
+    The sub-query must not match.
+    """
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self):
+        return "Not(%r)" % self.child
+
+    def compile(self):
+        predicate = self.child.compile()
+        return lambda song: not predicate(song)
+
+    def candidates(self, trigram_index):
+        return None
+
+
+def tokenize(search_terms):
+    """
+    Split command line search terms into tokens. Each token is a (kind,
+    value) tuple, where kind is either "op" or "term". An argument containing
+    whitespace (i.e. one which was quoted on the command line) is a phrase,
+    as are quoted sections within an argument.
+
+    :param search_terms: terms as given on the command line
+    :type search_terms: list[str]
+    """
+    tokens = []
+    for arg in search_terms:
+        if any(c.isspace() for c in arg) and '"' not in arg:
+            tokens.append(("term", arg))
+            continue
+        try:
+            words = shlex.split(arg, posix=False)
+        except ValueError:
+            raise QuerySyntaxError("unbalanced quotes in '%s'" % arg)
+        for word in words:
+            if len(word) > 1 and word[0] == word[-1] == '"':
+                tokens.append(("term", word[1:-1]))
+                continue
+            while word.startswith("("):
+                tokens.append(("op", "("))
+                word = word[1:]
+            closing = len(word) - len(word.rstrip(")"))
+            word = word[:len(word) - closing]
+            if word in ("AND", "OR", "NOT"):
+                tokens.append(("op", word))
+            elif word.startswith("-") and len(word) > 1:
+                tokens.append(("op", "NOT"))
+                tokens.append(("term", word[1:]))
+            elif word:
+                tokens.append(("term", word))
+            tokens.extend([("op", ")")] * closing)
+    return tokens
+
+
+class _Parser(object):
+    """
+    Recursive descent parser for query tokens.
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise QuerySyntaxError("unexpected '%s'" % self.peek()[1])
+        return node
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek() == ("op", "OR"):
+            self.next()
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def parse_and(self):
+        children = [self.parse_unary()]
+        while True:
+            kind, value = self.peek()
+            if kind == "op" and value == "AND":
+                self.next()
+            elif kind is None or (kind == "op" and value in ("OR", ")")):
+                break
+            children.append(self.parse_unary())
+        return children[0] if len(children) == 1 else And(children)
+
+    def parse_unary(self):
+        kind, value = self.next()
+        if kind == "op" and value == "NOT":
+            return Not(self.parse_unary())
+        if kind == "op" and value == "(":
+            node = self.parse_or()
+            if self.next() != ("op", ")"):
+                raise QuerySyntaxError("missing ')'")
+            return node
+        if kind == "term":
+            return _make_term(value)
+        if kind is None:
+            raise QuerySyntaxError("query ends unexpectedly")
+        raise QuerySyntaxError("unexpected '%s'" % value)
+
+
+def _make_term(value):
+    """
+    Make a Term (or FuzzyTerm), stripping any anchors or fuzzy suffix from
+    its text.
+
+    :param value: the term, as given in the query
+    :type value: str
+    """
+    fuzzy = _FUZZY_SUFFIX.search(value)
+    if fuzzy is not None and fuzzy.start():
+        if value.startswith("^") or value[:fuzzy.start()].endswith("$"):
+            raise QuerySyntaxError("fuzzy term '%s' cannot be anchored" %
+                                   value)
+        max_edits = int(fuzzy.group(1)) if fuzzy.group(1) else None
+        return FuzzyTerm(value[:fuzzy.start()], max_edits)
+    anchor_start = value.startswith("^") and len(value) > 1
+    if anchor_start:
+        value = value[1:]
+    anchor_end = value.endswith("$") and len(value) > 1
+    if anchor_end:
+        value = value[:-1]
+    return Term(value, anchor_start, anchor_end)
+
+
+class Query(object):
+    """
+    A compiled search query.
+    """
+    def __init__(self, search_terms):
+        """
+        :param search_terms: terms as given on the command line
+        :type search_terms: list[str]
+        """
+        self.tree = _Parser(tokenize(search_terms)).parse()
+        self._predicate = self.tree.compile()
+
+    def __repr__(self):
+        return "Query(%r)" % self.tree
+
+    def matches(self, song):
+        """
+        Return True if a song's path (or search text) matches the query.
+
+        :param song: path to the song
+        :type song: str
+        """
+        return self._predicate(search_key(song))
+
+    def iter_search(self, index, trigram_index=None):
+        """
+        Yield the positions of songs in index which match the query, in
+        index order. Each song is considered only once, however many
+        branches of the query it matches. Songs are only checked as results
+        are consumed, so a caller which stops early saves the rest of the
+        scan.
+
+        :param index: sequence of songs' search keys (see search_key())
+        :type index: sequence
+        :param trigram_index: trigram index for index, used to skip songs
+        which cannot match (optional)
+        :type trigram_index: TrigramIndex
+        """
+        positions = None
+        if trigram_index is not None:
+            positions = self.tree.candidates(trigram_index)
+        predicate = self._predicate
+        if positions is None:
+            for n, song in enumerate(index):
+                if predicate(song):
+                    yield n
+        else:
+            for n in positions:
+                if predicate(index[n]):
+                    yield n
+
+    def search(self, index, trigram_index=None):
+        """
+        Return the positions of every song in index which matches the query,
+        in index order (see iter_search()).
+        """
+        return list(self.iter_search(index, trigram_index))
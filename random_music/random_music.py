@@ -11,19 +11,56 @@ License: BSD License
 from __future__ import with_statement
 import os
 import sys
-import glob
-from stat import ST_MTIME
+import errno
+import socket
 from socket import gethostname
-from random import randint
-import subprocess
+import hashlib
+from random import Random
 import datetime
 import time
+import cProfile
+from collections import deque
+from itertools import izip
 from ConfigParser import (ConfigParser, NoOptionError, NoSectionError,
                          MissingSectionHeaderError, RawConfigParser)
 from optparse import OptionParser
 
 from utils import which
-from _exceptions import DirectoryNotFoundError, MissingConfigFileError
+from index import (INDEX_FORMATS, MANIFEST_FILE, NO_TAGS, TEXT_FORMAT,
+                   BINARY_FORMAT, open_index, current_index_file,
+                   has_full_text, index_files, index_files_of_format,
+                   open_search_index, open_search_view, open_tags,
+                   read_manifest, remove_old_index_files, shard_digest,
+                   shard_file, write_index, write_manifest, export_text)
+from trigrams import build_trigram_index, trigram_file
+from query import Query
+from export import EXPORT_FORMATS, M3U_FORMAT, export_playlist
+from selection import (PERMUTATION_SHUFFLE, RANDOM_SHUFFLE, SHUFFLE_MODES,
+                       SHUFFLE_STATE_FILE, WEIGHTED_SHUFFLE, Permutation,
+                       load_shuffle_state, save_shuffle_state,
+                       select_from_index, select_songs)
+from weights import MAX_RATING, SONG_STATS_FILE, SongStats, WeightedSampler
+from history import (DEFAULT_NO_REPEAT_TRACKS, HISTORY_FILE, MAX_REPICKS,
+                     PLAY_EVENT, SKIP_EVENT, HistoryLog, RecentWindow,
+                     song_key)
+from player import PLAYBACK_MODES, SIMPLE_MODE, make_player
+from daemon import IndexServer, RemoteIndex, connect
+from library import Library
+from controller import PlaybackController, Track, send_command
+from scanner import (DirectoryState, DIR_STATE_FILE, DEFAULT_SCAN_WORKERS,
+                     scan_dirs)
+from songtable import SongTable
+from tags import (DEFAULT_TAG_WORKERS, TAG_CACHE_FILE, TagCache,
+                  audio_files, check_files, examine_files)
+from watcher import PollingWatcher, make_watcher
+from duplicates import (HASH_CACHE_FILE, HashCache, duplicates_file,
+                        find_duplicates, load_duplicates, write_duplicates)
+from prefetch import (CACHE_DIR, DEFAULT_PREFETCH_TRACKS, Prefetcher,
+                      TrackCache)
+from profiling import NULL_PROFILER, PROFILE_FORMATS, Profiler, timed
+from validate import find_missing
+from _exceptions import (DirectoryNotFoundError, MissingConfigFileError,
+                         QuerySyntaxError)
 
 __author__ = "Caoilte Guiry"
 __copyright__ = "Copyright (c) 2013 Caoilte Guiry."
@@ -40,6 +77,42 @@ PATHNAME = os.path.abspath(PATHNAME)
 DEFAULT_HOME_DIR = os.path.join(os.path.expanduser("~"), ".random_music") 
 DEFAULT_CONFIG_FILE = os.path.join(DEFAULT_HOME_DIR, "config.txt")
 DEFAULT_MUSIC_CLIENT = "mplayer"
+# The daemon's and controller's sockets are named after the index they use
+# (see daemon_socket_file() and control_socket_file())
+SOCKET_FILE_FORMAT = "%s_%s.sock"
+
+def daemon_socket_file(home_dir, index_dir):
+    """
+    Return the path of the socket of the daemon serving the index in
+    index_dir, so that processes using different config files (and so
+    different indexes) never talk to each other's daemons. The name is a
+    digest of the path, as socket paths are limited to around 100 bytes.
+
+    :param home_dir: directory to keep the socket in
+    :type home_dir: str
+    :param index_dir: the index directory from the config file
+    :type index_dir: str
+    """
+    return _socket_file(home_dir, "daemon", index_dir)
+
+
+def control_socket_file(home_dir, index_dir):
+    """
+    Return the path of the control socket of a music --control process
+    playing from the index in index_dir (see daemon_socket_file()).
+
+    :param home_dir: directory to keep the socket in
+    :type home_dir: str
+    :param index_dir: the index directory from the config file
+    :type index_dir: str
+    """
+    return _socket_file(home_dir, "control", index_dir)
+
+
+def _socket_file(home_dir, name, index_dir):
+    digest = hashlib.md5(os.path.abspath(index_dir)).hexdigest()[:12]
+    return os.path.join(home_dir, SOCKET_FILE_FORMAT % (name, digest))
+
 
 def main():
     """
@@ -49,6 +122,9 @@ def main():
     parser.add_option("-u", "--update-index", action="store_true", 
                 dest="update_index", default=False, 
                 help="Update index file")
+    parser.add_option("--full-update", action="store_true",
+                dest="full_update", default=False,
+                help="Update index file, rescanning every directory")
     parser.add_option("-r", "--randomise", action="store_true", 
                 dest="force_randomise", default=False, 
                 help="Force randomisation when using search terms.") 
@@ -58,27 +134,165 @@ def main():
     #           help="Loop playlist")
     parser.add_option("-l", "--list-only", action="store_true",
                 dest="list_only", default=False, help="List songs only") 
+    parser.add_option("-o", "--output", dest="output",
+                help="Write the playlist to a file instead of playing it")
+    parser.add_option("-f", "--format", dest="format", default=M3U_FORMAT,
+                type="choice", choices=sorted(EXPORT_FORMATS),
+                help="Playlist format for --list-only and --output: %s "
+                     "(default %s)" % (", ".join(sorted(EXPORT_FORMATS)),
+                                       M3U_FORMAT))
     parser.add_option("-c", "--config_file",
                 dest="config_file", help="Configuration file", default=DEFAULT_CONFIG_FILE)
     parser.add_option("-n", "--num-songs",
             dest="num_songs", help="Number of songs to generate/play")
+    parser.add_option("--seed", dest="seed", type="int",
+                help="Seed for randomisation, to get the same random "
+                     "playlist again")
+    parser.add_option("--rate", dest="rate", type="int",
+                help="Rate the songs matching the search terms from 0 to %d "
+                     "(used by the weighted shuffle mode)" % MAX_RATING)
+    parser.add_option("--export-index", dest="export_index",
+                help="Export the index to a text file, one song per line")
+    parser.add_option("--duplicates", action="store_true", dest="duplicates",
+                default=False,
+                help="List the duplicate songs left out of the index, under "
+                     "the copies which were kept")
+    parser.add_option("--validate", action="store_true", dest="validate",
+                default=False,
+                help="Check that every song in the index still exists, and "
+                     "remove those which don't from the index")
+    parser.add_option("--daemon", action="store_true", dest="daemon",
+                default=False,
+                help="Keep the index loaded and serve it to other music "
+                     "processes, which will then start more quickly")
+    parser.add_option("--no-daemon", action="store_false", dest="use_daemon",
+                default=True, help="Do not use a running daemon")
+    parser.add_option("--watch", action="store_true", dest="watch",
+                default=False,
+                help="Watch the music directories, updating the index as "
+                     "they change")
+    parser.add_option("--control", action="store_true", dest="control",
+                default=False,
+                help="Play songs while taking commands (skip, pause, queue, "
+                     "quit) from the terminal and from --send")
+    parser.add_option("--send", dest="send", metavar="COMMAND",
+                help="Send a command to music running with --control")
+    parser.add_option("--profile", dest="profile", type="choice",
+                choices=PROFILE_FORMATS,
+                help="Time each stage, and report the times on exit as %s" %
+                     " or ".join(PROFILE_FORMATS))
+    parser.add_option("--cprofile", dest="cprofile",
+                help="Profile the run with cProfile, saving the stats to a "
+                     "file (for reading with the pstats module)")
 
 
     (options, args) = parser.parse_args()
-    
+
+    if options.profile:
+        profiler = Profiler()
+    else:
+        profiler = NULL_PROFILER
+    if options.cprofile:
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+    try:
+        run(parser, options, args, profiler)
+    finally:
+        if options.cprofile:
+            cprofiler.disable()
+            cprofiler.dump_stats(options.cprofile)
+        if options.profile:
+            profiler.report(sys.stderr, options.profile)
+
+
+def run(parser, options, args, profiler=NULL_PROFILER):
+    """
+    Generate a playlist and do what the user args asked with it.
+
+    :param parser: the parser args were parsed with
+    :type parser: OptionParser
+    :param options: parsed options
+    :type options: optparse.Values
+    :param args: search terms
+    :type args: list[str]
+    :param profiler: profiler to time each stage with
+    :type profiler: profiling.Profiler
+    """
+    if options.send:
+        # The control socket is named after the index the controller plays
+        # from, so only the config file needs reading
+        config = ConfigParser()
+        if not config.read(options.config_file):
+            parser.error("The config file '%s' could not be found" %
+                         options.config_file)
+        try:
+            index_dir = config.get("config", "index_dir")
+        except (NoSectionError, NoOptionError), err:
+            parser.error(str(err))
+        try:
+            sys.stdout.write(send_command(
+                control_socket_file(DEFAULT_HOME_DIR, index_dir),
+                options.send))
+        except socket.error, err:
+            sys.stderr.write("Could not send command: %s\n" % err)
+            sys.exit(1)
+        return
+    if options.rate is not None:
+        # Check before going to the trouble of finding the songs
+        if not 0 <= options.rate <= MAX_RATING:
+            parser.error("--rate must be from 0 to %d" % MAX_RATING)
+        if not args:
+            parser.error("--rate needs search terms")
+
     # Try to create a playlist. 
     have_playlist = False
     while not have_playlist:    
         try:        
             rmp = RandomMusicPlaylist(config_file=options.config_file, search_terms=args, update_index=options.update_index, 
+                                      full_update=options.full_update,
                                       force_randomise=options.force_randomise, 
-                                      list_only=options.list_only, num_songs=options.num_songs)
+                                      list_only=options.list_only or bool(options.output),
+                                      num_songs=options.num_songs, seed=options.seed,
+                                      use_daemon=options.use_daemon and not options.daemon,
+                                      profiler=profiler)
             have_playlist = True
         except MissingConfigFileError, err_msg:
             sys.stderr.write("%s\n" % err_msg)
             create_config_file(options.config_file, 
                                DEFAULT_HOME_DIR)
+        except QuerySyntaxError, err_msg:
+            sys.stderr.write("%s\n" % err_msg)
+            sys.exit(1)
     
+    if options.daemon:
+        rmp.serve()
+        return
+    if options.watch:
+        rmp.watch()
+        return
+    if options.export_index:
+        rmp.export_index(options.export_index)
+        return
+    if options.duplicates:
+        rmp.list_duplicates()
+        return
+    if options.validate:
+        rmp.validate_index()
+        return
+    if options.rate is not None:
+        rmp.rate_songs(options.rate)
+        return
+    if rmp.list_only:
+        try:
+            rmp.export_playlist(options.output, options.format)
+        except IOError, err:
+            # e.g. when piped into head
+            if err.errno != errno.EPIPE:
+                raise
+        return
+    if options.control:
+        rmp.control_music()
+        return
     rmp.play_music()
 
 
@@ -100,6 +314,8 @@ def create_config_file(config_file, random_music_home):
     config.set('config', 'randomise', 'true')
     config.set('config', 'index_dir', os.path.join(random_music_home, 
                                                    "indicies"))
+    config.set('config', 'scan_workers', str(DEFAULT_SCAN_WORKERS))
+    config.set('config', 'index_format', BINARY_FORMAT)
     music_client = DEFAULT_MUSIC_CLIENT
     while not which(music_client):
         music_client = raw_input("The music player '%s' could not be found "
@@ -107,6 +323,14 @@ def create_config_file(config_file, random_music_home):
                                    "music player:" % music_client)   
     
     config.set('config', 'music_client', music_client) 
+    config.set('config', 'playback_mode', SIMPLE_MODE)
+    config.set('config', 'shuffle_mode', PERMUTATION_SHUFFLE)
+    config.set('config', 'no_repeat_tracks', str(DEFAULT_NO_REPEAT_TRACKS))
+    config.set('config', 'no_repeat_hours', '0')
+    config.set('config', 'remove_duplicates', 'true')
+    # Set to cache upcoming songs locally, e.g. for music on network mounts
+    config.set('config', 'cache_size_mb', '0')
+    config.set('config', 'prefetch_tracks', str(DEFAULT_PREFETCH_TRACKS))
 
     user_music_dirs = ""
     while not all([os.path.isdir(d) for d in user_music_dirs.split(",")]):
@@ -130,12 +354,35 @@ def check_is_dir(path):
         raise DirectoryNotFoundError(path)
 
 
+def get_config_option(config, option, default, getter="get"):
+    """
+    Get an optional option from the config section of a config file, falling
+    back to a default if it has not been set (config files created by older
+    versions will not have it).
+
+    :param config: the parsed config file
+    :type config: ConfigParser
+    :param option: name of the option
+    :type option: str
+    :param default: value to return if the option has not been set
+    :param getter: name of the ConfigParser method used to get the value,
+    e.g. "getint" or "getboolean"
+    :type getter: str
+    """
+    try:
+        return getattr(config, getter)("config", option)
+    except NoOptionError:
+        return default
+
+
 class RandomMusicPlaylist(object):
     """
     Generate and play random music playlists.
     """
     def __init__(self, config_file, search_terms=None, update_index=False, 
-                                  force_randomise=False, list_only=False, num_songs=None):
+                                  force_randomise=False, list_only=False, num_songs=None,
+                                  full_update=False, use_daemon=True, seed=None,
+                                  profiler=NULL_PROFILER):
         """
         :param config_file: path to configuration file (optional)
         :type config_file: str
@@ -153,11 +400,25 @@ class RandomMusicPlaylist(object):
         sequence); this option, when set to true, will randomise in spite of 
         the method of invocation.
         :type force_randomise: bool
-        :param list_only: if set to true, we do not play any songs, just list them.
+        :param list_only: if set to true, we do not play any songs, just list
+        them (see export_playlist()).
         :type list_only: bool
         :param num_songs: Number of songs to generate (defaults to all found)
         :type num_songs: int
+        :param full_update: if set to true, update the songs index by rescanning
+        every directory, rather than only those which have changed.
+        :type full_update: bool
+        :param use_daemon: if set to true, and an index daemon is running, get
+        songs from the daemon rather than loading the index ourselves.
+        :type use_daemon: bool
+        :param seed: seed for randomisation (optional). In the permutation
+        shuffle mode, a shuffle is resumed where it left off unless a seed is
+        given.
+        :type seed: int
+        :param profiler: profiler to time each stage with (optional)
+        :type profiler: profiling.Profiler
         """
+        self.profiler = profiler
         self.random_music_home = DEFAULT_HOME_DIR
         if not os.path.isdir(self.random_music_home):
             os.makedirs(self.random_music_home)
@@ -170,8 +431,11 @@ class RandomMusicPlaylist(object):
             self.search_terms = []
             
         self.update_index = update_index
+        self.full_update = full_update
         self.force_randomise = force_randomise
         self.list_only = list_only
+        self.seed = seed
+        self.rng = Random(seed)
             
         try:                                                                         
             self.num_songs = int(num_songs)                                          
@@ -181,12 +445,41 @@ class RandomMusicPlaylist(object):
                                                                              
 
 
+        self.daemon = None
+
         self.load_config()
         self.process_flags()
-        self.index_file = self.get_index_file()
+        self.socket_file = daemon_socket_file(self.random_music_home,
+                                              self.index_dir)
+        self.control_socket_file = control_socket_file(self.random_music_home,
+                                                       self.index_dir)
+        if use_daemon:
+            with profiler.timer("connect_daemon"):
+                self.daemon = connect(self.socket_file)
+        if self.daemon is not None:
+            if self.update_index or self.full_update:
+                self.daemon.reload()
+            self.index_file = self.daemon.info()["index_file"]
+        else:
+            self.index_file = self.get_index_file()
         self.generate_list()
+        with profiler.timer("load_stats"):
+            self.song_stats = SongStats(os.path.join(self.random_music_home,
+                                                     SONG_STATS_FILE))
+        self.sampler = None
+        self.permutation = None
+        self.history = None
+        self.recent = None
+        # Songs found to be missing as they came up to play
+        self.missing_songs = set()
+        with profiler.timer("init_shuffle"):
+            if self.randomise and self.shuffle_mode == PERMUTATION_SHUFFLE:
+                self._init_permutation()
+            elif self.randomise and self.shuffle_mode == WEIGHTED_SHUFFLE:
+                self.sampler = WeightedSampler(self.songs, self.song_stats)
 
 
+    @timed("load_config")
     def load_config(self):
         """
         Load configuration variables from config file.
@@ -205,6 +498,33 @@ class RandomMusicPlaylist(object):
             # create_config_file() does not take account of this at the
             # moment. TODO: implement this
             self.music_dirs = config.get("config", "music_dirs").split(",") 
+            self.scan_workers = get_config_option(config, "scan_workers",
+                                                  DEFAULT_SCAN_WORKERS,
+                                                  "getint")
+            self.tag_workers = get_config_option(config, "tag_workers",
+                                                 DEFAULT_TAG_WORKERS,
+                                                 "getint")
+            self.index_format = get_config_option(config, "index_format",
+                                                  TEXT_FORMAT)
+            self.playback_mode = get_config_option(config, "playback_mode",
+                                                   SIMPLE_MODE)
+            self.shuffle_mode = get_config_option(config, "shuffle_mode",
+                                                  RANDOM_SHUFFLE)
+            self.no_repeat_tracks = get_config_option(config,
+                                                      "no_repeat_tracks", 0,
+                                                      "getint")
+            self.no_repeat_hours = get_config_option(config,
+                                                     "no_repeat_hours", 0,
+                                                     "getfloat")
+            self.remove_duplicates = get_config_option(config,
+                                                       "remove_duplicates",
+                                                       False, "getboolean")
+            self.cache_size_mb = get_config_option(config, "cache_size_mb",
+                                                   0, "getfloat")
+            self.prefetch_tracks = get_config_option(config,
+                                                     "prefetch_tracks",
+                                                     DEFAULT_PREFETCH_TRACKS,
+                                                     "getint")
         except NoOptionError:
             sys.stderr.write("No such option in config file\n")
             sys.exit(1)
@@ -214,6 +534,19 @@ class RandomMusicPlaylist(object):
         except MissingSectionHeaderError:
             sys.stderr.write("Failed to parse config file\n")
             sys.exit(1)
+
+        if self.index_format not in INDEX_FORMATS:
+            sys.stderr.write("Unknown index_format '%s' in config file\n" %
+                             self.index_format)
+            sys.exit(1)
+        if self.playback_mode not in PLAYBACK_MODES:
+            sys.stderr.write("Unknown playback_mode '%s' in config file\n" %
+                             self.playback_mode)
+            sys.exit(1)
+        if self.shuffle_mode not in SHUFFLE_MODES:
+            sys.stderr.write("Unknown shuffle_mode '%s' in config file\n" %
+                             self.shuffle_mode)
+            sys.exit(1)
         
         # Verify that our music dirs are actually dirs
         for i, path in enumerate(self.music_dirs):
@@ -229,6 +562,9 @@ class RandomMusicPlaylist(object):
                                  "your config file. Please note that directories must "
                                  "not contain commas as these are used as a " 
                                  "delimiter\n" % path)
+        # Longest first, for clean_song_name()
+        self.sorted_music_dirs = sorted(self.music_dirs, key=len,
+                                        reverse=True)
         
         if not os.path.isdir(self.index_dir):
             sys.stdout.write("Creating indicies path %s\n" % self.index_dir)
@@ -236,6 +572,7 @@ class RandomMusicPlaylist(object):
             self._update_index()
 
 
+    @timed("process_flags")
     def process_flags(self):
         """
         Process command-line arguments and options.
@@ -249,97 +586,681 @@ class RandomMusicPlaylist(object):
         elif self.search_terms:
             self.randomise = False
         
-        if self.update_index:
-            self._update_index()
+        if self.update_index or self.full_update:
+            self._update_index(full=self.full_update)
             
         if self.list_only:
-            self.music_client = "echo"  # FIXME: unix-only!
             self.loop_songs = False
       
+    @timed("parse_search_terms")
     def parse_search_terms(self, search_terms):
         """
-        Convert search terms to a list (or a list of lists for OR 
-        searches).
+        Compile search terms into a query (see the query module for the
+        syntax). If there are no search terms, the query is None.
 
         :param search_terms: terms against which files will be matched
         :type search_terms: list[str]
         """
-        # v. kludgish.. TODO: do this a little more gracefully
-        self.search_terms, b = [], []
-        for index, st in enumerate(search_terms):
-            if st == "OR":
-                self.search_terms.append(b)
-                b = []
-            else:
-                b.append(st)
-
-            if index+1 == len(search_terms):
-                self.search_terms.append(b)
+        if search_terms:
+            self.query = Query(search_terms)
+        else:
+            self.query = None
    
-    def _update_index(self):
+    @timed("update_index")
+    def _update_index(self, full=False, changed_dirs=None):
         """
-        Update the index file.
+        Update the index, writing a shard for each music directory whose
+        songs have changed, and then a manifest of the current shards (see
+        the index module). Only directories which have changed since the
+        last update are rescanned, unless full is set. Only audio files are
+        indexed, along with their tags; files which haven't changed since
+        the last update are not read again. With remove_duplicates set,
+        only the first copy of each song is indexed (see the duplicates
+        module).
+
+        When the directories which have changed are already known (from
+        watch(), say), pass them as changed_dirs: only they are relisted,
+        and only the files within them are read again.
+
+        :param full: rescan every directory
+        :type full: bool
+        :param changed_dirs: the only directories which may have changed
+        :type changed_dirs: set[str]
         """
         start_time = datetime.datetime.now()
         sys.stdout.write("Updating index. Depending on the size of your music "
                          "collection this may take some time, so please be patient. "
                          "(Update started at %s)\n" % start_time)
-        new_index_file = "%s/music_index_%s.txt" % (self.index_dir,
-                        start_time.strftime("%Y%m%d_%H%M%S"))
-        files = (os.path.join(tup[0], f) for d in self.music_dirs 
-                                         for tup in os.walk(d) 
-                                         for f in tup[2] )
-        
-        with open(new_index_file, "w") as fh:
-            for filename in files:
-                fh.write("%s\n" % filename)
+        generation = start_time.strftime("%Y%m%d_%H%M%S_%f")
+        manifest_file = os.path.join(self.index_dir, MANIFEST_FILE)
+        state_file = os.path.join(self.index_dir, DIR_STATE_FILE)
+        tag_cache_file = os.path.join(self.index_dir, TAG_CACHE_FILE)
+        if full:
+            old_state = changed_dirs = None
+            tag_cache = TagCache()
+        else:
+            old_state = DirectoryState.load(state_file)
+            tag_cache = TagCache.load(tag_cache_file)
+        profiler = self.profiler
+        with profiler.timer("update_index.scan_dirs"):
+            state = scan_dirs(self.music_dirs, old_state, self.scan_workers,
+                              changed_dirs)
+        changed_files = None
+        if changed_dirs is not None:
+            changed_files = set(os.path.join(path, name)
+                                for path in changed_dirs
+                                if path in state.entries
+                                for name in state.entries[path][1])
+
+        # (root, songs, tags) for each music directory
+        roots = []
+        new_tag_cache = TagCache()
+        with profiler.timer("update_index.scan_files"):
+            root_files = [(root, list(state.iter_files([root])))
+                          for root in self.music_dirs]
+            # Only new and changed files are examined, all in the one pool
+            pending = check_files((path for _, files in root_files
+                                   for path in files),
+                                  tag_cache, new_tag_cache, changed_files)
+            examine_files(pending, new_tag_cache, self.tag_workers)
+            for root, files in root_files:
+                songs, song_tags = [], []
+                for song, tags in audio_files(files, new_tag_cache):
+                    songs.append(song)
+                    song_tags.append(tags)
+                roots.append((root, songs, song_tags))
+        duplicates = {}
+        if self.remove_duplicates:
+            hash_cache_file = os.path.join(self.index_dir, HASH_CACHE_FILE)
+            if full:
+                hash_cache = HashCache()
+            else:
+                hash_cache = HashCache.load(hash_cache_file)
+            new_hash_cache = HashCache()
+            entries = new_tag_cache.entries
+            with profiler.timer("update_index.duplicates"):
+                duplicates = find_duplicates(
+                    [(song, entries[song][0], entries[song][1])
+                     for _, songs, _ in roots for song in songs],
+                    hash_cache, new_hash_cache, self.tag_workers)
+            new_hash_cache.save(hash_cache_file)
+        # Copies are recorded against the shard of the song kept
+        alternates = dict((root, {}) for root, _, _ in roots)
+        root_of = {}
+        for root, songs, _ in roots:
+            for song in songs:
+                root_of.setdefault(song, root)
+        for _, songs, _ in roots:
+            for song in songs:
+                if song in duplicates:
+                    kept = duplicates[song]
+                    alternates[root_of[kept]].setdefault(kept,
+                                                         []).append(song)
+
+        old_manifest = read_manifest(manifest_file)
+        old_shards = {}
+        if old_manifest is not None and not full and \
+                old_manifest["format"] == self.index_format:
+            old_shards = dict((shard["root"], shard)
+                              for shard in old_manifest["shards"])
+        shards = []
+        num_songs = num_written = 0
+        for root, songs, song_tags in roots:
+            if duplicates:
+                kept = [n for n, song in enumerate(songs)
+                        if song not in duplicates]
+                songs = [songs[n] for n in kept]
+                song_tags = [song_tags[n] for n in kept]
+            num_songs += len(songs)
+            digest = shard_digest(songs, song_tags, alternates[root])
+            shard = old_shards.get(root)
+            if shard is None or shard["digest"] != digest or \
+                    not os.path.isfile(os.path.join(self.index_dir,
+                                                    shard["file"])):
+                path = shard_file(self.index_dir, generation, root,
+                                  self.index_format)
+                self._write_shard(path, songs, song_tags, alternates[root])
+                shard = {"root": root, "file": os.path.basename(path),
+                         "songs": len(songs), "digest": digest}
+                num_written += 1
+            shards.append(shard)
+        with profiler.timer("update_index.remove_old"):
+            num_removed = self._swap_manifest(self.index_format, shards,
+                                              old_manifest)
+        state.save(state_file)
+        new_tag_cache.save(tag_cache_file)
+        self.index_file = manifest_file
+        num_duplicates = len(duplicates)
+        profiler.count("update_index.dirs_rescanned", state.listed)
+        profiler.count("update_index.dirs_unchanged", state.reused)
+        profiler.count("update_index.files_examined", new_tag_cache.examined)
+        profiler.count("update_index.files_unchanged", new_tag_cache.reused)
+        profiler.count("update_index.songs", num_songs)
+        profiler.count("update_index.duplicate_songs", num_duplicates)
+        profiler.count("update_index.shards_written", num_written)
+        profiler.count("update_index.shards_unchanged",
+                       len(shards) - num_written)
+        profiler.count("update_index.old_files_removed", num_removed)
             
         end_time = datetime.datetime.now()
-        sys.stdout.write("Music index updated (created index file '%s')\n" 
+        sys.stdout.write("Music index updated (manifest '%s')\n"
+                         "Shards written: %d, unchanged: %d\n"
+                         "Directories rescanned: %d, unchanged: %d\n"
+                         "Files examined: %d, unchanged: %d\n"
+                         "Duplicate songs left out: %d\n"
+                         "Old index files removed: %d\n"
                          "Update duration:%s\n" % 
-                         (new_index_file, end_time - start_time))
+                         (manifest_file, num_written, len(shards) - num_written,
+                          state.listed, state.reused,
+                          new_tag_cache.examined, new_tag_cache.reused,
+                          num_duplicates, num_removed,
+                          end_time - start_time))
+        return state
+
+    def _swap_manifest(self, fmt, shards, old_manifest):
+        """
+        Replace the manifest, and remove the index files no longer needed,
+        returning the number of files removed.
+
+        :param fmt: format of the shards, one of INDEX_FORMATS
+        :type fmt: str
+        :param shards: the new shards (see index.read_manifest)
+        :type shards: list[dict]
+        :param old_manifest: the manifest being replaced, if any
+        :type old_manifest: dict
+        """
+        write_manifest(os.path.join(self.index_dir, MANIFEST_FILE), fmt,
+                       shards)
+        # Readers which opened the old manifest just before it was replaced
+        # may still be opening its shards, so they're kept until next time
+        keep = [shard["file"] for shard in shards]
+        if old_manifest is not None:
+            keep.extend(shard["file"] for shard in old_manifest["shards"])
+        return remove_old_index_files(self.index_dir, keep)
+
+    def _remove_songs(self, songs):
+        """
+        Remove songs from the index without rescanning the music
+        directories: the shards holding them are rewritten without them (or
+        with one of their copies in their place, if they were left in the
+        index in place of copies which are still there), and a new manifest
+        swapped in. Returns the number of songs removed (none
+        for an index last updated before indexes were sharded, which can't
+        be rewritten in part).
+
+        :param songs: paths of the songs to remove
+        :type songs: set
+        """
+        manifest = read_manifest(os.path.join(self.index_dir, MANIFEST_FILE))
+        if manifest is None:
+            return 0
+        generation = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        shards = []
+        num_removed = 0
+        for shard in manifest["shards"]:
+            path = os.path.join(self.index_dir, shard["file"])
+            index = open_index(path)
+            try:
+                shard_songs = list(index)
+                kept = [n for n, song in enumerate(shard_songs)
+                        if song not in songs]
+                if len(kept) == len(shard_songs):
+                    shards.append(shard)
+                    continue
+                tag_table = open_tags(index)
+                if tag_table is not None:
+                    song_tags = list(tag_table)
+                    tag_table.close()
+                else:
+                    song_tags = [NO_TAGS] * len(shard_songs)
+            finally:
+                index.close()
+            num_removed += len(shard_songs) - len(kept)
+            alternates = {}
+            for song, copies in load_duplicates(path).iteritems():
+                copies = [copy for copy in copies if copy not in songs]
+                if copies:
+                    alternates[song] = copies
+            # A removed song with a copy left is replaced by the copy (which
+            # has the same tags, being identical), and its other copies are
+            # recorded against that.
+            new_songs, new_tags = [], []
+            for song, tags in izip(shard_songs, song_tags):
+                if song in songs:
+                    copies = alternates.pop(song, None)
+                    if not copies:
+                        continue
+                    song = copies[0]
+                    if copies[1:]:
+                        alternates[song] = copies[1:]
+                new_songs.append(song)
+                new_tags.append(tags)
+            shard_songs, song_tags = new_songs, new_tags
+            new_path = shard_file(self.index_dir, generation, shard["root"],
+                                  manifest["format"])
+            self._write_shard(new_path, shard_songs, song_tags, alternates)
+            shards.append({"root": shard["root"],
+                           "file": os.path.basename(new_path),
+                           "songs": len(shard_songs),
+                           "digest": shard_digest(shard_songs, song_tags,
+                                                  alternates)})
+        if num_removed:
+            self._swap_manifest(manifest["format"], shards, manifest)
+        return num_removed
+
+    def validate_index(self):
+        """
+        Check that every song in the index still exists (see the validate
+        module), and remove those which don't from the index.
+        """
+        index = open_index(self.index_file)
+        try:
+            with self.profiler.timer("validate"):
+                missing = set(index[n] for n in
+                              find_missing(index, self.scan_workers))
+            num_songs = len(index)
+        finally:
+            index.close()
+        for song in sorted(missing):
+            sys.stdout.write("Missing: %s\n" % song)
+        num_removed = self._remove_songs(missing)
+        sys.stdout.write("%d of %d songs missing, %d removed from the index\n"
+                         % (len(missing), num_songs, num_removed))
+        if len(missing) > num_removed:
+            sys.stdout.write("Run music -u to remove the rest\n")
+        if num_removed and self.daemon is not None:
+            self.daemon.reload()
+
+    def _write_shard(self, path, songs, song_tags, alternates):
+        """
+        Write a shard, along with its alternates file and, unless it can
+        search itself, its trigram index.
+
+        :param path: path to the shard
+        :type path: str
+        :param songs: song paths to write
+        :type songs: list[str]
+        :param song_tags: tags for each song
+        :type song_tags: list[Tags]
+        :param alternates: mapping of songs to their copies left out
+        :type alternates: dict
+        """
+        profiler = self.profiler
+        with profiler.timer("update_index.write"):
+            write_index(path, songs, song_tags)
+            write_duplicates(duplicates_file(path), alternates)
+        shard = open_index(path)
+        if not has_full_text(shard):
+            with profiler.timer("update_index.trigrams"):
+                search_view = open_search_view(shard)
+                build_trigram_index(trigram_file(path), search_view)
+                if search_view is not shard:
+                    search_view.close()
+        shard.close()
     
+    @timed("get_index_file")
     def get_index_file(self):
         """
-        Get the most up-to-date index file.
+        Get the index's manifest (or for an index last updated before
+        indexes were sharded, the most up-to-date index file).
         """
-        entries = sorted((os.stat(index_file)[ST_MTIME], index_file) 
-                        for index_file in glob.glob(self.index_dir+"/*.txt"))
-        if len(entries) == 0:
+        self.profiler.count("get_index_file.candidates",
+                            len(index_files_of_format(self.index_dir,
+                                                      self.index_format)))
+        index_file = current_index_file(self.index_dir, self.index_format)
+        if index_file is None:
             raise Exception("Missing index file. "
                             "Try running program with -u flag")
-        return entries[-1][-1]
+        return index_file
     
+    @timed("generate_list")
     def generate_list(self):
         """
-        Open the index file and generate a list of songs.
+        Open the index file and generate a list of songs. Without search
+        terms, the index itself is used as the list of songs, so a binary
+        index is never read into memory. If a daemon is running, the index
+        is not opened at all; songs are fetched from the daemon as needed.
+
+        If num_songs was given, only that many songs are kept: the first
+        num_songs matches in sequential mode (the search stops there), or a
+        random subset of the matches in random mode.
         """
-        with open(self.index_file, "r") as fh:
-            original_songs = [line.rstrip() for line in fh.readlines()]
+        profiler = self.profiler
+        # A random subset is a different playlist every time (see
+        # _init_permutation())
+        self.random_subset = bool(self.num_songs) and self.randomise
+        if self.daemon is not None:
+            self.index = RemoteIndex(self.daemon)
+        else:
+            with profiler.timer("generate_list.open_index"):
+                self.index = open_index(self.index_file)
         
-        if self.search_terms:
+        if self.query is not None and self.daemon is not None:
+            self.songs = SongTable(self.daemon.search(self.search_terms,
+                                                      self.num_songs,
+                                                      self.randomise,
+                                                      self.seed))
+        elif self.query is not None:
             # refine using search terms
-            self.songs = []
-            for st in self.search_terms:
-                refined_songs = original_songs
-                for s in st:
-                    refined_songs = [song for song in refined_songs 
-                                        if s.lower() in song.lower()]
-                self.songs += sorted(refined_songs)
+            with profiler.timer("generate_list.open_search_index"):
+                trigram_index = open_search_index(self.index)
+                search_view = open_search_view(self.index)
+            try:
+                matches = (self.index[n] for n in
+                           self.query.iter_search(search_view,
+                                                  trigram_index))
+                with profiler.timer("generate_list.search"):
+                    self.songs = select_songs(matches, self.num_songs,
+                                              self.randomise, self.rng)
+            finally:
+                search_view.close()
+                if trigram_index is not None:
+                    trigram_index.close()
         else:
-            self.songs = original_songs
-        
-        # If we've specified a num_songs, slice out this much
-        if self.num_songs:                                 
-            self.songs[:] = self.songs[:self.num_songs]    
+            with profiler.timer("generate_list.select"):
+                self.songs = select_from_index(self.index, self.num_songs,
+                                               self.randomise, self.rng)
+        self.num_songs = len(self.songs)
+        profiler.count("generate_list.songs", self.num_songs)
+
+
+    def _load_library(self):
+        """
+        Load the latest index file as a Library.
+        """
+        return Library(self.get_index_file())
+
+    def serve(self):
+        """
+        Serve the index to other music processes until interrupted.
+        """
+        server = IndexServer(self.socket_file, self._load_library)
+        sys.stdout.write("Serving %s on %s\n" % (server.library.index_file,
+                                                 self.socket_file))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            sys.stderr.write("\nExiting...\n")
+        finally:
+            server.server_close()
+
+    def watch(self):
+        """
+        Watch the music directories until interrupted, updating the index
+        whenever they change. Changes are applied in batches, once they have
+        settled, and a running daemon is told to reload the index.
+        """
+        state_file = os.path.join(self.index_dir, DIR_STATE_FILE)
+        state = DirectoryState.load(state_file)
+        if not state.entries:
+            state = self._update_index()
+        watcher = make_watcher(self.music_dirs, self.scan_workers)
+        sys.stdout.write("Watching %s\n" % ", ".join(self.music_dirs))
+        try:
+            while True:
+                try:
+                    watcher.update(state)
+                except OSError, err:
+                    if err.errno != errno.ENOSPC:
+                        raise
+                    sys.stderr.write("WARNING: too many directories to "
+                                     "watch (see fs.inotify.max_user_watches"
+                                     "), falling back to polling\n")
+                    watcher.close()
+                    watcher = PollingWatcher(self.music_dirs,
+                                             self.scan_workers)
+                    watcher.update(state)
+                changed = watcher.wait()
+                if changed is not None:
+                    sys.stdout.write("%d directories changed\n" %
+                                     len(changed))
+                state = self._update_index(changed_dirs=changed)
+                if self.daemon is not None:
+                    self.daemon.reload()
+        except KeyboardInterrupt:
+            sys.stderr.write("\nExiting...\n")
+        finally:
+            watcher.close()
+
+    def export_playlist(self, output=None, fmt=M3U_FORMAT):
+        """
+        Write the playlist out instead of playing it. In random mode, every
+        song is written once, in random order.
+
+        :param output: path to write the playlist to (defaults to stdout)
+        :type output: str
+        :param fmt: playlist format, one of export.EXPORT_FORMATS
+        :type fmt: str
+        """
+        if self.randomise:
+            permutation = Permutation(self.num_songs,
+                                      self.rng.getrandbits(64))
+            songs = (self.songs[permutation[n]]
+                     for n in xrange(self.num_songs))
+        else:
+            songs = iter(self.songs)
+        return export_playlist(songs, output, fmt)
+
+    def export_index(self, export_file):
+        """
+        Export the index to a text file, one song per line.
+
+        :param export_file: path to the file to export to
+        :type export_file: str
+        """
+        with open(export_file, "w") as fh:
+            export_text(self.index, fh)
+
+    def list_duplicates(self, fh=sys.stdout):
+        """
+        List the songs left out of the index as duplicates (see
+        remove_duplicates), each indented under the song which was kept.
+
+        :param fh: file to write the list to
+        :type fh: file
+        """
+        alternates = {}
+        for index_file in index_files(self.index_file):
+            alternates.update(load_duplicates(index_file))
+        for song in sorted(alternates):
+            fh.write("%s\n" % song)
+            for alternate in alternates[song]:
+                fh.write("    %s\n" % alternate)
+
+    def _init_permutation(self):
+        """
+        Set up the permutation shuffle, resuming the last shuffle of this
+        playlist unless a seed was given. A playlist of num_songs songs
+        picked at random is not the same playlist from one run to the next,
+        so its shuffle is neither resumed nor saved.
+        """
+        self.shuffle_state_file = os.path.join(self.random_music_home,
+                                               SHUFFLE_STATE_FILE)
+        self.playlist_key = hashlib.md5("\0".join(
+                    [self.index_file, self._index_version(),
+                     str(self.num_songs)] +
+                    list(self.search_terms))).hexdigest()
+        self.save_shuffle = not self.random_subset
+        state = None
+        if self.seed is None and self.save_shuffle:
+            state = load_shuffle_state(self.shuffle_state_file,
+                                       self.playlist_key)
+        if state is not None:
+            seed, position = state
+        else:
+            seed, position = self.rng.getrandbits(64), 0
+        self.permutation = Permutation(self.num_songs, seed)
+        # The position of the last song returned by _get_song_index()
+        self.shuffle_position = position - 1
+        # (song index, seed, position) of each song picked but not yet
+        # started, since songs are picked ahead of playing them
+        self.shuffle_picks = deque()
+
+    def _index_version(self):
+        """
+        Return a string which changes whenever the songs in the index do:
+        the digests of the manifest's shards (the manifest itself keeps the
+        same path from one update to the next), or nothing for an index
+        from before indexes were sharded, whose path changes instead.
+        """
+        if os.path.basename(self.index_file) != MANIFEST_FILE:
+            return ""
+        manifest = read_manifest(self.index_file)
+        if manifest is None:
+            return ""
+        return ",".join(str(shard["digest"])
+                        for shard in manifest["shards"])
+
+    def _next_permutation_index(self):
+        """
+        Get the next song index from the permutation shuffle, starting a new
+        shuffle once every song has been played (or returning None if we
+        don't want to loop songs). Our position is saved once the song
+        starts (see _song_started()).
+        """
+        position = self.shuffle_position + 1
+        if position >= self.num_songs:
+            if not self.loop_songs:
+                return None
+            self.permutation = Permutation(self.num_songs,
+                                           self.rng.getrandbits(64))
+            position = 0
+        self.shuffle_position = position
+        song_index = self.permutation[position]
+        self.shuffle_picks.append((song_index, self.permutation.seed,
+                                   position))
+        return song_index
+
+    def _save_shuffle_position(self, song_index):
+        """
+        Save our place in the permutation shuffle as the song which has just
+        started, so that the next run resumes from it. Picks before it were
+        passed over (their files had gone) and are dropped.
+
+        :param song_index: index of the song which started
+        :type song_index: int
+        """
+        while self.shuffle_picks:
+            picked, seed, position = self.shuffle_picks.popleft()
+            if picked == song_index:
+                if self.save_shuffle:
+                    save_shuffle_state(self.shuffle_state_file,
+                                       self.playlist_key, seed, position)
+                return
+
+    def rate_songs(self, rating):
+        """
+        Rate every song in the playlist.
+
+        :param rating: rating from 0 to weights.MAX_RATING
+        :type rating: int
+        """
+        for song in self.songs:
+            self.song_stats.rate(song, rating)
+        self.song_stats.save()
+        sys.stdout.write("Rated %d songs\n" % self.num_songs)
+
+    def _open_history(self):
+        """
+        Open the play history log, and load the window of recently played
+        songs from its tail.
+        """
+        self.history = HistoryLog(os.path.join(self.random_music_home,
+                                               HISTORY_FILE))
+        self.recent = RecentWindow.from_log(self.history,
+                                            self.no_repeat_tracks,
+                                            self.no_repeat_hours * 3600)
+
+    def _song_started(self, song_index):
+        """
+        Record that a song has started playing.
+        """
+        song = self.songs[song_index]
+        if self.sampler is not None:
+            self.sampler.played(song_index)
         else:
-            self.num_songs = len(self.songs)
+            self.song_stats.played(song)
+        if self.permutation is not None:
+            self._save_shuffle_position(song_index)
+        if self.history is not None:
+            self.history.append(PLAY_EVENT, song)
+            self.recent.add(song_key(song))
 
+    def _song_skipped(self, song_index):
+        """
+        Record that a song was skipped.
+        """
+        song = self.songs[song_index]
+        if self.sampler is not None:
+            self.sampler.skipped(song_index)
+        else:
+            self.song_stats.skipped(song)
+        if self.history is not None:
+            self.history.append(SKIP_EVENT, song)
 
+    def _song_missing(self, song_index):
+        """
+        Record that a song's file has gone, so that it isn't picked again,
+        and is removed from the index once playback stops.
+        """
+        song = self.songs[song_index]
+        if song not in self.missing_songs:
+            self.missing_songs.add(song)
+            self.profiler.count("playback.missing")
+            sys.stderr.write("Missing: %s\n" % song)
+        if self.sampler is not None:
+            self.sampler.exclude(song_index)
+
+    def _remove_missing_songs(self):
+        """
+        Remove the songs found missing during playback from the index.
+        """
+        if not self.missing_songs:
+            return
+        num_removed = self._remove_songs(self.missing_songs)
+        if num_removed:
+            sys.stderr.write("Removed %d missing songs from the index\n" %
+                             num_removed)
+            if self.daemon is not None:
+                self.daemon.reload()
+
+    def _pick_random_index(self):
+        """
+        Pick a song index at random (or take the next index from the
+        permutation shuffle).
+        """
+        if self.shuffle_mode == PERMUTATION_SHUFFLE:
+            return self._next_permutation_index()
+        elif self.sampler is not None:
+            return self.sampler.sample(self.rng)
+        return self.rng.randint(1, self.num_songs) - 1
+
+    def _pick_unrecent_index(self):
+        """
+        Pick a song index at random, avoiding songs played recently (see
+        no_repeat_tracks and no_repeat_hours) where we can. The permutation
+        shuffle never repeats a song within a pass, and passing over its
+        picks would leave those songs out of the pass altogether, so its
+        picks are taken as they come.
+        """
+        song_index = self._pick_random_index()
+        if not self.recent or self.permutation is not None:
+            return song_index
+        self.recent.expire()
+        for _ in xrange(MAX_REPICKS):
+            if (song_index is None or
+                    song_key(self.songs[song_index]) not in self.recent):
+                break
+            self.profiler.count("pick_song.repicks")
+            song_index = self._pick_random_index()
+        return song_index
+
+    @timed("pick_song")
     def _get_song_index(self, song_index):
         """
         Get the next song index. If we are in random mode, we generate a
-        random index, otherwise we increment the index. However, we want
+        random index (or take the next index from the permutation shuffle),
+        otherwise we increment the index. However, we want
         to reset the index to 0 if we've reached the end, or exit if 
         we've specified that we don't want to loop songs.
 
@@ -347,7 +1268,7 @@ class RandomMusicPlaylist(object):
         :type song_index: int
         """ 
         if self.randomise:
-            song_index = randint(1, self.num_songs) - 1
+            song_index = self._pick_unrecent_index()
         else:
             if (song_index + 1) == self.num_songs:
                 if self.loop_songs:
@@ -364,7 +1285,6 @@ class RandomMusicPlaylist(object):
         """
         Begin an infinite loop of songs.
         """
-        song_index = -1
         if self.num_songs  == 0:
             sys.stdout.write("No songs found\n")
             sys.exit(0)
@@ -374,34 +1294,213 @@ class RandomMusicPlaylist(object):
         sys.stdout.write("Press ctrl+c once to skip a song\n")
         sys.stdout.write("Hold ctrl+c to exit\n")
         sys.stdout.write("%d files found.\n" % self.num_songs)
-        while True:
-            try:
-                song_index = self._get_song_index(song_index)
-                if song_index == None:
-                    sys.exit(0)
+        player = make_player(self.playback_mode, self.music_client,
+                             self.profiler)
+        self._open_history()
+        prefetcher = self._open_prefetcher()
+        # When the last song finished, for timing the gap before the next
+        last_finished = None
+        try:
+            for song_index, upcoming in self._iter_songs(prefetcher):
                 song = self.songs[song_index]
-                sys.stdout.write("%s\n" % song)
-                
-                # Disabled the following as it got pretty annoying seeing a 
-                # torrent of notifications for non-music files (mplayer 
-                # gracefully skips these).            
-                #try:
-                #    notify_cmd="notify-send  -t 1000 '%s'" % \
-                #                song.split("/")[-1]
-                #    subprocess.check_call(notify_cmd, shell=True)
-                #except:
-                #    pass
-                #FIXME: escape quotes in songs
-                play_cmd = '"%s" "%s" > /dev/null 2>&1 ' % \
-                           (self.music_client, song) 
-                subprocess.check_call(play_cmd, shell=True)
-            except KeyboardInterrupt:
+                if upcoming:
+                    next_song = self._playback_path(self.songs[upcoming[0]],
+                                                    prefetcher)
+                else:
+                    next_song = None
                 try:
-                    # HACK to allow repeated ctrl+c to exit outright
-                    time.sleep(0.1) 
+                    sys.stdout.write("%s\n" % song)
+                    sys.stdout.flush()
+                    
+                    # Disabled the following as it got pretty annoying seeing a 
+                    # torrent of notifications for non-music files (mplayer 
+                    # gracefully skips these).            
+                    #try:
+                    #    notify_cmd="notify-send  -t 1000 '%s'" % \
+                    #                song.split("/")[-1]
+                    #    subprocess.check_call(notify_cmd, shell=True)
+                    #except:
+                    #    pass
+                    if last_finished is not None:
+                        self.profiler.add_time("playback.gap",
+                                               time.time() - last_finished)
+                    self.profiler.count("playback.songs")
+                    player.play(self._playback_path(song, prefetcher),
+                                next_song)
                 except KeyboardInterrupt:
-                    sys.stderr.write("\nExiting...\n")
-                    sys.exit(0)
+                    self.profiler.count("playback.skips")
+                    self._song_skipped(song_index)
+                    try:
+                        # HACK to allow repeated ctrl+c to exit outright
+                        time.sleep(0.1) 
+                    except KeyboardInterrupt:
+                        sys.stderr.write("\nExiting...\n")
+                        sys.exit(0)
+                last_finished = time.time()
+        finally:
+            player.close()
+            if prefetcher is not None:
+                prefetcher.close()
+            self.history.close()
+            self.song_stats.save()
+            self._remove_missing_songs()
+        sys.exit(0)
+
+    def control_music(self):
+        """
+        Play songs under a PlaybackController, which takes commands (skip,
+        pause, queue and quit) from the terminal and from the control
+        socket, until the songs run out or it is told to quit.
+        """
+        if self.num_songs == 0:
+            sys.stdout.write("No songs found\n")
+            return
+        sys.stdout.write("%d files found.\n" % self.num_songs)
+        sys.stdout.write("Type skip, pause, queue SONG or quit (and press "
+                         "enter), or send them with music --send\n")
+        self._open_history()
+        prefetcher = self._open_prefetcher()
+
+        def tracks():
+            for song_index, upcoming in self._iter_songs(prefetcher):
+                self.profiler.count("playback.songs")
+                yield Track(song_index, self.songs[song_index],
+                            self._playback_path(self.songs[song_index],
+                                                prefetcher),
+                            [self._playback_path(self.songs[n], prefetcher)
+                             for n in upcoming])
+
+        def skipped(track):
+            if track.key is not None:
+                self.profiler.count("playback.skips")
+                self._song_skipped(track.key)
+
+        def update(args):
+            self._update_index()
+            if self.daemon is not None:
+                self.daemon.reload()
+            return "updated"
+
+        controller = PlaybackController(self.music_client, tracks(),
+                                        self.control_socket_file,
+                                        on_skip=skipped, find=self._find,
+                                        background_commands={
+                                            "update": update})
+        try:
+            controller.run()
+        except socket.error, err:
+            if err.errno != errno.EADDRINUSE:
+                raise
+            sys.stderr.write("%s; use music --send to control it\n" %
+                             err.strerror)
+            sys.exit(1)
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+            self.history.close()
+            self.song_stats.save()
+            self._remove_missing_songs()
+
+    def _find(self, search_terms):
+        """
+        Return the songs in the index matching search terms, or an empty
+        list if they cannot be parsed.
+        """
+        try:
+            query = Query(search_terms)
+        except QuerySyntaxError:
+            return []
+        if self.daemon is not None:
+            return self.daemon.search(search_terms)
+        trigram_index = open_search_index(self.index)
+        search_view = open_search_view(self.index)
+        try:
+            return [self.index[n] for n in
+                    query.iter_search(search_view, trigram_index)]
+        finally:
+            search_view.close()
+            if trigram_index is not None:
+                trigram_index.close()
+
+    def _iter_songs(self, prefetcher=None):
+        """
+        Yield the index into self.songs of each song to play, along with the
+        indices of the songs expected after it (one song, or prefetch_tracks
+        songs if there is a prefetcher), recording each song as played.
+        Songs whose files have gone are passed over (see _song_missing()).
+
+        :param prefetcher: prefetcher to copy upcoming songs with (optional)
+        :type prefetcher: prefetch.Prefetcher
+        """
+        if prefetcher is not None:
+            lookahead = max(1, self.prefetch_tracks)
+        else:
+            lookahead = 1
+        song_index = self._get_song_index(-1)
+        # Indices of the songs to play after song_index
+        upcoming = deque()
+        while song_index is not None:
+            # A stat is far cheaper than starting a player on a dead path
+            song = self.songs[song_index]
+            if song in self.missing_songs or not os.path.exists(song):
+                self._song_missing(song_index)
+                if len(self.missing_songs) >= self.num_songs:
+                    return
+                if upcoming:
+                    song_index = upcoming.popleft()
+                else:
+                    song_index = self._get_song_index(song_index)
+                continue
+            # Record the song as played before working out the next song,
+            # so that the weighted shuffle doesn't pick it again.
+            self._song_started(song_index)
+            # Work out the next songs up front, so the player can get ready
+            # for the next one, and the prefetcher copy them, while this one
+            # plays.
+            while len(upcoming) < lookahead and (not upcoming or
+                                                 upcoming[-1] is not None):
+                upcoming.append(self._get_song_index(
+                    upcoming[-1] if upcoming else song_index))
+            next_indices = [n for n in upcoming if n is not None]
+            if prefetcher is not None:
+                prefetcher.upcoming(song,
+                                    [self.songs[n] for n in next_indices])
+            yield song_index, next_indices
+            song_index = upcoming.popleft()
+
+    def _open_prefetcher(self):
+        """
+        Open the read-ahead cache and start copying songs into it, returning
+        the Prefetcher, or None if there is no cache (see cache_size_mb) or
+        another process is using it.
+        """
+        if self.cache_size_mb <= 0:
+            return None
+        try:
+            cache = TrackCache(os.path.join(self.random_music_home,
+                                            CACHE_DIR),
+                               int(self.cache_size_mb * 1024 * 1024))
+        except IOError, err:
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            sys.stderr.write("WARNING: the cache is in use by another music "
+                             "process, playing without it\n")
+            return None
+        return Prefetcher(cache)
+
+    def _playback_path(self, song, prefetcher):
+        """
+        Return the path to play a song from: its cached copy, if it has been
+        copied, or the song itself.
+        """
+        if prefetcher is None:
+            return song
+        path = prefetcher.cache.get(song)
+        if path is None:
+            self.profiler.count("playback.cache_misses")
+            return song
+        self.profiler.count("playback.cache_hits")
+        return path
 
     # TODO: decouple this
     def clean_song_name(self, songname):
@@ -413,10 +1512,10 @@ class RandomMusicPlaylist(object):
         :param songname: the abs path to the song we want to 'clean'
         :type songname: str
         """
-        # Reverse-sort the music_dirs list by string length, as if one 
+        # Try the longest music_dirs first (see load_config()), as if one
         # music_dir is a subset of the other (e.g. "/music" and "/music/jazz"),
         #  we could end up cutting off too little
-        for md in sorted(self.music_dirs, key=len, reverse=True):
+        for md in self.sorted_music_dirs:
             if songname.find(md) == 0:
                 songname = songname.replace(md, "")
                 break # shouldn't need to do any more replacements
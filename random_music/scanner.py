@@ -0,0 +1,246 @@
+"""Crawl music directories, keeping enough state to rescan incrementally.
+
+A directory's mtime changes whenever an entry is added to, removed from or
+renamed within it, so if we remember each directory's mtime along with its
+listing, a later update only has to list those directories whose mtime has
+changed. Every known directory still has to be stat()ed (a change deep within
+a tree does not bubble up to its parents), but a stat is far cheaper than a
+listdir on large directories and network mounts.
+
+Directories are scanned a level at a time, with each level shared out amongst
+a bounded pool of worker threads. On network mounts a scan is bound by
+per-call latency rather than CPU, so the threads spend most of their time
+blocked in system calls with the GIL released. Results are gathered in order
+and every listing is sorted, so the output does not depend on the number of
+workers.
+
+"""
+
+import os
+import time
+import cPickle as pickle
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+DIR_STATE_FILE = "dir_state.pickle"
+
+# Directories modified within this many seconds of a scan are not trusted to
+# have a stable mtime (another entry could be added within the same mtime
+# granularity), so they are always relisted on the next update.
+MTIME_GRACE = 2.0
+
+DEFAULT_SCAN_WORKERS = 8
+
+
+class DirectoryState(object):
+    """
+    Per-directory mtimes and entry lists for a set of music directories.
+    """
+    def __init__(self, entries=None):
+        """
+        :param entries: mapping of directory path to a (mtime, files, subdirs)
+        tuple, where files and subdirs are sorted lists of entry names
+        :type entries: dict
+        """
+        self.entries = entries if entries is not None else {}
+        self.listed = 0
+        self.reused = 0
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a previously saved state, returning an empty state if there is
+        none (or it cannot be read).
+
+        :param path: path to the saved state
+        :type path: str
+        """
+        try:
+            with open(path, "rb") as fh:
+                return cls(pickle.load(fh))
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return cls()
+
+    def save(self, path):
+        """
+        Save the state, replacing any existing state atomically.
+
+        :param path: path to save the state to
+        :type path: str
+        """
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "wb") as fh:
+            pickle.dump(self.entries, fh, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+    def iter_files(self, music_dirs):
+        """
+        Yield the full path of every file beneath music_dirs. Files are
+        yielded root by root, and in lexicographic order within a root, so
+        that index files are stable between updates.
+
+        :param music_dirs: root directories, as passed to scan_dirs()
+        :type music_dirs: list[str]
+        """
+        for root in music_dirs:
+            stack = [(root, True)]
+            while stack:
+                path, is_dir = stack.pop()
+                if not is_dir:
+                    yield path
+                    continue
+                entry = self.entries.get(path)
+                if entry is None:
+                    continue
+                # Sorting directories as "name/" orders the children exactly
+                # as their full paths would sort.
+                children = sorted([(f, f, False) for f in entry[1]] +
+                                  [(d + "/", d, True) for d in entry[2]])
+                for _, name, child_is_dir in reversed(children):
+                    stack.append((os.path.join(path, name), child_is_dir))
+
+
+def _list_dir(path):
+    """
+    List a directory, splitting its entries into files and subdirectories.
+    As with os.walk, symlinks to directories are not followed.
+
+    :param path: the directory to list
+    :type path: str
+    """
+    files, subdirs = [], []
+    if scandir is not None:
+        # scandir gets the entry type from the directory listing itself on
+        # most platforms, saving a stat() per entry.
+        for entry in scandir(path):
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    subdirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            if os.path.isdir(full_path):
+                if not os.path.islink(full_path):
+                    subdirs.append(name)
+            else:
+                files.append(name)
+    files.sort()
+    subdirs.sort()
+    return files, subdirs
+
+
+def _scan_dir(path, cached, scan_time):
+    """
+    Return a (mtime, files, subdirs) entry for a directory, reusing the
+    cached entry if the directory has not been modified. Returns None if the
+    directory no longer exists or cannot be read.
+
+    :param path: the directory to scan
+    :type path: str
+    :param cached: the entry from the previous scan, if any
+    :type cached: tuple
+    :param scan_time: time at which the scan started
+    :type scan_time: float
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    if cached is not None and cached[0] == mtime:
+        return cached
+    try:
+        files, subdirs = _list_dir(path)
+    except OSError:
+        return None
+    if mtime >= scan_time - MTIME_GRACE:
+        mtime = None
+    return (mtime, files, subdirs)
+
+
+def scan_dirs(music_dirs, state=None, workers=DEFAULT_SCAN_WORKERS,
+              changed=None):
+    """
+    Scan music_dirs, listing only those directories which have changed
+    since state was recorded, and return the new DirectoryState. Directories
+    which have been deleted (or are no longer beneath any of music_dirs) are
+    pruned.
+
+    If the directories which have changed are already known (from a
+    watcher, say), pass them as changed: the recorded listings of all other
+    directories are then reused without even a stat().
+
+    :param music_dirs: root directories to scan
+    :type music_dirs: list[str]
+    :param state: the state from the previous scan (optional)
+    :type state: DirectoryState
+    :param workers: number of directories to scan concurrently
+    :type workers: int
+    :param changed: the only directories which may have changed (optional)
+    :type changed: set[str]
+    """
+    old_entries = state.entries if state is not None else {}
+    new_state = DirectoryState()
+    scan_time = time.time()
+    pool = ThreadPool(workers) if workers > 1 else None
+
+    def scan(path):
+        cached = old_entries.get(path)
+        if changed is not None and cached is not None and \
+                path not in changed:
+            return cached
+        return _scan_dir(path, cached, scan_time)
+
+    try:
+        pending = list(music_dirs)
+        while pending:
+            pending = [path for path in pending
+                       if path not in new_state.entries]
+            if pool is not None and len(pending) > 1:
+                results = pool.map(scan, pending)
+            else:
+                results = [scan(path) for path in pending]
+            pending = _record_level(new_state, old_entries, pending, results)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return new_state
+
+
+def _record_level(new_state, old_entries, paths, results):
+    """
+    Record a level's scan results in new_state, and return the paths of the
+    next level's directories.
+
+    :param new_state: the state being built
+    :type new_state: DirectoryState
+    :param old_entries: entries from the previous scan
+    :type old_entries: dict
+    :param paths: the directories which were scanned
+    :type paths: list[str]
+    :param results: the entries returned by _scan_dir() for each path
+    :type results: list[tuple]
+    """
+    next_pending = []
+    for path, entry in zip(paths, results):
+        if path in new_state.entries:
+            # The same root listed twice
+            continue
+        if entry is None:
+            continue
+        if entry is old_entries.get(path):
+            new_state.reused += 1
+        else:
+            new_state.listed += 1
+        new_state.entries[path] = entry
+        next_pending.extend(os.path.join(path, d) for d in entry[2])
+    return next_pending
@@ -0,0 +1,198 @@
+"""Choose which songs make up a playlist, and the order they are played in.
+
+When only num_songs songs are wanted, there is no need to hold every match
+in memory: in sequential mode, the first num_songs matches are taken and the
+search stops there; in random mode, a reservoir of num_songs songs is kept,
+giving a uniformly random subset of the matches in a single pass.
+
+Songs are then picked from the playlist either uniformly at random (the
+"random" shuffle mode, which may repeat songs), or in the order given by a
+seeded Permutation of the playlist (the "permutation" shuffle mode, which
+plays every song once before any is repeated), or in proportion to their
+weights (the "weighted" shuffle mode, see the weights module). A permutation
+shuffle can be resumed from its seed and position.
+
+"""
+
+import os
+import json
+import random
+from itertools import islice
+
+from songtable import SongTable
+
+RANDOM_SHUFFLE = "random"
+PERMUTATION_SHUFFLE = "permutation"
+WEIGHTED_SHUFFLE = "weighted"
+SHUFFLE_MODES = (RANDOM_SHUFFLE, PERMUTATION_SHUFFLE, WEIGHTED_SHUFFLE)
+
+SHUFFLE_STATE_FILE = "shuffle_state.json"
+
+
+def reservoir_sample(items, k, rng=random):
+    """
+    Return a uniformly random sample of k items from an iterable of unknown
+    length, holding at most k items in memory (Vitter's algorithm R). If
+    there are fewer than k items, all of them are returned.
+
+    :param items: the items to sample from
+    :type items: iterable
+    :param k: the number of items wanted
+    :type k: int
+    :param rng: source of randomness
+    :type rng: random.Random
+    """
+    reservoir = list(islice(items, k))
+    if len(reservoir) < k:
+        return reservoir
+    for seen, item in enumerate(items, k + 1):
+        n = rng.randint(0, seen - 1)
+        if n < k:
+            reservoir[n] = item
+    return reservoir
+
+
+def select_songs(songs, num_songs=None, randomise=False, rng=random):
+    """
+    Return a list of up to num_songs songs from an iterable of matching
+    songs: the first num_songs in sequential mode, or a random subset in
+    random mode. If num_songs is not given, every song is returned, in a
+    SongTable.
+
+    :param songs: matching songs, in index order
+    :type songs: iterable
+    :param num_songs: maximum number of songs wanted (optional)
+    :type num_songs: int
+    :param randomise: choose a random subset rather than the first songs
+    :type randomise: bool
+    :param rng: source of randomness
+    :type rng: random.Random
+    """
+    if not num_songs:
+        return SongTable(songs)
+    if randomise:
+        return reservoir_sample(songs, num_songs, rng)
+    return list(islice(songs, num_songs))
+
+
+def select_from_index(index, num_songs=None, randomise=False, rng=random):
+    """
+    As select_songs(), for an entire index. Since the size of the index is
+    known, a random subset can be picked without reading every song.
+
+    :param index: sequence of song paths
+    :type index: sequence
+    :param num_songs: maximum number of songs wanted (optional)
+    :type num_songs: int
+    :param randomise: choose a random subset rather than the first songs
+    :type randomise: bool
+    :param rng: source of randomness
+    :type rng: random.Random
+    """
+    if not num_songs:
+        return index
+    if randomise:
+        count = min(num_songs, len(index))
+        return [index[n] for n in sorted(rng.sample(xrange(len(index)),
+                                                    count))]
+    return index[:num_songs]
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(z):
+    """
+    Scramble a 64-bit integer (the SplitMix64 finaliser).
+    """
+    z = (z + 0x9E3779B97F4A7C15) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+
+class Permutation(object):
+    """
+    A pseudo-random permutation of range(n), computed one position at a time
+    in constant memory.
+
+    Positions are encrypted with a small Feistel network over the smallest
+    power-of-four sized domain which covers n; a Feistel network is a
+    bijection whatever its round function, so no two positions map to the
+    same value. Values which fall outside range(n) are encrypted again
+    ("cycle walking") until they land inside it, which takes fewer than four
+    rounds of encryption on average.
+    """
+    ROUNDS = 4
+
+    def __init__(self, n, seed):
+        """
+        :param n: size of the permutation
+        :type n: int
+        :param seed: the same seed always gives the same permutation
+        :type seed: int
+        """
+        self.n = n
+        self.seed = seed
+        self._half_bits = max(1, (max(n - 1, 1).bit_length() + 1) // 2)
+        self._mask = (1 << self._half_bits) - 1
+        rng = random.Random(seed)
+        self._keys = [rng.getrandbits(64) for _ in xrange(self.ROUNDS)]
+
+    def __len__(self):
+        return self.n
+
+    def _encrypt(self, x):
+        left, right = x >> self._half_bits, x & self._mask
+        for key in self._keys:
+            left, right = right, left ^ (_mix64(right ^ key) & self._mask)
+        return (left << self._half_bits) | right
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.n:
+            raise IndexError("permutation position out of range")
+        x = self._encrypt(position)
+        while x >= self.n:
+            x = self._encrypt(x)
+        return x
+
+
+def load_shuffle_state(path, playlist_key):
+    """
+    Load a saved permutation shuffle, returning a (seed, position) tuple, or
+    None if there is no saved shuffle for this playlist.
+
+    :param path: path to the saved shuffle state
+    :type path: str
+    :param playlist_key: identifies the playlist being shuffled
+    :type playlist_key: str
+    """
+    try:
+        with open(path) as fh:
+            state = json.load(fh)
+        if state["playlist"] == playlist_key:
+            return int(state["seed"]), int(state["position"])
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def save_shuffle_state(path, playlist_key, seed, position):
+    """
+    Save a permutation shuffle's seed and position, so that it can be
+    resumed.
+
+    :param path: path to save the shuffle state to
+    :type path: str
+    :param playlist_key: identifies the playlist being shuffled
+    :type playlist_key: str
+    :param seed: the permutation's seed
+    :type seed: int
+    :param position: position to resume from
+    :type position: int
+    """
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "w") as fh:
+        json.dump({"playlist": playlist_key, "seed": seed,
+                   "position": position}, fh)
+    os.rename(tmp_path, path)
@@ -0,0 +1,165 @@
+"""Compact in-memory storage for lists of song paths.
+
+Songs in a playlist mostly come in index order, so each path tends to share
+a long prefix (music directory, artist and album) with the one before it.
+A SongTable front-codes paths in blocks: the first path in each block is
+stored in full, and every other path as the length of the prefix it shares
+with the previous path, followed by the rest of it. Each full block is then
+compressed with zlib (which picks up what front coding misses, such as
+repeated words and file extensions), and the blocks are packed into a single
+bytearray. A path costs a fraction of its own length, rather than a whole
+Python string object (and a list slot) per song.
+
+Paths are rebuilt on demand by decoding their block. The last block decoded
+is kept, so stepping through the table only decodes each block once.
+
+"""
+
+import zlib
+from array import array
+from itertools import izip
+
+BLOCK_SIZE = 32
+
+
+def _shared_prefix(a, b):
+    """
+    Return the length of the common prefix of two strings. Slices are
+    compared rather than characters, so the comparisons happen in C.
+    """
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def _varint(n):
+    if n < 0x80:
+        return chr(n)
+    chars = []
+    while n >= 0x80:
+        chars.append(chr(n & 0x7f | 0x80))
+        n >>= 7
+    chars.append(chr(n))
+    return "".join(chars)
+
+
+def _read_varint(data, pos):
+    n = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _decode_block(data):
+    """
+    Decode a front-coded block, returning its songs.
+    """
+    songs = []
+    song = ""
+    pos = 0
+    while pos < len(data):
+        shared, pos = _read_varint(data, pos)
+        length, pos = _read_varint(data, pos)
+        song = song[:shared] + data[pos:pos + length]
+        pos += length
+        songs.append(song)
+    return songs
+
+
+class SongTable(object):
+    """
+    A compressed, front-coded list of song paths.
+    """
+    def __init__(self, songs=()):
+        """
+        :param songs: song paths to store
+        :type songs: iterable
+        """
+        self._data = bytearray()
+        # Offset into _data of each compressed block, plus the end of the
+        # last one
+        self._offsets = array("L", [0])
+        # The block being filled, front-coded but not yet compressed
+        self._pending = []
+        self._pending_songs = []
+        self._count = 0
+        # (block number, songs) of the last block decoded
+        self._cached = (None, None)
+        for song in songs:
+            self.append(song)
+
+    def append(self, song):
+        """
+        Add a song to the end of the table.
+
+        :param song: path to the song
+        :type song: str
+        """
+        if self._pending_songs:
+            shared = _shared_prefix(self._pending_songs[-1], song)
+        else:
+            shared = 0
+        suffix = song[shared:]
+        self._pending.append(_varint(shared) + _varint(len(suffix)) + suffix)
+        self._pending_songs.append(song)
+        self._count += 1
+        if len(self._pending_songs) == BLOCK_SIZE:
+            self._data += zlib.compress("".join(self._pending))
+            self._offsets.append(len(self._data))
+            self._pending = []
+            self._pending_songs = []
+
+    def __len__(self):
+        return self._count
+
+    def _block(self, block):
+        """
+        Return the songs in a block.
+        """
+        if block == len(self._offsets) - 1:
+            return self._pending_songs
+        cached_block, songs = self._cached
+        if cached_block != block:
+            data = self._data[self._offsets[block]:self._offsets[block + 1]]
+            songs = _decode_block(zlib.decompress(str(data)))
+            self._cached = (block, songs)
+        return songs
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self[i] for i in xrange(*n.indices(self._count))]
+        if n < 0:
+            n += self._count
+        if not 0 <= n < self._count:
+            raise IndexError("index out of range")
+        return self._block(n // BLOCK_SIZE)[n % BLOCK_SIZE]
+
+    def __iter__(self):
+        for block in xrange(len(self._offsets)):
+            for song in self._block(block):
+                yield song
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(
+                a == b for a, b in izip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return "SongTable(%r)" % list(self)
@@ -0,0 +1,244 @@
+"""SQLite index files, with full-text search.
+
+Songs, their tags and their search keys (see query.search_key) are stored in
+a table keyed by their position in the index, alongside a contentless FTS5
+table of each song's search key using the trigram tokenizer, which SQLite
+uses to find the songs containing a search term without checking every
+song. Where SQLite
+was built without FTS5 (or is too old to have the trigram tokenizer), the
+full-text table is left out and searches fall back to a trigram index file,
+as for the other index formats.
+
+Databases are written in a single transaction and use WAL mode, so any
+number of processes (and the daemon's threads) can read them at once.
+
+"""
+
+import os
+import sqlite3
+import threading
+from itertools import islice, izip
+
+from query import search_key, search_text
+
+FTS_TABLE = "songs_fts"
+# Number of songs fetched at a time when iterating over an index
+FETCH_SIZE = 1000
+# Number of songs inserted at a time when writing an index
+INSERT_BATCH = 10000
+# Stored as the database's user_version if it holds tags
+TAGS_VERSION = 1
+TAG_COLUMNS = "artist, album, title, duration"
+
+
+def write_sqlite_index(path, songs, tags=None):
+    """
+    Write songs to a new SQLite index.
+
+    :param path: path to the index file, which must not already exist
+    :type path: str
+    :param songs: song paths to write
+    :type songs: iterable
+    :param tags: tags for each song (optional)
+    :type tags: iterable of index.Tags
+    """
+    conn = sqlite3.connect(path)
+    conn.text_factory = str
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        # The index is renamed into place once written, so nothing is lost
+        # if we crash part way through.
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("CREATE TABLE songs (id INTEGER PRIMARY KEY, "
+                     "path TEXT NOT NULL, artist TEXT, album TEXT, "
+                     "title TEXT, duration INTEGER, search_key TEXT)")
+        try:
+            conn.execute("CREATE VIRTUAL TABLE %s USING fts5(search, "
+                         "content='', tokenize='trigram')" % FTS_TABLE)
+            has_fts = True
+        except sqlite3.OperationalError:
+            has_fts = False
+        if tags is None:
+            rows = ((n, song, None, None, None, None, search_key(song))
+                    for n, song in enumerate(songs))
+        else:
+            rows = ((n, song) + tuple(song_tags) +
+                    (search_key(search_text(song, song_tags)),)
+                    for n, (song, song_tags) in enumerate(izip(songs, tags)))
+        with conn:
+            while True:
+                batch = list(islice(rows, INSERT_BATCH))
+                if not batch:
+                    break
+                conn.executemany("INSERT INTO songs VALUES "
+                                 "(?, ?, ?, ?, ?, ?, ?)", batch)
+                if has_fts:
+                    conn.executemany("INSERT INTO %s (rowid, search) "
+                                     "VALUES (?, ?)" % FTS_TABLE,
+                                     ((row[0], row[6]) for row in batch))
+        if tags is not None:
+            conn.execute("PRAGMA user_version=%d" % TAGS_VERSION)
+    finally:
+        conn.close()
+
+
+class SQLiteIndex(object):
+    """
+    A SQLite index. Songs are only read from the database as they are
+    accessed.
+    """
+    def __init__(self, path):
+        """
+        :param path: path to the index file
+        :type path: str
+        """
+        if not os.path.isfile(path):
+            raise IOError("No such index file: '%s'" % path)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.text_factory = str
+        self._lock = threading.Lock()
+        try:
+            self._count = self._query("SELECT count(*) FROM songs")[0][0]
+            self.has_fts = bool(self._query(
+                "SELECT 1 FROM sqlite_master WHERE name = ?", (FTS_TABLE,)))
+            self.has_tags = (self._query("PRAGMA user_version")[0][0] ==
+                             TAGS_VERSION)
+            self.has_keys = any(row[1] == "search_key" for row in
+                                self._query("PRAGMA table_info(songs)"))
+        except sqlite3.DatabaseError:
+            self._conn.close()
+            raise ValueError("'%s' is not a SQLite index file" % path)
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def __len__(self):
+        return self._count
+
+    def _get(self, columns, n):
+        """
+        Return the given columns of the song at position n, or of the songs
+        in slice n.
+        """
+        if isinstance(n, slice):
+            start, stop, step = n.indices(self._count)
+            rows = self._query("SELECT %s FROM songs WHERE id >= ? AND "
+                               "id < ? ORDER BY id" % columns, (start, stop))
+            return rows[::step]
+        if n < 0:
+            n += self._count
+        rows = self._query("SELECT %s FROM songs WHERE id = ?" % columns,
+                           (n,))
+        if not rows:
+            raise IndexError("index out of range")
+        return rows[0]
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [row[0] for row in self._get("path", n)]
+        return self._get("path", n)[0]
+
+    def __iter__(self):
+        for start in xrange(0, self._count, FETCH_SIZE):
+            for song in self[start:start + FETCH_SIZE]:
+                yield song
+
+    def tag_columns(self):
+        """
+        Return a sequence of (artist, album, title, duration) tuples, one
+        per song, or None if the index has no tags.
+        """
+        if not self.has_tags:
+            return None
+        return TagColumns(self)
+
+    def search_keys(self):
+        """
+        Return a sequence of the songs' search keys, or None if the index
+        has none.
+        """
+        if not self.has_keys:
+            return None
+        return SearchKeyColumn(self)
+
+    def full_text(self):
+        """
+        Return a FullTextSearch for the index, or None if it has no
+        full-text table.
+        """
+        if not self.has_fts:
+            return None
+        return FullTextSearch(self)
+
+    def close(self):
+        self._conn.close()
+
+
+class TagColumns(object):
+    """
+    A read-only sequence of the tags stored in a SQLite index.
+    """
+    def __init__(self, index):
+        """
+        :param index: the index holding the tags
+        :type index: SQLiteIndex
+        """
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, n):
+        return self.index._get(TAG_COLUMNS, n)
+
+    def __iter__(self):
+        for start in xrange(0, len(self.index), FETCH_SIZE):
+            for row in self[start:start + FETCH_SIZE]:
+                yield row
+
+    def close(self):
+        pass
+
+
+class SearchKeyColumn(TagColumns):
+    """
+    A read-only sequence of the search keys stored in a SQLite index.
+    """
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [row[0] for row in self.index._get("search_key", n)]
+        return self.index._get("search_key", n)[0]
+
+
+class FullTextSearch(object):
+    """
+    Narrow down searches using a SQLite index's full-text table. Used in
+    place of a trigram index (see trigrams.TrigramIndex).
+    """
+    def __init__(self, index):
+        """
+        :param index: the index to search
+        :type index: SQLiteIndex
+        """
+        self.index = index
+
+    def candidates(self, term):
+        """
+        Return the sorted positions of songs which may contain term, or
+        None if term is too short to narrow the search down.
+
+        :param term: the search term
+        :type term: str
+        """
+        # The trigram tokenizer cannot match fewer than three characters.
+        if len(term.decode("utf-8", "replace")) < 3:
+            return None
+        rows = self.index._query("SELECT rowid FROM %s WHERE %s MATCH ? "
+                                 "ORDER BY rowid" % (FTS_TABLE, FTS_TABLE),
+                                 ('"%s"' % term.replace('"', '""'),))
+        return [row[0] for row in rows]
+
+    def close(self):
+        pass
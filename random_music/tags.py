@@ -0,0 +1,326 @@
+"""Recognise audio files, and read their tags.
+
+A file is recognised as audio by its extension or, if its extension is not
+a familiar one, by the magic bytes at its start, so cover art, cue sheets
+and the like never make it into the index.
+
+Tags (artist, album, title and duration) are read with mutagen where it is
+installed. Without it, only ID3v1 tags are read and durations are unknown.
+Reading tags means opening every file, so files are examined in a pool of
+worker processes. The results are cached by each file's size and mtime, so
+an update only examines files which are new or have changed; checking the
+cache only takes a stat(), which is done in the calling process, so
+unchanged files never go near the pool.
+
+"""
+
+import os
+import marshal
+from itertools import imap
+from multiprocessing import Pool, cpu_count
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None
+
+from index import NO_TAGS, Tags
+
+TAG_CACHE_FILE = "tag_cache.marshal"
+
+try:
+    DEFAULT_TAG_WORKERS = cpu_count()
+except NotImplementedError:
+    DEFAULT_TAG_WORKERS = 1
+# Number of files handed to a worker at a time
+CHUNK_SIZE = 64
+
+AUDIO_EXTENSIONS = frozenset([
+    ".aac", ".ac3", ".aif", ".aifc", ".aiff", ".amr", ".ape", ".au",
+    ".dsf", ".dts", ".flac", ".it", ".m4a", ".m4b", ".mid", ".midi", ".mka",
+    ".mod", ".mp2", ".mp3", ".mp4", ".mpc", ".oga", ".ogg", ".opus", ".ra",
+    ".s3m", ".shn", ".spx", ".tta", ".wav", ".wma", ".wv", ".xm",
+])
+NON_AUDIO_EXTENSIONS = frozenset([
+    ".accurip", ".bmp", ".cue", ".db", ".doc", ".gif", ".htm", ".html",
+    ".ini", ".jpeg", ".jpg", ".log", ".m3u", ".m3u8", ".md5", ".nfo",
+    ".par2", ".pdf", ".pls", ".png", ".rtf", ".sfv", ".tif", ".tiff",
+    ".txt", ".url", ".xml",
+])
+# (offset, bytes) signatures of audio containers
+AUDIO_MAGIC = (
+    (0, "ID3"),                     # MP3 with an ID3v2 tag
+    (0, "fLaC"),
+    (0, "OggS"),
+    (8, "WAVE"),
+    (8, "AIFF"),
+    (8, "AIFC"),
+    (4, "ftypM4A"),
+    (4, "ftypM4B"),
+    (0, "MAC "),                    # Monkey's Audio
+    (0, "wvpk"),                    # WavPack
+    (0, "MPCK"),                    # Musepack
+    (0, "MThd"),                    # MIDI
+    (0, "\x30\x26\xb2\x75"),        # ASF (WMA)
+    (0, "\x1a\x45\xdf\xa3"),        # Matroska
+)
+MAGIC_SIZE = 12
+
+
+def is_audio(path):
+    """
+    Return whether a file is an audio file, going by its extension or, for
+    unfamiliar extensions, its contents.
+
+    :param path: path to the file
+    :type path: str
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in AUDIO_EXTENSIONS:
+        return True
+    if ext in NON_AUDIO_EXTENSIONS:
+        return False
+    try:
+        with open(path, "rb") as fh:
+            head = fh.read(MAGIC_SIZE)
+    except IOError:
+        return False
+    for offset, magic in AUDIO_MAGIC:
+        if head[offset:offset + len(magic)] == magic:
+            return True
+    # A bare MPEG audio frame sync
+    return len(head) >= 2 and head[0] == "\xff" and ord(head[1]) & 0xe0 == 0xe0
+
+
+def _clean(value):
+    """
+    Tidy up a tag value, which must not contain the characters used to
+    separate tags in the index and in search text.
+    """
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return " ".join(value.replace("\0", " ").split())
+
+
+def _read_id3v1(path):
+    """
+    Read the ID3v1 tag at the end of an MP3 file.
+    """
+    try:
+        with open(path, "rb") as fh:
+            fh.seek(-128, os.SEEK_END)
+            data = fh.read(128)
+    except IOError:
+        return NO_TAGS
+    if not data.startswith("TAG"):
+        return NO_TAGS
+    title, artist, album = [_clean(data[start:start + 30].split("\0")[0]
+                                   .decode("latin-1"))
+                            for start in (3, 33, 63)]
+    return Tags(artist, album, title, 0)
+
+
+def read_tags(path):
+    """
+    Read an audio file's tags, returning NO_TAGS if it has none (or they
+    cannot be read).
+
+    :param path: path to the file
+    :type path: str
+    """
+    if mutagen is None:
+        if os.path.splitext(path)[1].lower() == ".mp3":
+            return _read_id3v1(path)
+        return NO_TAGS
+    try:
+        audio = mutagen.File(path, easy=True)
+    except Exception:
+        # mutagen raises all sorts of errors for damaged files
+        return NO_TAGS
+    if audio is None:
+        return NO_TAGS
+    tags = audio.tags or {}
+
+    def first(key):
+        values = tags.get(key)
+        return _clean(values[0]) if values else ""
+
+    try:
+        duration = int(round(audio.info.length))
+    except (AttributeError, TypeError, ValueError):
+        duration = 0
+    return Tags(first("artist"), first("album"), first("title"), duration)
+
+
+def _examine(path):
+    """
+    Examine a file in a worker process, returning (path, entry), where entry
+    is a (size, mtime, is_audio, tags) tuple, or None if the file has gone.
+
+    :param path: path to the file
+    :type path: str
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path, None
+    audio = is_audio(path)
+    tags = read_tags(path) if audio else NO_TAGS
+    return path, (st.st_size, st.st_mtime, audio, tuple(tags))
+
+
+class TagCache(object):
+    """
+    Examined files' sizes, mtimes, types and tags, keyed by path.
+    """
+    def __init__(self, entries=None):
+        """
+        :param entries: mapping of path to a (size, mtime, is_audio, tags)
+        tuple
+        :type entries: dict
+        """
+        self.entries = entries if entries is not None else {}
+        self.examined = 0
+        self.reused = 0
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a previously saved cache, returning an empty cache if there is
+        none (or it cannot be read).
+
+        :param path: path to the saved cache
+        :type path: str
+        """
+        try:
+            with open(path, "rb") as fh:
+                return cls(marshal.load(fh))
+        except (IOError, EOFError, ValueError, TypeError):
+            return cls()
+
+    def save(self, path):
+        """
+        Save the cache, replacing any existing cache atomically.
+
+        :param path: path to save the cache to
+        :type path: str
+        """
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "wb") as fh:
+            marshal.dump(self.entries, fh)
+        os.rename(tmp_path, path)
+
+
+def check_files(paths, cache, new_cache, changed=None):
+    """
+    Check files against cache, recording the entries of those which have not
+    changed in new_cache, and return the paths of those which need to be
+    examined (see examine_files()). Files which have gone are left out of
+    both, so they drop out of the cache.
+
+    If the files which may have changed are already known, pass them as
+    changed: every other file with an entry in cache reuses it without even
+    a stat().
+
+    :param paths: paths of the files to check
+    :type paths: iterable
+    :param cache: the cache from the previous update
+    :type cache: TagCache
+    :param new_cache: the cache being built
+    :type new_cache: TagCache
+    :param changed: the only files which may have changed (optional)
+    :type changed: set[str]
+    """
+    pending = []
+    seen = set()
+    for path in paths:
+        if path in seen:
+            continue
+        seen.add(path)
+        cached = cache.entries.get(path)
+        if cached is None:
+            pending.append(path)
+            continue
+        if changed is None or path in changed:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if cached[0] != st.st_size or cached[1] != st.st_mtime:
+                pending.append(path)
+                continue
+        new_cache.reused += 1
+        new_cache.entries[path] = cached
+    return pending
+
+
+def examine_files(paths, new_cache, workers=DEFAULT_TAG_WORKERS):
+    """
+    Examine files in a pool of worker processes, recording their entries in
+    new_cache.
+
+    :param paths: paths of the files to examine
+    :type paths: list[str]
+    :param new_cache: the cache being built
+    :type new_cache: TagCache
+    :param workers: number of worker processes
+    :type workers: int
+    """
+    if not paths:
+        return
+    pool = Pool(workers) if workers > 1 and len(paths) > 1 else None
+    try:
+        if pool is not None:
+            results = pool.imap(_examine, paths, CHUNK_SIZE)
+        else:
+            results = imap(_examine, paths)
+        for path, entry in results:
+            if entry is not None:
+                new_cache.examined += 1
+                new_cache.entries[path] = entry
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def audio_files(paths, cache):
+    """
+    Yield a (path, tags) tuple for each audio file amongst paths, in order,
+    from its entry in cache. Files without an entry are left out.
+
+    :param paths: paths of the files
+    :type paths: iterable
+    :param cache: the cache holding the files' entries
+    :type cache: TagCache
+    """
+    for path in paths:
+        entry = cache.entries.get(path)
+        if entry is not None and entry[2]:
+            yield path, Tags(*entry[3])
+
+
+def scan_files(paths, cache, new_cache, workers=DEFAULT_TAG_WORKERS,
+               changed=None):
+    """
+    Yield a (path, tags) tuple for each audio file amongst paths, in order.
+    Files are checked against cache (see check_files()), and only those
+    which are new or have changed are examined, in a pool of worker
+    processes. Every file seen is recorded in new_cache, so files which
+    have gone drop out of it.
+
+    :param paths: paths of the files to examine
+    :type paths: iterable
+    :param cache: the cache from the previous update
+    :type cache: TagCache
+    :param new_cache: the cache being built
+    :type new_cache: TagCache
+    :param workers: number of worker processes
+    :type workers: int
+    :param changed: the only files which may have changed (optional)
+    :type changed: set[str]
+    """
+    paths = list(paths)
+    examine_files(check_files(paths, cache, new_cache, changed), new_cache,
+                  workers)
+    return audio_files(paths, new_cache)
@@ -0,0 +1,39 @@
+import os
+import shutil
+import tempfile
+import unittest2
+
+from random_music import benchmark
+
+
+class TestBenchmark(unittest2.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_generate_library(self):
+        """
+        The library should have fanout ** depth leaf directories, each
+        holding the given number of songs and a cover image.
+        """
+        self.assertEqual(benchmark.generate_library(self.work_dir, 2, 3, 4),
+                         36)
+        songs = covers = 0
+        for _, dirs, files in os.walk(self.work_dir):
+            songs += sum(1 for name in files if name.endswith(".mp3"))
+            covers += files.count("cover.jpg")
+        self.assertEqual((songs, covers), (36, 9))
+
+    def test_compare(self):
+        """
+        Operations which slowed down by more than the threshold should be
+        flagged, and operations missing from either run ignored.
+        """
+        baseline = {"results": {"a": {"min": 1.0}, "b": {"min": 1.0},
+                                "c": {"min": 1.0}}}
+        current = {"results": {"a": {"min": 1.1}, "b": {"min": 1.5},
+                               "d": {"min": 1.0}}}
+        self.assertEqual(benchmark.compare(baseline, current, 0.2),
+                         [("a", 1.0, 1.1, False), ("b", 1.0, 1.5, True)])
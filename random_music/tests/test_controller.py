@@ -0,0 +1,111 @@
+import os
+import errno
+import shutil
+import socket
+import tempfile
+import time
+import unittest2
+from StringIO import StringIO
+
+from random_music import controller
+from random_music.controller import PlaybackController, Track
+
+
+class TestEventLoop(unittest2.TestCase):
+    def test_timers(self):
+        """
+        Timers should run in order once due.
+        """
+        loop = controller.EventLoop()
+        calls = []
+        loop.call_later(0.02, lambda: calls.append(2))
+        loop.call_later(0.01, lambda: calls.append(1))
+        loop.call_later(0.02, lambda: calls.append(3))
+        deadline = time.time() + 1
+        while len(calls) < 3 and time.time() < deadline:
+            loop.run_once()
+        self.assertEqual(calls, [1, 2, 3])
+
+
+class TestPlaybackController(unittest2.TestCase):
+    def _controller(self, client, tracks, **kwargs):
+        out = StringIO()
+        return out, PlaybackController(client, iter(tracks), use_stdin=False,
+                                       out=out, **kwargs)
+
+    def test_play(self):
+        """
+        Every song should be played in turn, and the controller should
+        stop once they run out.
+        """
+        out, ctl = self._controller("true", [Track(n, "song%d" % n, "x", [])
+                                             for n in range(3)])
+        ctl.run()
+        self.assertEqual(out.getvalue(), "song0\nsong1\nsong2\n")
+
+    def test_commands(self):
+        """
+        Skipping should stop the song and report it, songs queued should
+        play next, and quitting should stop the controller.
+        """
+        # "sleep 30" plays a long song
+        tracks = [Track(n, "song%d" % n, "30", []) for n in range(3)]
+        skipped = []
+        out, ctl = self._controller("sleep", tracks, on_skip=skipped.append,
+                                    find=lambda terms: ["0"] * len(terms))
+        ctl.loop.call_later(0.1, lambda: ctl.command("pause"))
+        ctl.loop.call_later(0.2, lambda: ctl.command("skip"))
+        ctl.loop.call_later(0.3, lambda: ctl.command("queue a b"))
+        ctl.loop.call_later(0.5, lambda: ctl.command("quit"))
+        start = time.time()
+        ctl.run()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(skipped, [tracks[0]])
+        self.assertEqual(out.getvalue(), "song0\nsong1\n")
+        self.assertEqual([track.song for track in ctl.queued], ["0", "0"])
+        self.assertEqual(ctl.command("foo"), "unknown command 'foo'")
+
+    def test_background_commands(self):
+        """
+        Background commands should run while songs keep playing, one at a
+        time, with their replies written out once they finish.
+        """
+        tracks = [Track(n, "song%d" % n, "30", []) for n in range(3)]
+        out, ctl = self._controller(
+            "sleep", tracks,
+            background_commands={"wait": lambda args: time.sleep(0.3) or
+                                 "waited"})
+        replies = []
+        ctl.loop.call_later(0.1, lambda: replies.append(ctl.command("wait")))
+        ctl.loop.call_later(0.2, lambda: replies.append(ctl.command("wait")))
+        ctl.loop.call_later(0.2, lambda: ctl.command("skip"))
+        ctl.loop.call_later(0.6, lambda: ctl.command("quit"))
+        ctl.run()
+        self.assertEqual(replies, ["started wait", "busy with wait"])
+        self.assertEqual(out.getvalue(), "song0\nsong1\nwaited\n")
+
+    def test_control_socket(self):
+        """
+        A controller should take over a socket left behind by one which
+        has gone, but not one which is still listening.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        socket_file = os.path.join(tmp_dir, "control.sock")
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(socket_file)
+        stale.close()
+        tracks = [Track(n, "song%d" % n, "30", []) for n in range(2)]
+        out, ctl = self._controller("sleep", tracks, socket_file=socket_file)
+        errors = []
+
+        def start_second():
+            try:
+                self._controller("sleep", tracks,
+                                 socket_file=socket_file)[1].run()
+            except socket.error, err:
+                errors.append(err.errno)
+            ctl.command("quit")
+        ctl.loop.call_later(0.1, start_second)
+        ctl.run()
+        self.assertEqual(errors, [errno.EADDRINUSE])
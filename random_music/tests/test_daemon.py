@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest2
+
+from random_music import daemon
+from random_music.index import write_index
+from random_music.library import Library
+
+
+SONGS = ["/music/David Bowie/Heroes.mp3", "/music/Lou Reed/Perfect Day.mp3",
+         "/music/Rolling Stones/Angie.mp3"]
+
+
+class _Library(Library):
+    """
+    A Library which records whether it has been closed.
+    """
+    closed = False
+
+    def close(self):
+        Library.close(self)
+        self.closed = True
+
+
+class TestIndexServer(unittest2.TestCase):
+    def setUp(self):
+        """
+        Serve a list of songs from a daemon running in a thread.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.socket_file = os.path.join(self.tmp_dir, "daemon.sock")
+        self.index_file = os.path.join(self.tmp_dir, "index.txt")
+        write_index(self.index_file, SONGS)
+        self.server = daemon.IndexServer(self.socket_file,
+                                         lambda: _Library(self.index_file))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        """
+        Stop the daemon and remove its socket.
+        """
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_remote_index(self):
+        """
+        A RemoteIndex should behave like the index being served.
+        """
+        client = daemon.connect(self.socket_file)
+        index = daemon.RemoteIndex(client)
+        self.assertEqual(index.path, self.index_file)
+        self.assertEqual(len(index), len(SONGS))
+        self.assertEqual(index[1], SONGS[1])
+        self.assertEqual(index[1:], SONGS[1:])
+        self.assertEqual(list(index), SONGS)
+        client.close()
+
+    def test_search(self):
+        """
+        Searches should be evaluated by the daemon, and errors reported back
+        to the client.
+        """
+        client = daemon.connect(self.socket_file)
+        self.assertEqual(client.search(["bowie", "OR", "stones"]),
+                         [SONGS[0], SONGS[2]])
+        self.assertRaises(RuntimeError, client.search, ["(bowie"])
+        self.assertRaises(RuntimeError, client.request, "foo")
+        client.close()
+
+    def test_seed(self):
+        """
+        A random search with a seed should pick the same songs every time.
+        """
+        client = daemon.connect(self.socket_file)
+        picks = [client.search(["mp3"], 2, True, seed=3) for _ in range(5)]
+        self.assertEqual(len(picks[0]), 2)
+        self.assertEqual(picks, [picks[0]] * 5)
+        client.close()
+
+    def test_reload(self):
+        """
+        Reloading should close the old library, but only once the requests
+        using it have finished.
+        """
+        library = self.server.acquire()
+        self.server.reload()
+        self.assertFalse(library.closed)
+        self.server.release(library)
+        self.assertTrue(library.closed)
+        old_library = self.server.library
+        self.server.reload()
+        self.assertTrue(old_library.closed)
+        self.assertFalse(self.server.library.closed)
+
+    def test_not_running(self):
+        """
+        Connecting when no daemon is running should return None.
+        """
+        self.assertEqual(daemon.connect(self.socket_file + ".missing"), None)
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest2
+
+from random_music import duplicates
+
+
+class TestDuplicates(unittest2.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "wb") as fh:
+            fh.write(data)
+        st = os.stat(path)
+        return (path, st.st_size, st.st_mtime)
+
+    def test_find_duplicates(self):
+        """
+        Copies should map to the first copy, while files differing only in
+        the middle, files of other sizes and empty files should not.
+        """
+        big = os.urandom(3 * duplicates.SAMPLE_SIZE)
+        changed = big[:len(big) // 2] + "x" + big[len(big) // 2 + 1:]
+        files = [self._write("a.mp3", big),
+                 self._write("b.mp3", "small"),
+                 self._write("c.mp3", big),
+                 self._write("d.mp3", changed),
+                 self._write("e.mp3", "small"),
+                 self._write("f.mp3", "smalls"),
+                 self._write("g.mp3", ""),
+                 self._write("h.mp3", ""),
+                 self._write("i.mp3", big)]
+        paths = [f[0] for f in files]
+        new_cache = duplicates.HashCache()
+        found = duplicates.find_duplicates(files, duplicates.HashCache(),
+                                           new_cache, workers=1)
+        self.assertEqual(found, {paths[2]: paths[0], paths[8]: paths[0],
+                                 paths[4]: paths[1]})
+        self.assertEqual(found, duplicates.find_duplicates(
+            files, duplicates.HashCache(), duplicates.HashCache(), workers=2))
+
+        # Cached hashes should be used for files which haven't changed.
+        new_cache.entries[paths[4]][2] = "stale"
+        self.assertEqual(duplicates.find_duplicates(
+            files, new_cache, duplicates.HashCache(), workers=1),
+            {paths[2]: paths[0], paths[8]: paths[0]})
+
+    def test_duplicates_file(self):
+        """
+        Alternates should read back as written, and as empty when missing.
+        """
+        index_file = os.path.join(self.tmp_dir, "index.idx")
+        self.assertEqual(duplicates.load_duplicates(index_file), {})
+        alternates = {"/music/a.mp3": ["/music/b.mp3", "/music/c.mp3"]}
+        duplicates.write_duplicates(duplicates.duplicates_file(index_file),
+                                    alternates)
+        self.assertEqual(duplicates.load_duplicates(index_file), alternates)
@@ -0,0 +1,53 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest2
+
+from random_music import export
+
+
+SONGS = ["/music/Lou Reed/Perfect Day.mp3", "/music/Bj\xc3\xb6rk/J\xc3\xb3ga.flac"]
+
+
+class TestExportPlaylist(unittest2.TestCase):
+    def setUp(self):
+        """
+        Create a temporary directory for playlists.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Remove the temporary directory.
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def _export(self, fmt):
+        output = os.path.join(self.tmp_dir, "playlist")
+        count = export.export_playlist(iter(SONGS), output, fmt)
+        self.assertEqual(count, len(SONGS))
+        with open(output) as fh:
+            return fh.read()
+
+    def test_m3u(self):
+        self.assertEqual(self._export(export.M3U_FORMAT),
+                         "%s\n%s\n" % tuple(SONGS))
+
+    def test_extm3u(self):
+        self.assertEqual(self._export(export.EXTM3U_FORMAT),
+                         "#EXTM3U\n"
+                         "#EXTINF:-1,Perfect Day\n%s\n"
+                         "#EXTINF:-1,J\xc3\xb3ga\n%s\n" % tuple(SONGS))
+
+    def test_pls(self):
+        self.assertEqual(self._export(export.PLS_FORMAT),
+                         "[playlist]\n"
+                         "File1=%s\nTitle1=Perfect Day\n"
+                         "File2=%s\nTitle2=J\xc3\xb3ga\n"
+                         "NumberOfEntries=2\nVersion=2\n" % tuple(SONGS))
+
+    def test_jsonl(self):
+        lines = self._export(export.JSONL_FORMAT).splitlines()
+        self.assertEqual([json.loads(line)["path"].encode("utf-8")
+                          for line in lines], SONGS)
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest2
+
+from random_music import history
+
+
+class TestHistoryLog(unittest2.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, history.HISTORY_FILE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_records_are_batched(self):
+        """
+        Records should only be written out once a batch has built up.
+        """
+        log = history.HistoryLog(self.path, sync_batch=3)
+        log.append(history.PLAY_EVENT, "/music/a.mp3", 1.0)
+        log.append(history.SKIP_EVENT, "/music/a.mp3", 2.0)
+        self.assertEqual(os.path.getsize(self.path),
+                         len(history.HISTORY_MAGIC))
+        log.append(history.PLAY_EVENT, "/music/b.mp3", 3.0)
+        self.assertEqual(os.path.getsize(self.path),
+                         len(history.HISTORY_MAGIC) + 3 * history.RECORD.size)
+        log.close()
+
+    def test_recent(self):
+        """
+        recent() should return the last records by count or by age,
+        whichever covers more, surviving a reopen.
+        """
+        log = history.HistoryLog(self.path)
+        for n in range(10):
+            log.append(history.PLAY_EVENT, "/music/%d.mp3" % n, float(n))
+        log.close()
+        log = history.HistoryLog(self.path)
+        self.assertEqual([r[1] for r in log.recent(2)],
+                         [history.song_key("/music/8.mp3"),
+                          history.song_key("/music/9.mp3")])
+        self.assertEqual([r[0] for r in log.recent(2, 4.5, now=9.0)],
+                         [5.0, 6.0, 7.0, 8.0, 9.0])
+        self.assertEqual(len(log.recent(8, 1, now=9.0)), 8)
+        log.close()
+
+    def test_compact(self):
+        """
+        Compacting should keep only the most recent records.
+        """
+        log = history.HistoryLog(self.path)
+        for n in range(10):
+            log.append(history.PLAY_EVENT, "/music/%d.mp3" % n, float(n))
+        log.compact(3)
+        log.close()
+        log = history.HistoryLog(self.path)
+        self.assertEqual([r[0] for r in log.recent(100)], [7.0, 8.0, 9.0])
+        log.close()
+
+
+class TestRecentWindow(unittest2.TestCase):
+    def test_max_tracks(self):
+        """
+        Only the last max_tracks plays should be remembered, counting songs
+        played more than once.
+        """
+        window = history.RecentWindow(max_tracks=2)
+        window.add(1, 0.0)
+        window.add(2, 0.0)
+        window.add(1, 0.0)
+        self.assertIn(2, window)
+        window.add(3, 0.0)
+        self.assertNotIn(2, window)
+        self.assertIn(1, window)
+        window.add(3, 0.0)
+        self.assertNotIn(1, window)
+        self.assertEqual(len(window), 2)
+
+    def test_max_age(self):
+        """
+        Plays within max_age should be remembered, however many there are.
+        """
+        window = history.RecentWindow(max_tracks=1, max_age=10)
+        window.add(1, 0.0)
+        window.add(2, 5.0)
+        self.assertIn(1, window)
+        window.expire(10.5)
+        self.assertNotIn(1, window)
+        self.assertIn(2, window)
+
+    def test_from_log(self):
+        """
+        A window built from the log should hold its recent plays, but not
+        skips.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            log = history.HistoryLog(os.path.join(tmp_dir, "history"))
+            for n in range(5):
+                log.append(history.PLAY_EVENT, "/music/%d.mp3" % n, float(n))
+            log.append(history.SKIP_EVENT, "/music/0.mp3", 5.0)
+            window = history.RecentWindow.from_log(log, max_tracks=2,
+                                                   now=6.0)
+            log.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(len(window), 2)
+        self.assertIn(history.song_key("/music/4.mp3"), window)
+        self.assertIn(history.song_key("/music/3.mp3"), window)
@@ -0,0 +1,236 @@
+import os
+import shutil
+import tempfile
+import unittest2
+
+from random_music import index, query, trigrams
+
+
+SONGS = ["/music/a/1.mp3", "/music/a/2.mp3", "/music/b/caf\xc3\xa9.mp3", ""]
+
+
+class TestIndexFormats(unittest2.TestCase):
+    def setUp(self):
+        """
+        Create a temporary directory for index files.
+        """
+        self.index_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Remove the temporary directory.
+        """
+        shutil.rmtree(self.index_dir)
+
+    def _roundtrip(self, fmt, songs):
+        path = os.path.join(self.index_dir,
+                            "music_index" + index.INDEX_FORMATS[fmt])
+        index.write_index(path, iter(songs))
+        return index.open_index(path)
+
+    def test_text(self):
+        """
+        A text index should read back as written.
+        """
+        idx = self._roundtrip(index.TEXT_FORMAT, SONGS[:3])
+        self.assertEqual(list(idx), SONGS[:3])
+
+    def test_binary(self):
+        """
+        A binary index should read back as written, both sequentially and by
+        position.
+        """
+        idx = self._roundtrip(index.BINARY_FORMAT, SONGS)
+        self.assertEqual(len(idx), len(SONGS))
+        self.assertEqual(list(idx), SONGS)
+        self.assertEqual([idx[i] for i in range(len(SONGS))], SONGS)
+        self.assertEqual(idx[-2], SONGS[-2])
+        self.assertEqual(idx[1:3], SONGS[1:3])
+        self.assertRaises(IndexError, idx.__getitem__, len(SONGS))
+        idx.close()
+
+    def test_empty_binary(self):
+        """
+        An empty binary index should be readable.
+        """
+        idx = self._roundtrip(index.BINARY_FORMAT, [])
+        self.assertEqual(len(idx), 0)
+        self.assertEqual(list(idx), [])
+        idx.close()
+
+    def test_unknown_format(self):
+        """
+        Files with an unknown extension should be rejected.
+        """
+        self.assertRaises(ValueError, index.open_index, "music_index.foo")
+
+    def test_sqlite(self):
+        """
+        A SQLite index should read back as written, both sequentially and by
+        position.
+        """
+        idx = self._roundtrip(index.SQLITE_FORMAT, SONGS)
+        self.assertEqual(len(idx), len(SONGS))
+        self.assertEqual(list(idx), SONGS)
+        self.assertEqual([idx[i] for i in range(len(SONGS))], SONGS)
+        self.assertEqual(idx[-2], SONGS[-2])
+        self.assertEqual(idx[1:3], SONGS[1:3])
+        self.assertRaises(IndexError, idx.__getitem__, len(SONGS))
+        idx.close()
+
+    def test_sqlite_full_text(self):
+        """
+        A SQLite index should narrow searches down using its full-text
+        table, where SQLite supports it.
+        """
+        idx = self._roundtrip(index.SQLITE_FORMAT, SONGS)
+        if not index.has_full_text(idx):
+            idx.close()
+            self.skipTest("SQLite has no FTS5 trigram tokenizer")
+        search_index = index.open_search_index(idx)
+        self.assertEqual(search_index.candidates("/A/"), [0, 1])
+        self.assertEqual(search_index.candidates("cafe"), [2])
+        self.assertEqual(search_index.candidates("zzz"), [])
+        self.assertEqual(search_index.candidates("mp"), None)
+        idx.close()
+
+    def test_tags(self):
+        """
+        Tags should be stored with the index, in every format, and searched
+        along with the songs' paths.
+        """
+        tags = [index.Tags("Artist", "Album", "One", 61), index.NO_TAGS,
+                index.Tags("", "", "Caf\xc3\xa9", 0), index.NO_TAGS]
+        for fmt in index.INDEX_FORMATS:
+            path = os.path.join(self.index_dir,
+                                "music_index" + index.INDEX_FORMATS[fmt])
+            index.write_index(path, iter(SONGS[:3]), iter(tags[:3]))
+            idx = index.open_index(path)
+            tag_table = index.open_tags(idx)
+            self.assertEqual(list(tag_table), tags[:3])
+            self.assertEqual(tag_table[0], tags[0])
+            self.assertEqual(tag_table[1:], tags[1:3])
+            search_view = index.open_search_view(idx)
+            self.assertEqual(search_view[0],
+                             "/music/a/1.mp3\nartist\nalbum\none")
+            self.assertEqual(list(search_view)[1], SONGS[1])
+            search_view.close()
+            idx.close()
+
+    def test_no_tags(self):
+        """
+        An index written without tags should be searched by path alone.
+        """
+        idx = self._roundtrip(index.BINARY_FORMAT, SONGS)
+        self.assertEqual(index.open_tags(idx), None)
+        search_view = index.open_search_view(idx)
+        self.assertEqual(list(search_view),
+                         [query.search_key(song) for song in SONGS])
+        search_view.close()
+        idx.close()
+
+    def test_no_search_keys(self):
+        """
+        An index written before search keys were stored should be searched
+        by keys worked out as it is read, without its trigram index.
+        """
+        for fmt in (index.TEXT_FORMAT, index.BINARY_FORMAT):
+            idx = self._roundtrip(fmt, SONGS[:3])
+            os.unlink(index.keys_file(idx.path))
+            trigrams.build_trigram_index(trigrams.trigram_file(idx.path),
+                                         SONGS[:3])
+            self.assertEqual(index.open_search_index(idx), None)
+            search_view = index.open_search_view(idx)
+            self.assertEqual(search_view[2], "/music/b/cafe.mp3")
+            self.assertEqual(search_view[1:],
+                             ["/music/a/2.mp3", "/music/b/cafe.mp3"])
+            search_view.close()
+            idx.close()
+
+
+class TestShardedIndex(unittest2.TestCase):
+    def setUp(self):
+        """
+        Write two shards and a manifest naming them.
+        """
+        self.index_dir = tempfile.mkdtemp()
+        self.shards = []
+        for root, songs in (("/music/a", SONGS[:2]), ("/music/b", SONGS[2:3])):
+            path = index.shard_file(self.index_dir, "1", root,
+                                    index.BINARY_FORMAT)
+            tags = [index.Tags("", "", os.path.basename(song), 0)
+                    for song in songs]
+            index.write_index(path, songs, tags)
+            trigrams.build_trigram_index(trigrams.trigram_file(path),
+                                         songs)
+            self.shards.append({"root": root, "file": os.path.basename(path),
+                                "songs": len(songs), "digest":
+                                index.shard_digest(songs, tags, {})})
+        self.manifest = os.path.join(self.index_dir, index.MANIFEST_FILE)
+        index.write_manifest(self.manifest, index.BINARY_FORMAT, self.shards)
+
+    def tearDown(self):
+        """
+        Remove the temporary directory.
+        """
+        shutil.rmtree(self.index_dir)
+
+    def test_manifest(self):
+        """
+        A manifest should read back as written, and be preferred to older
+        index files.
+        """
+        manifest = index.read_manifest(self.manifest)
+        self.assertEqual(manifest["format"], index.BINARY_FORMAT)
+        self.assertEqual(manifest["shards"], self.shards)
+        self.assertEqual(index.current_index_file(self.index_dir,
+                                                  index.BINARY_FORMAT),
+                         self.manifest)
+        self.assertEqual(index.read_manifest(self.manifest + ".missing"),
+                         None)
+
+    def test_read(self):
+        """
+        The shards should read as a single index.
+        """
+        idx = index.open_index(self.manifest)
+        self.assertEqual(len(idx), 3)
+        self.assertEqual(list(idx), SONGS[:3])
+        self.assertEqual([idx[i] for i in range(3)], SONGS[:3])
+        self.assertEqual(idx[-1], SONGS[2])
+        self.assertEqual(idx[1:3], SONGS[1:3])
+        self.assertEqual(idx[::2], [SONGS[0], SONGS[2]])
+        self.assertRaises(IndexError, idx.__getitem__, 3)
+        idx.close()
+
+    def test_search(self):
+        """
+        Searches should be narrowed down shard by shard, giving positions
+        in the whole index.
+        """
+        idx = index.open_index(self.manifest)
+        search_index = index.open_search_index(idx)
+        self.assertEqual(search_index.candidates("caf"), [2])
+        self.assertEqual(search_index.candidates("/a/"), [0, 1])
+        self.assertEqual(search_index.candidates("mp"), None)
+        search_view = index.open_search_view(idx)
+        self.assertEqual(search_view[2], "/music/b/cafe.mp3\n\n\ncafe.mp3")
+        search_view.close()
+        search_index.close()
+        idx.close()
+
+    def test_remove_old_index_files(self):
+        """
+        Index files, and the files kept alongside them, should be removed
+        unless they are to be kept.
+        """
+        old_file = os.path.join(self.index_dir, "music_index_0.idx")
+        index.write_index(old_file, SONGS, [index.NO_TAGS] * len(SONGS))
+        self.assertEqual(index.remove_old_index_files(
+            self.index_dir, [shard["file"] for shard in self.shards]), 3)
+        self.assertEqual(sorted(os.listdir(self.index_dir)), sorted(
+            [index.MANIFEST_FILE] +
+            [os.path.splitext(shard["file"])[0] + ext
+             for shard in self.shards
+             for ext in (".idx", ".tags", index.KEYS_EXT,
+                         trigrams.TRIGRAM_EXT)]))
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest2
+
+from random_music.index import write_index
+from random_music.library import Library
+from random_music.selection import PERMUTATION_SHUFFLE, RANDOM_SHUFFLE
+
+
+SONGS = ["/music/David Bowie/Heroes.mp3", "/music/Lou Reed/Perfect Day.mp3",
+         "/music/Rolling Stones/Angie.mp3", "/music/David Bowie/Kooks.mp3",
+         "/music/Lou Reed/Vicious.mp3"]
+
+
+class TestLibrary(unittest2.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.tmp_dir, "index.idx")
+        write_index(self.index_file, SONGS)
+        self.library = Library(self.index_file)
+
+    def tearDown(self):
+        self.library.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_from_config(self):
+        """
+        The latest index named by a config file should be loaded.
+        """
+        config_file = os.path.join(self.tmp_dir, "config.txt")
+        with open(config_file, "w") as fh:
+            fh.write("[config]\nindex_dir = %s\nindex_format = binary\n" %
+                     self.tmp_dir)
+        library = Library.from_config(config_file)
+        self.assertEqual(library.index_file, self.index_file)
+        self.assertEqual(list(library.index), SONGS)
+        library.close()
+
+    def test_sequential(self):
+        """
+        Without a shuffle mode, matches should be played in order, once
+        unless looping.
+        """
+        self.assertEqual(list(self.library.playlist()), SONGS)
+        self.assertEqual(list(self.library.playlist(["bowie"])),
+                         [SONGS[0], SONGS[3]])
+        playlist = self.library.playlist(["reed"], loop=True)
+        self.assertEqual([playlist.next() for _ in range(3)],
+                         [SONGS[1], SONGS[4], SONGS[1]])
+
+    def test_permutation(self):
+        """
+        Every song should be played once each time round, in a different
+        order each time, and the same seed and position should resume the
+        same sequence.
+        """
+        playlist = self.library.playlist(shuffle_mode=PERMUTATION_SHUFFLE,
+                                         seed=3, loop=True)
+        played = [playlist.next() for _ in range(len(SONGS) * 4)]
+        rounds = [played[n:n + len(SONGS)]
+                  for n in range(0, len(played), len(SONGS))]
+        for songs in rounds:
+            self.assertEqual(sorted(songs), sorted(SONGS))
+        self.assertGreater(len(set(tuple(songs) for songs in rounds)), 1)
+        state = playlist.state()
+        self.assertEqual(state["position"], len(played))
+        state["position"] = 7
+        resumed = self.library.playlist(**state)
+        self.assertEqual(resumed.peek(), played[7])
+        self.assertEqual(resumed.peek(2), played[9])
+        self.assertEqual(resumed.next(), played[7])
+
+    def test_random(self):
+        """
+        Random playlists should end after as many songs as they have,
+        unless looping, and be repeatable from their seed.
+        """
+        playlist = self.library.playlist(["david"], RANDOM_SHUFFLE, seed=1)
+        played = list(playlist)
+        self.assertEqual(len(played), 2)
+        self.assertTrue(set(played) <= set([SONGS[0], SONGS[3]]))
+        playlist.seek(0)
+        self.assertEqual(list(playlist), played)
+        self.assertEqual(self.library.playlist(["nothing"], RANDOM_SHUFFLE,
+                                               loop=True).next(), None)
+        self.assertRaises(ValueError, self.library.playlist,
+                          shuffle_mode="weighted")
+
+    def test_threads(self):
+        """
+        Playlists shared between threads should hand out each position
+        once, and playlists in different threads should not interfere.
+        """
+        shared = self.library.playlist(shuffle_mode=PERMUTATION_SHUFFLE,
+                                       seed=5, loop=True)
+        expected = [self.library.playlist(shuffle_mode=PERMUTATION_SHUFFLE,
+                                          seed=5, loop=True).peek(n)
+                    for n in range(400)]
+        results = []
+
+        def play():
+            own = self.library.playlist(["reed"], loop=True)
+            songs = []
+            for _ in range(100):
+                songs.append(shared.next())
+                self.assertIn(own.next(), (SONGS[1], SONGS[4]))
+            results.extend(songs)
+
+        threads = [threading.Thread(target=play) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), sorted(expected))
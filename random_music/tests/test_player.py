@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest2
+
+from random_music import player
+
+
+class TestQuote(unittest2.TestCase):
+    def test_quote(self):
+        """
+        Quotes and backslashes should be escaped for mplayer's slave mode.
+        """
+        self.assertEqual(player._quote('/music/a "b"\\c.mp3'),
+                         '"/music/a \\"b\\"\\\\c.mp3"')
+        self.assertRaises(ValueError, player._quote, "/music/a\nb.mp3")
+
+
+class TestPlayers(unittest2.TestCase):
+    def setUp(self):
+        """
+        Use touch as the music client, so that playing a song creates it.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.songs = [os.path.join(self.tmp_dir, name)
+                      for name in ("a.mp3", "b \"quoted\".mp3", "c's.mp3")]
+
+    def tearDown(self):
+        """
+        Remove the songs created.
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_simple(self):
+        """
+        Songs should be passed to the music client unquoted.
+        """
+        music_player = player.make_player(player.SIMPLE_MODE, "touch")
+        music_player.play(self.songs[1])
+        music_player.close()
+        self.assertTrue(os.path.exists(self.songs[1]))
+
+    def test_prespawn(self):
+        """
+        The next song should not be played until it is asked for, and a
+        spare process which is not needed should be cleaned up.
+        """
+        music_player = player.make_player(player.PRESPAWN_MODE, "touch")
+        music_player.play(self.songs[0], self.songs[1])
+        self.assertTrue(os.path.exists(self.songs[0]))
+        self.assertFalse(os.path.exists(self.songs[1]))
+        music_player.play(self.songs[1], self.songs[2])
+        self.assertTrue(os.path.exists(self.songs[1]))
+        music_player.close()
+        self.assertFalse(os.path.exists(self.songs[2]))
+
+    @unittest2.skipIf(player._libc is None, "prespawning needs ptrace")
+    def test_prespawn_process_group(self):
+        """
+        A prespawned process should be in our process group once started,
+        so that it can read the terminal.
+        """
+        with open(os.devnull, "r+b") as devnull:
+            proc = player._StoppedProcess(["sleep", "0.1"], devnull)
+            proc.start()
+            self.assertEqual(os.getpgid(proc.pid), os.getpgrp())
+            self.assertEqual(proc.wait(), 0)
+
+
+class TestSlavePlayer(unittest2.TestCase):
+    def test_stale_answer(self):
+        """
+        An answer left over from an earlier request should not be taken
+        for the answer to the next one.
+        """
+        slave = player.SlavePlayer.__new__(player.SlavePlayer)
+        slave.answers = player.Queue()
+        slave.answers.put("ANS_path=/music/old.mp3")
+        commands = []
+
+        def command(line):
+            commands.append(line)
+            slave.answers.put("ANS_path=/music/new.mp3")
+
+        slave._command = command
+        self.assertEqual(slave._current_path(), "/music/new.mp3")
+        self.assertEqual(len(commands), 1)
@@ -0,0 +1,106 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest2
+
+from random_music import prefetch
+
+
+class TestTrackCache(unittest2.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+        self.songs = []
+        for n in range(4):
+            song = os.path.join(self.tmp_dir, "song%d.mp3" % n)
+            with open(song, "wb") as fh:
+                fh.write(str(n) * 100)
+            self.songs.append(song)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fetch(self):
+        """
+        Songs should only be served from the cache once copied, under a
+        name keeping their extension.
+        """
+        cache = prefetch.TrackCache(self.cache_dir, 1000)
+        self.assertEqual(cache.get(self.songs[0]), None)
+        cache.fetch(self.songs[0])
+        path = cache.get(self.songs[0])
+        self.assertTrue(path.endswith(".mp3"))
+        with open(path, "rb") as fh:
+            self.assertEqual(fh.read(), "0" * 100)
+
+    def test_evict(self):
+        """
+        The least recently used copies should be evicted to make room,
+        except for pinned ones.
+        """
+        cache = prefetch.TrackCache(self.cache_dir, 250)
+        cache.fetch(self.songs[0])
+        cache.fetch(self.songs[1])
+        cache.entries[prefetch.cache_name(self.songs[0])][3] = 0
+        cache.entries[prefetch.cache_name(self.songs[1])][3] = 1
+        cache.pin([self.songs[0]])
+        cache.fetch(self.songs[2])
+        self.assertNotEqual(cache.get(self.songs[0]), None)
+        self.assertEqual(cache.get(self.songs[1]), None)
+        self.assertNotEqual(cache.get(self.songs[2]), None)
+        self.assertEqual(cache.size, 200)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    def test_persistence(self):
+        """
+        Copies should be kept between sessions, but only served once
+        checked against their songs, and copied again if they changed.
+        """
+        cache = prefetch.TrackCache(self.cache_dir, 1000)
+        cache.fetch(self.songs[0])
+        cache.fetch(self.songs[1])
+        cache.save()
+        cache.close()
+        with open(self.songs[1], "wb") as fh:
+            fh.write("changed")
+        os.utime(self.songs[1], (time.time() + 10, time.time() + 10))
+        cache = prefetch.TrackCache(self.cache_dir, 1000)
+        self.assertEqual(cache.size, 200)
+        self.assertEqual(cache.get(self.songs[0]), None)
+        cache.fetch(self.songs[0])
+        cache.fetch(self.songs[1])
+        with open(cache.get(self.songs[1]), "rb") as fh:
+            self.assertEqual(fh.read(), "changed")
+        self.assertEqual(cache.size, 107)
+
+    def test_lock(self):
+        """
+        Only one cache should be open on a directory at a time, so that
+        opening one cannot remove the copies another has made.
+        """
+        cache = prefetch.TrackCache(self.cache_dir, 1000)
+        cache.fetch(self.songs[0])
+        self.assertRaises(IOError, prefetch.TrackCache, self.cache_dir, 1000)
+        self.assertNotEqual(cache.get(self.songs[0]), None)
+        self.assertTrue(os.path.exists(cache.get(self.songs[0])))
+        cache.save()
+        cache.close()
+        prefetch.TrackCache(self.cache_dir, 1000).close()
+
+    def test_prefetcher(self):
+        """
+        Upcoming songs should be copied in the background, but not the song
+        playing.
+        """
+        cache = prefetch.TrackCache(self.cache_dir, 1000)
+        prefetcher = prefetch.Prefetcher(cache)
+        prefetcher.upcoming(self.songs[0], self.songs[1:2])
+        deadline = time.time() + 5
+        while (cache.get(self.songs[1]) is None and
+               time.time() < deadline):
+            time.sleep(0.01)
+        prefetcher.close()
+        self.assertEqual(cache.get(self.songs[0]), None)
+        self.assertNotEqual(cache.get(self.songs[1]), None)
+        self.assertEqual(cache.get(self.songs[2]), None)
@@ -0,0 +1,67 @@
+import json
+import unittest2
+from StringIO import StringIO
+
+from random_music import profiling
+
+
+class Stage(object):
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    @profiling.timed("stage")
+    def run(self, value):
+        return value
+
+
+class TestProfiler(unittest2.TestCase):
+    def test_timers_and_counters(self):
+        """
+        Timers should accumulate each time they run, including through the
+        timed decorator, and counters should add up.
+        """
+        profiler = profiling.Profiler()
+        with profiler.timer("load"):
+            pass
+        profiler.add_time("load", 2.0)
+        profiler.count("songs", 3)
+        profiler.count("songs")
+        self.assertEqual(Stage(profiler).run(5), 5)
+        self.assertEqual(profiler.timings["load"].count, 2)
+        self.assertEqual(profiler.timings["load"].max, 2.0)
+        self.assertEqual(profiler.timings["stage"].count, 1)
+        self.assertEqual(profiler.counters, {"songs": 4})
+
+    def test_report(self):
+        """
+        Reports should list timers and counters in the order they were
+        first used, as a table or one JSON object per line.
+        """
+        profiler = profiling.Profiler()
+        profiler.add_time("load", 1.0)
+        profiler.add_time("load", 3.0)
+        profiler.count("songs", 7)
+        fh = StringIO()
+        profiler.report(fh, profiling.JSON_FORMAT)
+        records = [json.loads(line) for line in fh.getvalue().splitlines()]
+        self.assertEqual(records, [
+            {"type": "timer", "name": "load", "count": 2, "total": 4.0,
+             "mean": 2.0, "min": 1.0, "max": 3.0},
+            {"type": "counter", "name": "songs", "value": 7}])
+        fh = StringIO()
+        profiler.report(fh, profiling.TEXT_FORMAT)
+        lines = fh.getvalue().splitlines()
+        self.assertEqual(lines[1].split(),
+                         ["load", "2", "4.0000s", "2.0000s", "3.0000s"])
+        self.assertEqual(lines[3].split(), ["songs", "7"])
+
+    def test_null_profiler(self):
+        """
+        The null profiler should record nothing.
+        """
+        profiler = profiling.NULL_PROFILER
+        with profiler.timer("load"):
+            pass
+        profiler.count("songs")
+        self.assertEqual(Stage(profiler).run(5), 5)
+        self.assertEqual((profiler.timings, profiler.counters), ({}, {}))
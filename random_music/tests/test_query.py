@@ -0,0 +1,131 @@
+import unittest2
+
+from random_music import query
+from random_music._exceptions import QuerySyntaxError
+
+
+SONGS = ["/music/David Bowie/Heroes/01 Beauty and the Beast.mp3",
+         "/music/David Bowie/Heroes/03 Heroes.mp3",
+         "/music/David Bowie/Stage/Heroes (Live).mp3",
+         "/music/Lou Reed/Transformer/05 Perfect Day.mp3",
+         "/music/Rolling Stones/Some Girls/Beast of Burden.mp3"]
+KEYS = [query.search_key(song) for song in SONGS]
+
+
+def _edit_distance(term, text):
+    """
+    The least edit distance between term and any part of text, worked out
+    the slow way.
+    """
+    row = [0] * (len(text) + 1)
+    for i, c in enumerate(term):
+        previous, row = row, [i + 1]
+        for j, d in enumerate(text):
+            row.append(min(previous[j + 1] + 1, row[j] + 1,
+                           previous[j] + (c != d)))
+    return min(row)
+
+
+class TestQuery(unittest2.TestCase):
+    def _search(self, *search_terms):
+        return [SONGS[n] for n in query.Query(search_terms).search(KEYS)]
+
+    def test_and(self):
+        """
+        Adjacent terms should all have to match, ignoring case.
+        """
+        self.assertEqual(self._search("bowie", "BEAST"), SONGS[:1])
+        self.assertEqual(self._search("bowie", "AND", "beast"), SONGS[:1])
+
+    def test_or(self):
+        """
+        OR should bind more loosely than AND, and songs matching several
+        branches should only be returned once, in index order.
+        """
+        self.assertEqual(self._search("stones", "OR", "reed", "day"),
+                         [SONGS[3], SONGS[4]])
+        self.assertEqual(self._search("heroes", "OR", "bowie"), SONGS[:3])
+
+    def test_not(self):
+        """
+        NOT (or a leading -) should exclude songs.
+        """
+        self.assertEqual(self._search("heroes", "NOT", "live"), SONGS[:2])
+        self.assertEqual(self._search("heroes", "-live"), SONGS[:2])
+
+    def test_phrases_and_groups(self):
+        """
+        Quoted phrases and parentheses should be supported.
+        """
+        self.assertEqual(self._search("lou reed"), [SONGS[3]])
+        self.assertEqual(self._search('"rolling stones"'), [SONGS[4]])
+        self.assertEqual(self._search("(reed", "OR", "stones)", "burden"),
+                         [SONGS[4]])
+
+    def test_anchors(self):
+        """
+        Anchored terms should only match at path segment boundaries.
+        """
+        self.assertEqual(self._search("^heroes$"), SONGS[:2])
+        self.assertEqual(self._search("^beast"), [SONGS[4]])
+        self.assertEqual(self._search("heroes$"), SONGS[:2])
+
+    def test_tags(self):
+        """
+        Terms should match tags in a song's search text, with anchors
+        matching at the start and end of each tag.
+        """
+        text = query.search_text("/music/01 track.mp3",
+                                 ("David Bowie", "Heroes", "Heroes", 360))
+        self.assertEqual(query.search_text("/music/a.mp3", ("", "", "", 0)),
+                         "/music/a.mp3")
+        self.assertTrue(query.Query(["bowie"]).matches(text))
+        self.assertTrue(query.Query(["^heroes$"]).matches(text))
+        self.assertTrue(query.Query(["track$"]).matches(text))
+        self.assertFalse(query.Query(["^bowie"]).matches(text))
+
+    def test_search_key(self):
+        """
+        Search keys should ignore case, accents and punctuation, keeping
+        path segments and file extensions.
+        """
+        self.assertEqual(query.search_key("/Bj\xc3\xb6rk/J\xc3\xb3ga.MP3"),
+                         "/bjork/joga.mp3")
+        self.assertEqual(query.search_key("/Guns N' Roses/Mr. Brownstone "
+                                          "(Live).mp3"),
+                         "/guns n roses/mr brownstone live.mp3")
+        self.assertEqual(query.search_key("Stra\xc3\x9fe\n_S.O.S._"),
+                         "strasse\ns.o.s")
+        self.assertEqual(self._search("^heroes", "live$"), [SONGS[2]])
+        self.assertTrue(query.Query(["bj\xc3\xb6rk", "guns-n-roses"]).matches(
+            "/music/Guns N' Roses/Bjork.mp3"))
+
+    def test_fuzzy(self):
+        """
+        Fuzzy terms should match text within the given number of edits.
+        """
+        self.assertEqual(self._search("bowei~"), SONGS[:3])
+        self.assertEqual(self._search("transfromer~1"), [])
+        self.assertEqual(self._search("transfromer~"), [SONGS[3]])
+        self.assertEqual(self._search("permutation~"), [])
+        self.assertEqual(repr(query.Query(["rolling~", "beethoven~"]).tree),
+                         "And([FuzzyTerm('rolling', 1), "
+                         "FuzzyTerm('beethoven', 2)])")
+        self.assertRaises(QuerySyntaxError, query.Query, ["^bowie~"])
+        for term in ("a~", "ab~2", "!!~"):
+            self.assertRaises(QuerySyntaxError, query.Query, [term])
+        for term in ("ab", "abc", "bca", "aabbc", "cabbage"):
+            for text in ("", "a", "abcabc", "bbbcccaaa", "cbacbacab"):
+                for max_edits in range(3):
+                    self.assertEqual(
+                        query.within_edits(term, text, max_edits),
+                        _edit_distance(term, text) <= max_edits,
+                        (term, text, max_edits))
+
+    def test_syntax_errors(self):
+        """
+        Malformed queries should raise QuerySyntaxError.
+        """
+        for search_terms in (["bowie", "OR"], ["(bowie"], ["bowie)"],
+                             ['"bowie']):
+            self.assertRaises(QuerySyntaxError, query.Query, search_terms)
@@ -1,9 +1,16 @@
 
 
 import os
+import shutil
+import tempfile
 import unittest2
 
 from random_music import random_music, utils
+from random_music.duplicates import load_duplicates
+from random_music.index import (MANIFEST_FILE, TEXT_FORMAT, Tags, open_index,
+                                open_tags, read_manifest, shard_digest,
+                                shard_file, write_manifest)
+from random_music.profiling import NULL_PROFILER
 
 
 class TestWhich(unittest2.TestCase):
@@ -118,9 +125,9 @@ class TestCreatConfigFile(unittest2.TestCase):
         """
         random_music.RawConfigParser.write = self.old_rcp_write 
         random_music.which = self.old_which 
-        raw_input = self.old_raw_input 
-        random_music.os.isdir = self.old_isdir 
-        open = self.old_open 
+        del random_music.raw_input
+        random_music.os.path.isdir = self.old_isdir 
+        del random_music.open
 
 
     def test_create(self):
@@ -128,3 +135,55 @@ class TestCreatConfigFile(unittest2.TestCase):
 
      
 
+
+
+class TestRemoveSongs(unittest2.TestCase):
+    def setUp(self):
+        """
+        Write a sharded index of a few songs, one of which has two copies
+        left out as duplicates.
+        """
+        self.index_dir = tempfile.mkdtemp()
+        self.rmp = random_music.RandomMusicPlaylist.__new__(
+            random_music.RandomMusicPlaylist)
+        self.rmp.index_dir = self.index_dir
+        self.rmp.profiler = NULL_PROFILER
+        songs = ["/music/a.mp3", "/music/b.mp3", "/music/c.mp3"]
+        song_tags = [Tags("A", "", "", 0), Tags("B", "", "", 0),
+                     Tags("C", "", "", 0)]
+        alternates = {"/music/b.mp3": ["/copies/b.mp3", "/more/b.mp3"]}
+        path = shard_file(self.index_dir, "1", "/music", TEXT_FORMAT)
+        self.rmp._write_shard(path, songs, song_tags, alternates)
+        write_manifest(os.path.join(self.index_dir, MANIFEST_FILE),
+                       TEXT_FORMAT,
+                       [{"root": "/music", "file": os.path.basename(path),
+                         "songs": len(songs),
+                         "digest": shard_digest(songs, song_tags,
+                                                alternates)}])
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def _shard(self):
+        manifest = read_manifest(os.path.join(self.index_dir, MANIFEST_FILE))
+        path = os.path.join(self.index_dir, manifest["shards"][0]["file"])
+        shard = open_index(path)
+        try:
+            tag_table = open_tags(shard)
+            songs_tags = zip(shard, tag_table)
+            tag_table.close()
+        finally:
+            shard.close()
+        return songs_tags, load_duplicates(path)
+
+    def test_remove_kept_duplicate(self):
+        """
+        A removed song with copies left should be replaced by its first
+        copy, with the other copies recorded against that.
+        """
+        self.assertEqual(self.rmp._remove_songs(set(["/music/b.mp3",
+                                                     "/music/c.mp3"])), 2)
+        songs_tags, alternates = self._shard()
+        self.assertEqual([(song, tags.artist) for song, tags in songs_tags],
+                         [("/music/a.mp3", "A"), ("/copies/b.mp3", "B")])
+        self.assertEqual(alternates, {"/copies/b.mp3": ["/more/b.mp3"]})
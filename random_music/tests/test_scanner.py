@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest2
+
+from random_music import scanner
+
+
+class TestScanDirs(unittest2.TestCase):
+    def setUp(self):
+        """
+        Create a small music tree in a temporary directory.
+        """
+        self.root = tempfile.mkdtemp()
+        for path in ("a/1.mp3", "a/2.mp3", "a/b/3.mp3", "c.mp3", "d/4.mp3"):
+            self._touch(path)
+        # Pretend every directory was modified long ago, so that the scan
+        # trusts their mtimes.
+        for dirpath, _, _ in os.walk(self.root):
+            os.utime(dirpath, (1, 1))
+
+    def tearDown(self):
+        """
+        Remove the temporary music tree.
+        """
+        shutil.rmtree(self.root)
+
+    def _touch(self, path):
+        full_path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        open(full_path, "w").close()
+
+    def _files(self, state):
+        return [os.path.relpath(f, self.root)
+                for f in state.iter_files([self.root])]
+
+    def test_full_scan(self):
+        """
+        A scan with no previous state should list every directory, and files
+        should come out in sorted path order.
+        """
+        state = scanner.scan_dirs([self.root])
+        self.assertEqual(state.listed, 4)
+        self.assertEqual(self._files(state),
+                         ["a/1.mp3", "a/2.mp3", "a/b/3.mp3", "c.mp3", "d/4.mp3"])
+
+    def test_incremental_scan(self):
+        """
+        Only modified directories should be relisted, and deleted
+        directories should be pruned.
+        """
+        state = scanner.scan_dirs([self.root])
+        self._touch("a/b/5.mp3")
+        os.utime(os.path.join(self.root, "a/b"), (2, 2))
+        shutil.rmtree(os.path.join(self.root, "d"))
+        os.utime(self.root, (2, 2))
+
+        state = scanner.scan_dirs([self.root], state)
+        self.assertEqual((state.listed, state.reused), (2, 1))
+        self.assertEqual(self._files(state),
+                         ["a/1.mp3", "a/2.mp3", "a/b/3.mp3", "a/b/5.mp3",
+                          "c.mp3"])
+        self.assertNotIn(os.path.join(self.root, "d"), state.entries)
+
+    def test_changed_dirs(self):
+        """
+        Given the changed directories, only they should be relisted, along
+        with any new directories beneath them.
+        """
+        state = scanner.scan_dirs([self.root])
+        self._touch("a/e/6.mp3")
+        self._touch("d/7.mp3")
+        for path in ("a", "a/e", "d"):
+            os.utime(os.path.join(self.root, path), (2, 2))
+
+        state = scanner.scan_dirs([self.root], state,
+                                  changed=set([os.path.join(self.root, "a")]))
+        self.assertEqual((state.listed, state.reused), (2, 3))
+        self.assertEqual(self._files(state),
+                         ["a/1.mp3", "a/2.mp3", "a/b/3.mp3", "a/e/6.mp3",
+                          "c.mp3", "d/4.mp3"])
+
+    def test_save_load(self):
+        """
+        A saved state should load back unchanged; a missing one should load
+        as empty.
+        """
+        state = scanner.scan_dirs([self.root])
+        state_file = os.path.join(self.root, scanner.DIR_STATE_FILE)
+        state.save(state_file)
+        self.assertEqual(scanner.DirectoryState.load(state_file).entries,
+                         state.entries)
+        self.assertEqual(scanner.DirectoryState.load("/nonexistent").entries,
+                         {})
+
+    def test_workers(self):
+        """
+        The scan's output should not depend on the number of workers.
+        """
+        serial = scanner.scan_dirs([self.root], workers=1)
+        parallel = scanner.scan_dirs([self.root], workers=4)
+        self.assertEqual(serial.entries, parallel.entries)
+        self.assertEqual(self._files(serial), self._files(parallel))
@@ -0,0 +1,82 @@
+import random
+import unittest2
+
+from random_music import selection
+
+
+class TestSelectSongs(unittest2.TestCase):
+    def setUp(self):
+        self.rng = random.Random(0)
+
+    def test_sequential(self):
+        """
+        In sequential mode, the first num_songs songs should be taken, and
+        no more of the input consumed.
+        """
+        songs = iter(range(100))
+        self.assertEqual(selection.select_songs(songs, 3), [0, 1, 2])
+        self.assertEqual(next(songs), 3)
+        songs = ["/music/%d.mp3" % n for n in range(5)]
+        self.assertEqual(selection.select_songs(songs), songs)
+
+    def test_random(self):
+        """
+        In random mode, num_songs distinct songs should be picked from
+        across the input.
+        """
+        picked = selection.select_songs(iter(range(1000)), 10, True, self.rng)
+        self.assertEqual(len(set(picked)), 10)
+        self.assertTrue(max(picked) > 100)
+        self.assertEqual(sorted(selection.select_songs(range(5), 10, True,
+                                                       self.rng)), range(5))
+
+    def test_reservoir_is_uniform(self):
+        """
+        Every item should be roughly equally likely to be picked.
+        """
+        counts = [0] * 10
+        for _ in range(5000):
+            for item in selection.reservoir_sample(iter(range(10)), 2,
+                                                   self.rng):
+                counts[item] += 1
+        for count in counts:
+            self.assertTrue(800 < count < 1200, counts)
+
+    def test_select_from_index(self):
+        """
+        Selecting from a whole index should slice or sample it.
+        """
+        index = range(100)
+        self.assertTrue(selection.select_from_index(index) is index)
+        self.assertEqual(selection.select_from_index(index, 3), [0, 1, 2])
+        picked = selection.select_from_index(index, 10, True, self.rng)
+        self.assertEqual(len(set(picked)), 10)
+
+
+class TestPermutation(unittest2.TestCase):
+    def test_bijection(self):
+        """
+        Every position should map to a different song, for all sorts of
+        sizes.
+        """
+        for n in (1, 2, 3, 10, 255, 256, 1000):
+            permutation = selection.Permutation(n, 42)
+            self.assertEqual(sorted(permutation[i] for i in range(n)),
+                             range(n))
+
+    def test_seeds(self):
+        """
+        The same seed should give the same order, and different seeds
+        different orders.
+        """
+        first = [selection.Permutation(100, 1)[i] for i in range(100)]
+        again = [selection.Permutation(100, 1)[i] for i in range(100)]
+        other = [selection.Permutation(100, 2)[i] for i in range(100)]
+        self.assertEqual(first, again)
+        self.assertNotEqual(first, other)
+        self.assertNotEqual(first, range(100))
+
+    def test_out_of_range(self):
+        permutation = selection.Permutation(10, 1)
+        self.assertRaises(IndexError, permutation.__getitem__, 10)
+        self.assertRaises(IndexError, permutation.__getitem__, -1)
@@ -0,0 +1,46 @@
+import unittest2
+
+from random_music import songtable
+
+
+SONGS = ["/music/David Bowie/Heroes/01 Beauty and the Beast.mp3",
+         "/music/David Bowie/Heroes/02 Joe the Lion.mp3",
+         "/music/David Bowie/Heroes/03 Heroes.mp3",
+         "", "/music/Bj\xc3\xb6rk/Debut/Human Behaviour.mp3",
+         "/music/" + "x" * 300 + "/long.mp3",
+         "/music/" + "x" * 300 + "/longer.mp3"]
+
+
+class TestSongTable(unittest2.TestCase):
+    def test_roundtrip(self):
+        """
+        Songs should read back as stored, in order and by position, across
+        block boundaries.
+        """
+        songs = SONGS * 20
+        table = songtable.SongTable(songs)
+        self.assertEqual(len(table), len(songs))
+        self.assertEqual(list(table), songs)
+        self.assertEqual([table[n] for n in range(len(songs))], songs)
+        self.assertEqual(table[-1], songs[-1])
+        self.assertEqual(table[28:36], songs[28:36])
+        self.assertRaises(IndexError, table.__getitem__, len(songs))
+
+    def test_append(self):
+        """
+        Songs appended should be readable straight away.
+        """
+        table = songtable.SongTable()
+        for song in SONGS:
+            table.append(song)
+            self.assertEqual(table[-1], song)
+        self.assertEqual(table, SONGS)
+
+    def test_compact(self):
+        """
+        Paths sharing prefixes should be stored in much less space than the
+        paths themselves.
+        """
+        table = songtable.SongTable(SONGS[:3] * 100)
+        self.assertLess(len(table._data) + len(table._offsets) * 8,
+                        sum(len(song) for song in SONGS[:3] * 100) / 2)
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest2
+
+from random_music import tags
+from random_music.index import NO_TAGS, Tags
+
+
+def _id3v1(title, artist, album):
+    return ("TAG" + title.ljust(30, "\0") + artist.ljust(30, "\0") +
+            album.ljust(30, "\0") + "\0" * 35)
+
+
+class TestTags(unittest2.TestCase):
+    def setUp(self):
+        """
+        Create a few files, audio and otherwise.
+        """
+        self.music_dir = tempfile.mkdtemp()
+        self.files = {
+            "song.mp3": "\xff\xfb" + "\0" * 200 +
+                        _id3v1("Heroes", "David Bowie", "Heroes"),
+            "cover.jpg": "\xff\xd8\xff\xe0",
+            "notes.nfo": "ID3 but not really",
+            "track.unknown": "fLaC\0\0\0\x22",
+            "readme": "just text",
+        }
+        for name, data in self.files.items():
+            with open(os.path.join(self.music_dir, name), "wb") as fh:
+                fh.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.music_dir)
+
+    def _path(self, name):
+        return os.path.join(self.music_dir, name)
+
+    def test_is_audio(self):
+        """
+        Audio files should be recognised by extension or magic bytes.
+        """
+        self.assertTrue(tags.is_audio(self._path("song.mp3")))
+        self.assertTrue(tags.is_audio(self._path("track.unknown")))
+        self.assertFalse(tags.is_audio(self._path("cover.jpg")))
+        self.assertFalse(tags.is_audio(self._path("notes.nfo")))
+        self.assertFalse(tags.is_audio(self._path("readme")))
+
+    def test_id3v1(self):
+        """
+        ID3v1 tags should be read without mutagen.
+        """
+        mutagen, tags.mutagen = tags.mutagen, None
+        try:
+            self.assertEqual(tags.read_tags(self._path("song.mp3")),
+                             Tags("David Bowie", "Heroes", "Heroes", 0))
+            self.assertEqual(tags.read_tags(self._path("track.unknown")),
+                             NO_TAGS)
+        finally:
+            tags.mutagen = mutagen
+
+    def test_scan_files(self):
+        """
+        Only audio files should be yielded, in order, and unchanged files
+        should not be examined again.
+        """
+        paths = [self._path(name) for name in sorted(self.files)]
+        paths.append(self._path("gone.mp3"))
+        for workers in (1, 2):
+            cache = tags.TagCache()
+            found = list(tags.scan_files(paths, tags.TagCache(), cache,
+                                         workers))
+            self.assertEqual([path for path, _ in found],
+                             [self._path("song.mp3"),
+                              self._path("track.unknown")])
+            self.assertEqual(cache.examined, 5)
+            new_cache = tags.TagCache()
+            self.assertEqual(list(tags.scan_files(paths, cache, new_cache,
+                                                  workers)), found)
+            self.assertEqual((new_cache.examined, new_cache.reused), (0, 5))
+
+    def test_scan_changed_files(self):
+        """
+        Given the changed files, only they (and files not yet cached) should
+        be examined; the rest should keep their cached entries.
+        """
+        paths = [self._path(name) for name in sorted(self.files)]
+        cache = tags.TagCache()
+        list(tags.scan_files(paths[1:], tags.TagCache(), cache, 1))
+        for path in paths:
+            with open(path, "ab") as fh:
+                fh.write("more")
+        new_cache = tags.TagCache()
+        list(tags.scan_files(paths, cache, new_cache, 1, set(paths[1:2])))
+        self.assertEqual(new_cache.examined, 2)
+        for path in paths[2:]:
+            self.assertEqual(new_cache.entries[path], cache.entries[path])
+        self.assertEqual(new_cache.entries[paths[1]][0],
+                         os.path.getsize(paths[1]))
+
+    def test_cache_roundtrip(self):
+        """
+        A saved cache should load back as saved.
+        """
+        cache = tags.TagCache()
+        list(tags.scan_files([self._path("song.mp3")], tags.TagCache(),
+                             cache, 1))
+        cache_file = os.path.join(self.music_dir, tags.TAG_CACHE_FILE)
+        cache.save(cache_file)
+        self.assertEqual(tags.TagCache.load(cache_file).entries,
+                         cache.entries)
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest2
+
+from random_music import query, trigrams
+
+
+SONGS = ["/music/David Bowie/Heroes.mp3", "/music/Lou Reed/Perfect Day.mp3",
+         "/music/David Byrne/Like Humans Do.mp3"]
+
+
+class TestTrigramIndex(unittest2.TestCase):
+    def setUp(self):
+        """
+        Build a trigram index for a few songs.
+        """
+        self.index_dir = tempfile.mkdtemp()
+        index_file = os.path.join(self.index_dir, "music_index.txt")
+        trigrams.build_trigram_index(trigrams.trigram_file(index_file),
+                                     SONGS)
+        self.trigram_index = trigrams.open_trigram_index(index_file)
+
+    def tearDown(self):
+        """
+        Remove the trigram index.
+        """
+        self.trigram_index.close()
+        shutil.rmtree(self.index_dir)
+
+    def test_candidates(self):
+        """
+        Candidates should include every song containing the term, ignoring
+        case.
+        """
+        self.assertEqual(list(self.trigram_index.candidates("DAVID")), [0, 2])
+        self.assertEqual(list(self.trigram_index.candidates("reed")), [1])
+        self.assertEqual(list(self.trigram_index.candidates("zzz")), [])
+
+    def test_short_terms(self):
+        """
+        Terms too short to contain a trigram can't narrow the search down.
+        """
+        self.assertEqual(self.trigram_index.candidates("lo"), None)
+
+    def test_fuzzy_candidates(self):
+        """
+        Fuzzy terms should be narrowed down to songs containing part of the
+        term, unless the parts are too short.
+        """
+        self.assertEqual(query.Query(["perfcet~"]).tree.candidates(
+            self.trigram_index), [1])
+        self.assertEqual(query.Query(["humnas~2"]).tree.candidates(
+            self.trigram_index), None)
+
+    def test_missing_index(self):
+        """
+        A missing trigram index should open as None.
+        """
+        self.assertEqual(trigrams.open_trigram_index("/nonexistent.txt"),
+                         None)
@@ -0,0 +1,38 @@
+import os
+import shutil
+import tempfile
+import unittest2
+
+from random_music import validate
+
+
+class TestFindMissing(unittest2.TestCase):
+    def setUp(self):
+        """
+        Create some songs in a temporary directory, and list them along with
+        some which don't exist.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.songs = []
+        for n in range(validate.BATCH_SIZE * 2 + 10):
+            path = os.path.join(self.tmp_dir, "%d.mp3" % n)
+            if n % 7:
+                open(path, "w").close()
+            self.songs.append(path)
+
+    def tearDown(self):
+        """
+        Remove the temporary directory.
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_find_missing(self):
+        """
+        The positions of missing songs should be found, in order, however
+        many workers check them.
+        """
+        expected = range(0, len(self.songs), 7)
+        for workers in (1, 4):
+            self.assertEqual(validate.find_missing(self.songs, workers),
+                             expected)
+        self.assertEqual(validate.find_missing([]), [])
@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest2
+
+from random_music import watcher
+from random_music.scanner import scan_dirs
+
+
+class TestWatchers(unittest2.TestCase):
+    def setUp(self):
+        """
+        Create a small music directory, and scan it.
+        """
+        self.music_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.music_dir, "Artist"))
+        self.state = scan_dirs([self.music_dir])
+
+    def tearDown(self):
+        shutil.rmtree(self.music_dir)
+
+    def _copy_album(self):
+        album_dir = os.path.join(self.music_dir, "Artist", "Album")
+        os.mkdir(album_dir)
+        for n in range(3):
+            with open(os.path.join(album_dir, "%02d.mp3" % n), "wb") as fh:
+                fh.write("x")
+
+    def _wait_for(self, watch):
+        timer = threading.Timer(0.1, self._copy_album)
+        timer.start()
+        try:
+            return watch.wait()
+        finally:
+            timer.join()
+            watch.close()
+
+    @unittest2.skipIf(watcher._libc is None, "inotify is not available")
+    def test_inotify(self):
+        """
+        A burst of changes should be reported as a single batch.
+        """
+        watch = watcher.InotifyWatcher([self.music_dir], settle_time=0.3)
+        watch.update(self.state)
+        self.assertEqual(sorted(watch.wds), sorted(self.state.entries))
+        self.assertEqual(self._wait_for(watch),
+                         set([os.path.join(self.music_dir, "Artist")]))
+
+    def test_polling(self):
+        """
+        Rescans should report the directories which have changed.
+        """
+        watch = watcher.PollingWatcher([self.music_dir], 1, interval=0.2)
+        watch.update(self.state)
+        self.assertEqual(self._wait_for(watch),
+                         set([os.path.join(self.music_dir, "Artist"),
+                              os.path.join(self.music_dir, "Artist",
+                                           "Album")]))
@@ -0,0 +1,97 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest2
+
+from random_music import weights
+
+
+class TestFenwickTree(unittest2.TestCase):
+    def test_prefix_sums(self):
+        """
+        Prefix sums should stay correct as weights are updated.
+        """
+        values = [1.0, 2.0, 0.0, 4.0, 0.5, 3.0, 2.0]
+        tree = weights.FenwickTree(values)
+        for i in range(len(values) + 1):
+            self.assertAlmostEqual(tree.prefix_sum(i), sum(values[:i]))
+        tree.update(3, 1.0)
+        values[3] = 1.0
+        for i in range(len(values) + 1):
+            self.assertAlmostEqual(tree.prefix_sum(i), sum(values[:i]))
+
+    def test_find(self):
+        """
+        find() should return the item whose range contains the target,
+        never picking items with no weight.
+        """
+        tree = weights.FenwickTree([1.0, 0.0, 2.0, 1.0])
+        self.assertEqual([tree.find(t) for t in (0, 0.99, 1.0, 2.99, 3.0,
+                                                  3.99)],
+                         [0, 0, 2, 2, 3, 3])
+
+    def test_sample(self):
+        """
+        Items should be sampled in proportion to their weights.
+        """
+        tree = weights.FenwickTree([1.0, 0.0, 3.0])
+        rng = random.Random(0)
+        counts = [0, 0, 0]
+        for _ in range(4000):
+            counts[tree.sample(rng)] += 1
+        self.assertEqual(counts[1], 0)
+        self.assertTrue(800 < counts[0] < 1200, counts)
+        self.assertEqual(weights.FenwickTree([0.0]).sample(rng), None)
+
+
+class TestWeightedSampler(unittest2.TestCase):
+    def setUp(self):
+        """
+        Keep song stats in a temporary directory.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.stats_file = os.path.join(self.tmp_dir, weights.SONG_STATS_FILE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_weights(self):
+        """
+        Played, skipped and low-rated songs should have lower weights.
+        """
+        stats = weights.SongStats(self.stats_file)
+        sampler = weights.WeightedSampler(["a", "b", "c", "d"], stats)
+        sampler.played(0)
+        sampler.skipped(1)
+        sampler.rate(2, 0)
+        self.assertTrue(sampler.tree[0] < 0.1)
+        self.assertAlmostEqual(sampler.tree[1], weights.SKIP_PENALTY)
+        self.assertEqual(sampler.tree[2], 0)
+        self.assertEqual(sampler.tree[3], 1.0)
+
+    def test_exclude(self):
+        """
+        Excluded songs should not be picked, nor have anything recorded
+        against them.
+        """
+        stats = weights.SongStats(self.stats_file)
+        sampler = weights.WeightedSampler(["a", "b"], stats)
+        sampler.exclude(0)
+        rng = random.Random(1)
+        self.assertEqual(set(sampler.sample(rng) for _ in range(20)), set([1]))
+        self.assertFalse("a" in stats)
+        sampler.exclude(1)
+        self.assertEqual(sampler.sample(rng), None)
+
+    def test_persistence(self):
+        """
+        Stats should be saved, and picked up by later samplers.
+        """
+        stats = weights.SongStats(self.stats_file)
+        stats.rate("b", 0)
+        stats.save()
+        sampler = weights.WeightedSampler(["a", "b"],
+                                          weights.SongStats(self.stats_file))
+        self.assertEqual(sampler.tree[1], 0)
+        self.assertRaises(ValueError, stats.rate, "a", 6)
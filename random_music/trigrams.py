@@ -0,0 +1,190 @@
+"""Trigram index for substring searches.
+
+For every (lowercased) three-character sequence which appears in any song
+path, a trigram index stores the sorted list of positions of the songs
+containing it. Any song which contains a search term must contain every one
+of the term's trigrams, so intersecting their posting lists gives a (usually
+small) set of candidates, and only those candidates need to be checked for
+the term itself.
+
+The index is stored in a file alongside the song index, and is mmap()ed when
+searching, so only the posting lists of the trigrams being searched for are
+ever read.
+
+"""
+
+import os
+import sys
+import mmap
+import struct
+from array import array
+
+TRIGRAM_EXT = ".tri"
+
+# magic, number of trigrams
+TRIGRAM_HEADER = struct.Struct("<8sQ")
+TRIGRAM_MAGIC = "RMTRI001"
+# trigram, position of its posting list, length of its posting list
+TRIGRAM_KEY = struct.Struct("<3sxQI")
+
+
+def trigram_file(index_file):
+    """
+    Return the path of the trigram index for an index file.
+
+    :param index_file: path to the song index
+    :type index_file: str
+    """
+    return os.path.splitext(index_file)[0] + TRIGRAM_EXT
+
+
+def trigrams(text):
+    """
+    Return the set of trigrams in a (lowercased) string.
+
+    :param text: the string
+    :type text: str
+    """
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+def _postings_array(data=None):
+    """
+    Return an array of unsigned 32-bit song positions.
+    """
+    postings = array("I")
+    if data is not None:
+        postings.fromstring(data)
+        if sys.byteorder == "big":
+            postings.byteswap()
+    return postings
+
+
+def build_trigram_index(path, songs):
+    """
+    Build a trigram index for songs and write it to path.
+
+    :param path: path to write the trigram index to
+    :type path: str
+    :param songs: song paths, in index order
+    :type songs: iterable
+    """
+    postings = {}
+    for n, song in enumerate(songs):
+        for trigram in trigrams(song.lower()):
+            try:
+                postings[trigram].append(n)
+            except KeyError:
+                postings[trigram] = array("I", [n])
+    keys = sorted(postings)
+
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "wb") as fh:
+        fh.write(TRIGRAM_HEADER.pack(TRIGRAM_MAGIC, len(keys)))
+        position = 0
+        for key in keys:
+            fh.write(TRIGRAM_KEY.pack(key, position, len(postings[key])))
+            position += len(postings[key])
+        for key in keys:
+            if sys.byteorder == "big":
+                postings[key].byteswap()
+            postings[key].tofile(fh)
+    os.rename(tmp_path, path)
+
+
+class TrigramIndex(object):
+    """
+    A memory-mapped trigram index.
+    """
+    def __init__(self, path):
+        """
+        :param path: path to the trigram index
+        :type path: str
+        """
+        self.path = path
+        with open(path, "rb") as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._num_keys = TRIGRAM_HEADER.unpack_from(self._map)
+        if magic != TRIGRAM_MAGIC:
+            self._map.close()
+            raise ValueError("'%s' is not a trigram index" % path)
+        self._postings_start = (TRIGRAM_HEADER.size +
+                                TRIGRAM_KEY.size * self._num_keys)
+
+    def _key(self, n):
+        return TRIGRAM_KEY.unpack_from(self._map, TRIGRAM_HEADER.size +
+                                                  TRIGRAM_KEY.size * n)
+
+    def postings(self, trigram):
+        """
+        Return the sorted positions of songs containing trigram.
+
+        :param trigram: a (lowercased) three-character string
+        :type trigram: str
+        """
+        lo, hi = 0, self._num_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid)[0] < trigram:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self._num_keys:
+            return _postings_array()
+        key, position, length = self._key(lo)
+        if key != trigram:
+            return _postings_array()
+        start = self._postings_start + 4 * position
+        return _postings_array(self._map[start:start + 4 * length])
+
+    def candidates(self, term):
+        """
+        Return the sorted positions of songs which may contain term, or
+        None if term is too short to narrow the search down.
+
+        :param term: the search term
+        :type term: str
+        """
+        term_trigrams = trigrams(term.lower())
+        if not term_trigrams:
+            return None
+        lists = sorted((self.postings(t) for t in term_trigrams), key=len)
+        result = lists[0]
+        for postings in lists[1:]:
+            if not result:
+                break
+            result = intersect(result, postings)
+        return result
+
+    def close(self):
+        self._map.close()
+
+
+def intersect(a, b):
+    """
+    Return the intersection of two sorted sequences of song positions, as a
+    sorted list.
+
+    :param a: sorted song positions
+    :type a: sequence
+    :param b: sorted song positions
+    :type b: sequence
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    b = set(b)
+    return [n for n in a if n in b]
+
+
+def open_trigram_index(index_file):
+    """
+    Open the trigram index for an index file, returning None if there is no
+    (readable) trigram index.
+
+    :param index_file: path to the song index
+    :type index_file: str
+    """
+    try:
+        return TrigramIndex(trigram_file(index_file))
+    except (IOError, ValueError, mmap.error):
+        return None
@@ -0,0 +1,70 @@
+"""Find songs in the index whose files have gone.
+
+Songs moved or deleted since the last update stay in the index until the
+next one, and each costs a player start when it comes up. A validation pass
+stat()s every song in the index, in batches shared out amongst a pool of
+worker threads (as in scanner.scan_dirs, a stat on a network mount is mostly
+spent waiting, with the GIL released), so the missing songs can be removed
+from the index without rescanning the music directories.
+
+"""
+
+import os
+from itertools import imap, islice
+from multiprocessing.pool import ThreadPool
+
+from scanner import DEFAULT_SCAN_WORKERS
+
+# Number of songs checked by a worker at a time
+BATCH_SIZE = 500
+
+
+def _batches(songs):
+    """
+    Split songs into (position of first song, list of songs) batches.
+    """
+    songs = iter(songs)
+    start = 0
+    while True:
+        batch = list(islice(songs, BATCH_SIZE))
+        if not batch:
+            return
+        yield start, batch
+        start += len(batch)
+
+
+def _check(job):
+    """
+    Return the positions of the songs in a batch whose files are missing.
+
+    :param job: (position of the first song, list of songs)
+    :type job: tuple
+    """
+    start, batch = job
+    return [start + n for n, song in enumerate(batch)
+            if not os.path.exists(song)]
+
+
+def find_missing(songs, workers=DEFAULT_SCAN_WORKERS):
+    """
+    Return the positions of the songs whose files are missing, in order.
+
+    :param songs: paths of the songs to check
+    :type songs: iterable
+    :param workers: number of batches to check concurrently
+    :type workers: int
+    """
+    pool = ThreadPool(workers) if workers > 1 else None
+    try:
+        if pool is not None:
+            results = pool.imap(_check, _batches(songs))
+        else:
+            results = imap(_check, _batches(songs))
+        missing = []
+        for positions in results:
+            missing.extend(positions)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return missing
@@ -0,0 +1,258 @@
+"""Watch music directories for changes, so the index can be kept up to date.
+
+On Linux, every directory beneath the music directories is watched with
+inotify (through ctypes), which reports files and directories being created,
+deleted, moved or written. Changes tend to come in bursts (an album being
+copied in, say), so once something changes we wait for things to settle
+before reporting the whole batch of changed directories at once.
+
+Elsewhere, or when there are more directories than the kernel allows
+watches for (see /proc/sys/fs/inotify/max_user_watches), the music
+directories are polled instead: every so often they are rescanned
+incrementally (which only stat()s directories whose listings have not
+changed) and compared with the last scan.
+
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from scanner import DEFAULT_SCAN_WORKERS, scan_dirs
+
+# Once something has changed, report it when nothing else has changed for
+# this long ...
+SETTLE_TIME = 2.0
+# ... or this long after the first change, whichever comes first
+MAX_BATCH_DELAY = 30.0
+# How often directories are rescanned when polling
+POLL_INTERVAL = 60.0
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+# watch descriptor, mask, cookie, length of name
+EVENT = struct.Struct("iIII")
+READ_SIZE = 65536
+
+
+def _load_libc():
+    """
+    Return libc, if it has inotify support, or None.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _load_libc()
+
+
+def make_watcher(music_dirs, scan_workers=DEFAULT_SCAN_WORKERS):
+    """
+    Return an InotifyWatcher if inotify is available, or a PollingWatcher
+    otherwise.
+
+    :param music_dirs: root directories to watch
+    :type music_dirs: list[str]
+    :param scan_workers: number of directories to scan at once when polling
+    :type scan_workers: int
+    """
+    if _libc is not None:
+        try:
+            return InotifyWatcher(music_dirs)
+        except OSError:
+            pass
+    return PollingWatcher(music_dirs, scan_workers)
+
+
+class InotifyWatcher(object):
+    """
+    Watch directories with inotify.
+    """
+    def __init__(self, music_dirs, settle_time=SETTLE_TIME,
+                 max_delay=MAX_BATCH_DELAY):
+        """
+        :param music_dirs: root directories to watch
+        :type music_dirs: list[str]
+        :param settle_time: how long to wait for changes to stop
+        :type settle_time: float
+        :param max_delay: longest time to hold on to a change
+        :type max_delay: float
+        """
+        self.music_dirs = music_dirs
+        self.settle_time = settle_time
+        self.max_delay = max_delay
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths = {}
+        self.wds = {}
+        self.overflowed = False
+
+    def _add_watch(self, path):
+        wd = _libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                # Gone (or unreadable) since it was scanned
+                return
+            raise OSError(err, os.strerror(err))
+        # Watching a directory which was moved gives back its existing watch
+        old_path = self.paths.get(wd)
+        if old_path is not None and self.wds.get(old_path) == wd:
+            del self.wds[old_path]
+        self.paths[wd] = path
+        self.wds[path] = wd
+
+    def update(self, state):
+        """
+        Watch every directory in a scan, and stop watching any others. Raises
+        OSError (with errno ENOSPC) if the kernel's limit on watches is
+        reached.
+
+        :param state: the latest scan of the music directories
+        :type state: scanner.DirectoryState
+        """
+        for path in list(self.wds):
+            if path not in state.entries:
+                wd = self.wds.pop(path)
+                del self.paths[wd]
+                _libc.inotify_rm_watch(self.fd, wd)
+        for path in state.entries:
+            if path not in self.wds:
+                self._add_watch(path)
+
+    def _read_events(self):
+        """
+        Read the pending events, returning the set of directories they
+        concern.
+        """
+        changed = set()
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError, err:
+            if err.errno == errno.EAGAIN:
+                return changed
+            raise
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so assume anything could have changed.
+                self.overflowed = True
+                changed.update(self.music_dirs)
+                continue
+            path = self.paths.get(wd)
+            if path is None:
+                continue
+            changed.add(path)
+            if mask & IN_IGNORED:
+                # The directory has gone, and its watch with it.
+                del self.paths[wd]
+                if self.wds.get(path) == wd:
+                    del self.wds[path]
+        return changed
+
+    def wait(self):
+        """
+        Wait for directories to change, returning the set of directories
+        which changed once things have settled, or None if events were lost
+        and any directory could have changed.
+        """
+        changed = set()
+        while not changed:
+            select.select([self.fd], [], [])
+            changed = self._read_events()
+        deadline = time.time() + self.max_delay
+        while True:
+            timeout = min(self.settle_time, deadline - time.time())
+            if timeout <= 0:
+                break
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if not readable:
+                break
+            changed.update(self._read_events())
+        if self.overflowed:
+            self.overflowed = False
+            return None
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """
+    Watch directories by rescanning them every so often.
+    """
+    def __init__(self, music_dirs, scan_workers=DEFAULT_SCAN_WORKERS,
+                 interval=POLL_INTERVAL):
+        """
+        :param music_dirs: root directories to watch
+        :type music_dirs: list[str]
+        :param scan_workers: number of directories to scan at once
+        :type scan_workers: int
+        :param interval: seconds between scans
+        :type interval: float
+        """
+        self.music_dirs = music_dirs
+        self.scan_workers = scan_workers
+        self.interval = interval
+        self.state = None
+
+    def update(self, state):
+        """
+        Set the scan which later scans are compared with.
+
+        :param state: the latest scan of the music directories
+        :type state: scanner.DirectoryState
+        """
+        self.state = state
+
+    def wait(self):
+        """
+        Wait for directories to change, returning the set of directories
+        which changed.
+        """
+        while True:
+            time.sleep(self.interval)
+            new_state = scan_dirs(self.music_dirs, self.state,
+                                  self.scan_workers)
+            old_entries = self.state.entries if self.state else {}
+            changed = set(path for path in old_entries
+                          if path not in new_state.entries)
+            for path, entry in new_state.entries.iteritems():
+                old_entry = old_entries.get(path)
+                if old_entry is None or old_entry[1:] != entry[1:]:
+                    changed.add(path)
+            self.state = new_state
+            if changed:
+                return changed
+
+    def close(self):
+        pass
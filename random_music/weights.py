@@ -0,0 +1,299 @@
+"""Weighted random song selection, driven by ratings and play history.
+
+Each song's weight is the product of three factors:
+
+rating
+    Songs can be rated from 0 to 5 (unrated songs count as 3). A song rated
+    0 is never picked.
+recency
+    A song which has just been played has a small weight, which recovers
+    linearly over RECENCY_WINDOW.
+skips
+    Each time a song is skipped its weight is reduced.
+
+Weights are kept in a Fenwick (binary indexed) tree, so a song can be picked
+in proportion to its weight, and a song's weight changed, in O(log n) time,
+however many songs there are.
+
+Ratings and play history are stored in the random_music home directory, and
+only for songs which have been rated or played.
+
+"""
+
+import os
+import time
+import marshal
+from array import array
+
+SONG_STATS_FILE = "song_stats.marshal"
+
+DEFAULT_RATING = 3
+MAX_RATING = 5
+# Time taken for a played song's weight to recover fully
+RECENCY_WINDOW = 7 * 24 * 60 * 60
+# Weight of a song which has just been played, relative to one which has not
+# been played recently
+MIN_RECENCY = 0.01
+# Each skip multiplies a song's weight by this
+SKIP_PENALTY = 0.7
+# Save stats after this many changes, as well as when closed
+SAVE_INTERVAL = 20
+
+# Indexes into a song's stats list
+RATING, LAST_PLAYED, PLAYS, SKIPS = range(4)
+
+
+class FenwickTree(object):
+    """
+    Non-negative weights supporting O(log n) updates, prefix sums and
+    weighted selection.
+    """
+    def __init__(self, weights):
+        """
+        :param weights: initial weights
+        :type weights: iterable of float
+        """
+        self.weights = array("d", weights)
+        self.n = len(self.weights)
+        # tree[i] holds the sum of weights (i - lowbit(i), i], 1-based
+        self.tree = array("d", [0.0]) + self.weights
+        for i in xrange(1, self.n + 1):
+            parent = i + (i & -i)
+            if parent <= self.n:
+                self.tree[parent] += self.tree[i]
+        self._top_bit = 1 << (self.n.bit_length() - 1) if self.n else 0
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return self.weights[i]
+
+    def update(self, i, weight):
+        """
+        Set the weight of item i.
+
+        :param i: the item's position
+        :type i: int
+        :param weight: its new weight
+        :type weight: float
+        """
+        delta = weight - self.weights[i]
+        self.weights[i] = weight
+        i += 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, i):
+        """
+        Return the total weight of items [0, i).
+
+        :param i: number of items to sum
+        :type i: int
+        """
+        total = 0.0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def total(self):
+        return self.prefix_sum(self.n)
+
+    def find(self, target):
+        """
+        Return the position of the item whose cumulative weight range
+        contains target, i.e. the smallest i with prefix_sum(i + 1) > target.
+
+        :param target: a value in [0, total())
+        :type target: float
+        """
+        position = 0
+        bit = self._top_bit
+        while bit:
+            next_position = position + bit
+            if next_position <= self.n and self.tree[next_position] <= target:
+                position = next_position
+                target -= self.tree[next_position]
+            bit >>= 1
+        # Guard against floating point error pushing us past the last item
+        # with any weight.
+        position = min(position, self.n - 1)
+        while position > 0 and self.weights[position] == 0:
+            position -= 1
+        return position
+
+    def sample(self, rng):
+        """
+        Return the position of a random item, chosen in proportion to its
+        weight, or None if every weight is zero.
+
+        :param rng: source of randomness
+        :type rng: random.Random
+        """
+        total = self.total()
+        if total <= 0:
+            return None
+        return self.find(rng.random() * total)
+
+
+class SongStats(object):
+    """
+    Ratings and play history for songs, keyed by path.
+    """
+    def __init__(self, path):
+        """
+        :param path: path of the file the stats are stored in
+        :type path: str
+        """
+        self.path = path
+        self.changes = 0
+        try:
+            with open(path, "rb") as fh:
+                self.stats = marshal.load(fh)
+        except (IOError, EOFError, ValueError, TypeError):
+            self.stats = {}
+
+    def __contains__(self, song):
+        return song in self.stats
+
+    def _get(self, song):
+        try:
+            return self.stats[song]
+        except KeyError:
+            stats = self.stats[song] = [DEFAULT_RATING, 0.0, 0, 0]
+            return stats
+
+    def _changed(self):
+        self.changes += 1
+        if self.changes >= SAVE_INTERVAL:
+            self.save()
+
+    def rate(self, song, rating):
+        """
+        Rate a song.
+
+        :param song: path to the song
+        :type song: str
+        :param rating: rating, from 0 to MAX_RATING
+        :type rating: int
+        """
+        if not 0 <= rating <= MAX_RATING:
+            raise ValueError("Ratings must be between 0 and %d" % MAX_RATING)
+        self._get(song)[RATING] = rating
+        self._changed()
+
+    def played(self, song, now=None):
+        """
+        Record that a song has started playing.
+
+        :param song: path to the song
+        :type song: str
+        """
+        stats = self._get(song)
+        stats[LAST_PLAYED] = now if now is not None else time.time()
+        stats[PLAYS] += 1
+        self._changed()
+
+    def skipped(self, song):
+        """
+        Record that a song was skipped.
+
+        :param song: path to the song
+        :type song: str
+        """
+        self._get(song)[SKIPS] += 1
+        self._changed()
+
+    def weight(self, song, now=None):
+        """
+        Return a song's selection weight.
+
+        :param song: path to the song
+        :type song: str
+        """
+        try:
+            rating, last_played, _, skips = self.stats[song]
+        except KeyError:
+            return 1.0
+        if now is None:
+            now = time.time()
+        recency = min(1.0, max(MIN_RECENCY,
+                               (now - last_played) / RECENCY_WINDOW))
+        return ((float(rating) / DEFAULT_RATING) ** 2 * recency *
+                SKIP_PENALTY ** skips)
+
+    def save(self):
+        """
+        Save the stats, replacing the stored stats atomically.
+        """
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "wb") as fh:
+            marshal.dump(self.stats, fh)
+        os.rename(tmp_path, self.path)
+        self.changes = 0
+
+
+class WeightedSampler(object):
+    """
+    Pick songs from a playlist in proportion to their weights, keeping the
+    weights up to date as songs are played and skipped.
+    """
+    def __init__(self, songs, stats, now=None):
+        """
+        :param songs: the playlist
+        :type songs: sequence
+        :param stats: ratings and play history
+        :type stats: SongStats
+        """
+        self.songs = songs
+        self.stats = stats
+        weights = array("d", [1.0]) * len(songs)
+        # Only songs with stats need their weight working out
+        if stats.stats:
+            for n, song in enumerate(songs):
+                if song in stats:
+                    weights[n] = stats.weight(song, now)
+        self.tree = FenwickTree(weights)
+
+    def sample(self, rng):
+        """
+        Return the position of a randomly chosen song, or None if no song
+        can be picked.
+
+        :param rng: source of randomness
+        :type rng: random.Random
+        """
+        return self.tree.sample(rng)
+
+    def _update(self, n):
+        self.tree.update(n, self.stats.weight(self.songs[n]))
+
+    def played(self, n):
+        """
+        Record that the song at position n has started playing.
+        """
+        self.stats.played(self.songs[n])
+        self._update(n)
+
+    def skipped(self, n):
+        """
+        Record that the song at position n was skipped.
+        """
+        self.stats.skipped(self.songs[n])
+        self._update(n)
+
+    def rate(self, n, rating):
+        """
+        Rate the song at position n.
+        """
+        self.stats.rate(self.songs[n], rating)
+        self._update(n)
+
+    def exclude(self, n):
+        """
+        Stop picking the song at position n (e.g. because its file has
+        gone), without recording anything against it.
+        """
+        self.tree.update(n, 0.0)